@@ -1,21 +1,38 @@
 import argparse
+import csv
+import json
+import os
+import shutil
 import subprocess
 import sys
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
-from image_manipulation import utils
+from PIL import Image
+
+from image_manipulation import metadata, utils
+from image_manipulation.label import FONT, Label, label_cache, render_label
 
 default_size = 24
 default_border = 30
 default_orientation = "top-left-horizontal"
 
 DIM_W = "w"
+# Output formats that Pillow can write transparency to. Images with an alpha band are flattened for any other format.
+ALPHA_FORMATS = ("PNG", "WEBP", "TIFF", "GIF")
+# Output formats that can be CMYK. CMYK images written to any other format are converted to RGB.
+CMYK_FORMATS = ("JPEG", "TIFF")
+# The colour space of each image mode, besides RGB. An ICC profile only fits images in its own colour space.
+COLOUR_SPACES = {"1": "L", "L": "L", "LA": "L", "I": "L", "I;16": "L", "CMYK": "CMYK"}
 
 
 class ImageAnnotate:
     """
     Holds all the input and puts the text on the image in the correct location and orientation as requested.
-    Also adds text to image metadata (EXIF). Runs Imagemagick to do the image manipulation.
+    Also adds text to image metadata (EXIF, IPTC and XMP). Runs Imagemagick to do the image manipulation, or with the
+    Pillow engine, does it in-process.
     """
 
     def __init__(self, args: argparse.Namespace) -> None:
@@ -25,6 +42,7 @@ class ImageAnnotate:
         self.size = args.text_size
         self.border = args.border
         self.verbose = args.verbose
+        self.engine = args.engine
         self.horizontal = self.vertical = self.rotate_cmd = self.orientation = ""
         self.set_orientation(args.orientation)
 
@@ -49,19 +67,47 @@ class ImageAnnotate:
         else:
             return h
 
-    def edge_distance(self, label: bytes, dim: str) -> int:
+    def edge_distance(self, label: bytes | Label, dim: str) -> int:
         """
         Returns distance from the edge given edge (dim) for the image.
         :param label: Image blob of the text to put on the image, as a bytes blob. This would come from Imagemagick.
+            Or a `Label`, whose size is already known.
         :param dim: 'h' or 'w' to get distance from top/bottom ('h') or left/right ('w').
         :return: Distance in pixels.
         """
-        label_dim = self.image_dimension(dim, stdin=label)
+        if isinstance(label, Label):
+            label_dim = label.width if dim == DIM_W else label.height
+        else:
+            label_dim = self.image_dimension(dim, stdin=label)
         input_dim = self.image_dimension(dim, file=str(self.input_file))
+        return self.room(input_dim, label_dim)
+
+    def room(self, input_dim: int, label_dim: int) -> int:
+        """Returns the space left over when the label is put on the image, warning if there isn't any."""
         if input_dim < label_dim:
             print(f"WARN: {self.input_file} is too small for the text", file=sys.stderr)
         return input_dim - label_dim
 
+    def label_position(self, edge_distance: Callable[[str], int]) -> tuple[int, int]:
+        """
+        Work out where the label goes on the image.
+        :param edge_distance: Returns the distance from the edge for 'h' or 'w', as `edge_distance` does. Only called
+            when it's needed.
+        :return: x and y offset of the top left of the label.
+        """
+        y = self.border
+        if self.vertical in ("bottom", "b"):
+            y = edge_distance("h") - self.border
+        elif self.vertical in ("middle", "m"):
+            y = edge_distance("h") // 2
+
+        x = self.border
+        if self.horizontal in ("right", "r"):
+            x = edge_distance(DIM_W) - self.border
+        elif self.horizontal in ("middle", "m"):
+            x = edge_distance(DIM_W) // 2
+        return x, y
+
     def labelimg(self) -> bytes:
         """
         Produces the text label as an image blob.
@@ -69,7 +115,7 @@ class ImageAnnotate:
         """
         args = (
             f"convert -density 100 -pointsize {str(self.size)}".split()
-            + "-background #00000099 -fill white -gravity center -font Liberation-Serif".split()
+            + f"-background #00000099 -fill white -gravity center -font {FONT}".split()
             + [f"label: {self.text}"]
             + f"-strokewidth 8 {self.rotate_cmd} miff:-".split()
         )
@@ -77,28 +123,30 @@ class ImageAnnotate:
             print(args)
         return subprocess.run(args, capture_output=True, check=True).stdout
 
-    def composite_cmd(self, label: bytes) -> list[str]:
+    def label(self) -> Label:
         """
-        Build the command to "composite" the text onto the base image in the correct place.
-        :param label: Image bytes blob of the text to put on the image.
-        :return: The Imagemagick command.
+        Produces the text label with the current engine, from the label cache if the same label has been made before.
+        :return: The label. With ImageMagick, its blob is what `labelimg` produced.
         """
-        geometry_h = f"+{self.border}"
-        if self.vertical in ("bottom", "b"):
-            geometry_h = f'+{self.edge_distance(label, "h") - self.border}'
-        elif self.vertical in ("middle", "m"):
-            geometry_h = f'+{self.edge_distance(label, "h") // 2}'
+        rotate = bool(self.rotate_cmd)
+        key = (self.engine, self.text, self.size, FONT, rotate)
+        if self.engine == utils.ENGINE_PILLOW:
+            return label_cache().get(key, lambda: Label.from_image(render_label(self.text, self.size, rotate=rotate)))
 
-        geometry_w = f"+{self.border}"
-        if self.horizontal in ("right", "r"):
-            geometry_w = f"+{self.edge_distance(label, DIM_W) - self.border}"
-        elif self.horizontal in ("middle", "m"):
-            geometry_w = f"+{self.edge_distance(label, DIM_W) // 2}"
+        def render() -> Label:
+            blob = self.labelimg()
+            return Label(blob, *utils.image_dimensions(stdin=blob))
 
-        return (
-            f"composite -compose atop -geometry {geometry_w}{geometry_h} -".split()
-            + f"{self.input_file} {self.output_file}".split()
-        )
+        return label_cache().get(key, render)
+
+    def composite_cmd(self, label: bytes | Label) -> list[str]:
+        """
+        Build the command to "composite" the text onto the base image in the correct place.
+        :param label: Image bytes blob of the text to put on the image, or a `Label`.
+        :return: The Imagemagick command.
+        """
+        x, y = self.label_position(lambda dim: self.edge_distance(label, dim))
+        return f"composite -compose atop -geometry +{x}+{y} -".split() + f"{self.input_file} {self.output_file}".split()
 
     def exif_cmd(self) -> list[str]:
         """
@@ -113,24 +161,157 @@ class ImageAnnotate:
             self.output_file,
         ]
 
+    def composite_pillow(self) -> None:
+        """
+        Put the text on the image in-process: render the label with Pillow, and composite it where `composite_cmd`
+        would. The input is decoded once, and the output encoded and written once, metadata and all.
+        """
+        label = self.label().image()
+        image_format = Image.registered_extensions().get(os.path.splitext(self.output_file)[1].lower())
+        with Image.open(self.input_file) as img:
+            sizes = {DIM_W: (img.width, label.width), "h": (img.height, label.height)}
+            position = self.label_position(lambda dim: self.room(*sizes[dim]))
+            if self.verbose:
+                print("Label position:", position)
+            # Greyscale and CMYK images stay that way where the output format allows it; the rest become RGB.
+            # Palette transparency becomes an alpha band.
+            source = img.convert("RGBA") if img.mode == "P" and "transparency" in img.info else img
+            mode = {"L": "L", "LA": "L", "CMYK": "CMYK"}.get(source.mode, "RGB")
+            if mode == "CMYK" and image_format not in CMYK_FORMATS:
+                mode = "RGB"
+            # "atop": blend the label into the colour channels, leaving the image's own transparency as it was.
+            out = source.convert(mode)
+            out.paste(label.convert(mode), position, label)
+            if "A" in source.getbands():
+                if image_format in ALPHA_FORMATS:
+                    out.putalpha(source.getchannel("A"))
+                else:
+                    # The output can't be transparent: flatten onto white.
+                    flat = Image.new(mode, out.size, "white")
+                    flat.paste(out, mask=source.getchannel("A"))
+                    out = flat
+            options = utils.save_options(img)
+            if COLOUR_SPACES.get(img.mode, "RGB") != COLOUR_SPACES.get(mode, "RGB"):
+                # Pillow would also take it from `out.info`, which `convert` copied.
+                options.pop("icc_profile", None)
+                out.info.pop("icc_profile", None)
+        if image_format != "JPEG":
+            # Only EXIF can go in with Pillow; the rest is left to exiv2.
+            options["exif"] = metadata.exif_with_comment(options.get("exif"), self.text)
+            out.save(self.output_file, format=image_format, **options)
+            self.run_exiv2()
+            return
+        buffer = BytesIO()
+        out.save(buffer, format=image_format, **options)
+        with open(self.output_file, "wb") as f:
+            f.write(metadata.with_caption(buffer.getvalue(), self.text))
+
+    def write_metadata(self) -> None:
+        """
+        Put the text in the output file's metadata. JPEGs are done in-process, anything else needs exiv2.
+        """
+        with open(self.output_file, "rb") as f:
+            data = f.read()
+        if data[:2] != b"\xff\xd8":
+            self.run_exiv2()
+            return
+        with open(self.output_file, "wb") as f:
+            f.write(metadata.with_caption(data, self.text))
+
+    def run_exiv2(self) -> None:
+        if not shutil.which("exiv2"):
+            print(f"WARN: exiv2 is not installed, so not all metadata is set on {self.output_file}", file=sys.stderr)
+            return
+        if self.verbose:
+            print("EXIF Command:", " ".join(self.exif_cmd()))
+        subprocess.run(self.exif_cmd())
+
     def run(self) -> None:
         """Run commands to manipulate the image."""
-        label = self.labelimg()
+        if self.engine == utils.ENGINE_PILLOW:
+            self.composite_pillow()
+            return
+
+        label = self.label()
         composite_cmd = self.composite_cmd(label)
 
         if self.verbose:
             print("Composite Command:", " ".join(composite_cmd))
-            print("EXIF Command:", " ".join(self.exif_cmd()))
 
-        subprocess.run(composite_cmd, input=label, check=True)
-        subprocess.run(self.exif_cmd())
+        subprocess.run(composite_cmd, input=label.blob, check=True)
+        self.write_metadata()
+
+
+def read_manifest(path: str) -> List[Dict[str, Any]]:
+    """
+    Read a batch manifest. Each row describes one annotation, with the keys input, output and text, and optionally
+    size, border and orientation.
+    :param path: A CSV file with a header line if the name ends in '.csv', otherwise JSON Lines (one object per line).
+    :return: The rows.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            return list(csv.DictReader(f))
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def row_value(row: Dict[str, Any], key: str, default: Any) -> Any:
+    """A manifest row's `key`, or `default` if it's missing or an empty CSV cell. 0 is a value, not a default."""
+    value = row.get(key)
+    return default if value in (None, "") else value
+
+
+def row_args(row: Dict[str, Any], engine: str = utils.ENGINE_IMAGEMAGICK) -> argparse.Namespace:
+    """Turn a manifest row into the arguments `ImageAnnotate` expects, filling in the command-line defaults."""
+    for key in ("input", "output", "text"):
+        if not row.get(key):
+            raise ValueError(f"missing {key}")
+    return argparse.Namespace(
+        text=row["text"],
+        input_file=row["input"],
+        output_file=row["output"],
+        text_size=int(row_value(row, "size", default_size)),
+        border=int(row_value(row, "border", default_border)),
+        orientation=row_value(row, "orientation", default_orientation),
+        verbose=False,
+        engine=engine,
+    )
+
+
+def annotate_row(row: Dict[str, Any], engine: str = utils.ENGINE_IMAGEMAGICK) -> Dict[str, Any]:
+    """
+    Annotate the image described by one manifest row. Errors are reported in the result rather than raised, so one bad
+    row doesn't stop the batch.
+    :return: The result: the row's input and output, 'ok', and an 'error' message if it failed.
+    """
+    result: Dict[str, Any] = {"input": row.get("input"), "output": row.get("output"), "ok": True}
+    try:
+        ImageAnnotate(row_args(row, engine)).run()
+    except Exception as e:
+        result.update(ok=False, error=str(e))
+    return result
+
+
+def run_batch(
+    rows: List[Dict[str, Any]], jobs: int = 1, engine: str = utils.ENGINE_IMAGEMAGICK
+) -> Iterator[Dict[str, Any]]:
+    """
+    Annotate many images, `jobs` at a time in worker processes.
+    :return: The result for each row (see `annotate_row`), in the same order as `rows`, as soon as it's ready.
+    """
+    work = partial(annotate_row, engine=engine)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(work, rows)
+    else:
+        yield from map(work, rows)
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Annotate image with text using ImageMagick and set EXIF metadata.")
-    parser.add_argument("-t", "--text", required=True, help="Text to annotate image with")
-    parser.add_argument("-i", "--input-file", required=True, help="Input image file")
-    parser.add_argument("-o", "--output-file", required=True, help="Output image file")
+    parser.add_argument("-t", "--text", help="Text to annotate image with")
+    parser.add_argument("-i", "--input-file", help="Input image file")
+    parser.add_argument("-o", "--output-file", help="Output image file")
     parser.add_argument(
         "-s", "--text-size", type=int, default=default_size, help=f"Font size (default: {default_size})"
     )
@@ -144,9 +325,40 @@ def main() -> None:
         help=f"Orientation (default: {default_orientation}, see README for more options)",
     )
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=utils.ENGINES,
+        default=utils.ENGINE_IMAGEMAGICK,
+        help="Draw the text with ImageMagick's CLI, or in-process with Pillow (default: imagemagick)",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="MANIFEST",
+        help="Annotate every image listed in a JSON Lines or CSV manifest, instead of one image (see README)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of images to annotate in parallel with --batch (default: number of CPUs)",
+    )
 
     args = parser.parse_args()
 
+    if args.batch:
+        failed = 0
+        for row, result in enumerate(run_batch(read_manifest(args.batch), max(args.jobs, 1), args.engine), start=1):
+            print(json.dumps({"row": row, **result}), flush=True)
+            failed += not result["ok"]
+        if failed:
+            sys.exit(1)
+        return
+
+    missing = [option for option in ("text", "input_file", "output_file") if not getattr(args, option)]
+    if missing:
+        parser.error("the following arguments are required: " + ", ".join("--" + m.replace("_", "-") for m in missing))
     ImageAnnotate(args).run()
 
 
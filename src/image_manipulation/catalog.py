@@ -0,0 +1,149 @@
+"""
+On-disk catalog of image facts, shared by the ima-* tools so repeat runs over an unchanged library don't have to read
+every image again.
+
+The catalog is an SQLite database, keyed by absolute path. Each row remembers the file size and modification time it
+was filled in for; when either changes, everything known about the file is forgotten. Columns are filled lazily, by
+whichever tool first needs them.
+
+It is off unless the `IMA_CATALOG` environment variable names the database file, e.g.:
+
+    export IMA_CATALOG=~/.cache/ima-catalog.sqlite3
+"""
+
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+CATALOG_ENV = "IMA_CATALOG"
+
+# Facts that can be stored, with their SQL types.
+COLUMNS = {
+    "width": "INTEGER",
+    "height": "INTEGER",
+    "orientation": "INTEGER",
+    "taken": "TEXT",  # EXIF capture time, 'YYYY:MM:DD HH:MM:SS', or '' if the image doesn't have one
+    "dhash": "TEXT",  # difference hash, for finding duplicates, as 16 hex digits (too big for an SQLite INTEGER)
+}
+
+
+class Catalog:
+    """
+    One catalog database. Safe to share between threads; each process should open its own (see `default_catalog`).
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+            known = {row["name"] for row in self.db.execute("PRAGMA table_info(images)")}
+            for column, sql_type in COLUMNS.items():
+                if column not in known:
+                    self.db.execute(f"ALTER TABLE images ADD COLUMN {column} {sql_type}")
+
+    def get(self, file: str, st: Optional[os.stat_result] = None) -> Optional[Dict[str, Any]]:
+        """
+        Everything known about the current version of `file`.
+        :param file: Image file.
+        :param st: The file's `os.stat()` result, if the caller already has it.
+        :return: Column values, None for those not filled in yet. None if the file is unknown, changed or missing.
+        """
+        key = _key(file, st)
+        if key is None:
+            return None
+        path, size, mtime_ns = key
+        with self.lock:
+            row = self.db.execute("SELECT * FROM images WHERE path = ?", (path,)).fetchone()
+        if row is None or row["size"] != size or row["mtime_ns"] != mtime_ns:
+            return None
+        return {column: row[column] for column in COLUMNS}
+
+    def update(self, file: str, st: Optional[os.stat_result] = None, **values: Any) -> None:
+        """
+        Record facts about the current version of `file`, forgetting anything recorded for an older version.
+        :param file: Image file. Nothing is recorded if it doesn't exist.
+        :param st: The file's `os.stat()` result, if the caller already has it.
+        :param values: Column values to store.
+        """
+        unknown = set(values) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown catalog columns: {', '.join(sorted(unknown))}")
+        key = _key(file, st)
+        if key is None:
+            return
+        path, size, mtime_ns = key
+        columns = ", ".join(values)
+        placeholders = ", ".join("?" * len(values))
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        with self.lock, self.db:
+            updated = self.db.execute(
+                f"UPDATE images SET {assignments} WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (*values.values(), path, size, mtime_ns),
+            )
+            if updated.rowcount == 0:
+                self.db.execute(
+                    f"INSERT OR REPLACE INTO images (path, size, mtime_ns, {columns}) VALUES (?, ?, ?, {placeholders})",
+                    (path, size, mtime_ns, *values.values()),
+                )
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+def _key(file: str, st: Optional[os.stat_result]) -> Optional[Tuple[str, int, int]]:
+    try:
+        st = st or os.stat(file)
+    except OSError:
+        return None
+    return os.path.abspath(file), st.st_size, st.st_mtime_ns
+
+
+_catalogs: Dict[Tuple[int, str], Catalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def default_catalog() -> Optional[Catalog]:
+    """The catalog named by $IMA_CATALOG, opened once per process. None if the catalog is turned off."""
+    path = os.environ.get(CATALOG_ENV)
+    if not path:
+        return None
+    key = (os.getpid(), os.path.expanduser(path))
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = Catalog(key[1])
+        return _catalogs[key]
+
+
+def cached(
+    file: str,
+    columns: Sequence[str],
+    compute: Callable[[], Optional[Sequence[Any]]],
+    st: Optional[os.stat_result] = None,
+) -> Optional[Tuple[Any, ...]]:
+    """
+    Look facts about `file` up in the default catalog, working them out and storing them if they aren't there yet.
+    With the catalog turned off, this just calls `compute`.
+    :param file: Image file.
+    :param columns: Catalog columns wanted.
+    :param compute: Returns the values of `columns`, in order, or None if they can't be worked out.
+    :param st: The file's `os.stat()` result, if the caller already has it.
+    :return: The values of `columns`, or None.
+    """
+    catalog = default_catalog()
+    if catalog:
+        row = catalog.get(file, st)
+        if row and all(row[column] is not None for column in columns):
+            return tuple(row[column] for column in columns)
+    values = compute()
+    if values is None:
+        return None
+    if catalog:
+        catalog.update(file, st, **dict(zip(columns, values)))
+    return tuple(values)
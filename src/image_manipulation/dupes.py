@@ -0,0 +1,127 @@
+"""
+Find duplicate images, such as the same photo saved again by a messaging app, or an edited copy, so the ima-* tools
+can leave out all but one of each.
+
+Each image gets a 64-bit difference hash (dHash): the image is decoded at a small scale (JPEGs at 1/8 size, in draft
+mode), turned upright, shrunk to 9x8 grey pixels, and each bit says whether a pixel is brighter than the one to its
+right. Re-saving, resizing and small edits change only a few bits, so images whose hashes differ in at most
+`MAX_DISTANCE` bits are taken to be the same picture. Hashes are kept in the catalog, if it's turned on.
+
+Comparing every hash with every other one is done with NumPy if it's installed, and in pure Python (much more slowly,
+for big sets) if it isn't.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from PIL import Image, ImageOps
+
+from image_manipulation import catalog
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+
+DUPLICATES_SKIP = "skip"
+DUPLICATES_GROUP = "group"
+# What the tools can do with duplicates: leave them out, or leave them out but list them with the one that's kept.
+DUPLICATE_MODES = (DUPLICATES_SKIP, DUPLICATES_GROUP)
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+MAX_DISTANCE = 4
+
+
+def dhash(path: str) -> int:
+    """
+    The difference hash of an image file. Pillow's decompression bomb check stays on: these may be anyone's images.
+    """
+    with Image.open(path) as img:
+        img.draft("L", (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+        small = ImageOps.exif_transpose(img).convert("L").resize((HASH_WIDTH, HASH_HEIGHT), Image.Resampling.BOX)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for col in range(HASH_WIDTH - 1):
+            i = row * HASH_WIDTH + col
+            value = value << 1 | (pixels[i] > pixels[i + 1])
+    return value
+
+
+def image_hash(path: str) -> Optional[int]:
+    """
+    The difference hash of an image, from the catalog if it's there. None if the image can't be read, or is too big
+    to be opened safely, so it's never taken for a duplicate.
+    """
+    try:
+        values = catalog.cached(path, ("dhash",), lambda: (f"{dhash(path):016x}",))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return int(values[0], 16) if values else None
+
+
+def near_pairs(hashes: Sequence[int], max_distance: int = MAX_DISTANCE) -> Iterator[Tuple[int, int]]:
+    """The indexes (i, j), i < j, of the hashes that differ in at most `max_distance` bits."""
+    if np is not None and hashes:
+        values = np.array(hashes, dtype=np.uint64)
+        for i in range(len(values) - 1):
+            xor = values[i + 1 :] ^ values[i]
+            if hasattr(np, "bitwise_count"):
+                distances = np.bitwise_count(xor)
+            else:
+                distances = np.unpackbits(xor.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+            for j in np.nonzero(distances <= max_distance)[0]:
+                yield i, i + 1 + int(j)
+        return
+    for i, a in enumerate(hashes):
+        for j in range(i + 1, len(hashes)):
+            if (a ^ hashes[j]).bit_count() <= max_distance:
+                yield i, j
+
+
+def keeper_order(path: str) -> Tuple[int, str]:
+    """Sort key putting the copy to keep first: the biggest file, which has lost the least to re-saving."""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    return -size, path
+
+
+def find_duplicates(
+    paths: Sequence[str], max_distance: int = MAX_DISTANCE, jobs: int = os.cpu_count() or 1
+) -> List[List[str]]:
+    """
+    Group the images that are the same picture. Images that look alike through a chain of others end up in one group.
+    :param paths: Image files. Those that can't be read are left out.
+    :param jobs: Number of images to hash at once, in threads.
+    :return: The groups of more than one image, each with the one to keep first.
+    """
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        hashes = list(executor.map(image_hash, paths))
+    known = [(path, value) for path, value in zip(paths, hashes) if value is not None]
+    parent = list(range(len(known)))
+
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in near_pairs([value for _path, value in known], max_distance):
+        parent[root(i)] = root(j)
+    groups: Dict[int, List[str]] = {}
+    for i, (path, _value) in enumerate(known):
+        groups.setdefault(root(i), []).append(path)
+    return sorted(sorted(group, key=keeper_order) for group in groups.values() if len(group) > 1)
+
+
+def split_duplicates(paths: Sequence[str], jobs: int = os.cpu_count() or 1) -> Tuple[List[str], Dict[str, List[str]]]:
+    """
+    Separate the images to work on from their duplicates.
+    :return: `paths` without the duplicates, in the same order, and the duplicates left out, by the image kept instead.
+    """
+    groups = find_duplicates(paths, jobs=jobs)
+    copies = {copy for group in groups for copy in group[1:]}
+    return [path for path in paths if path not in copies], {group[0]: group[1:] for group in groups}
@@ -0,0 +1,158 @@
+"""
+Render annotation labels with Pillow, the same way `convert label:` does for `ImageAnnotate.labelimg`: white text on a
+semi-transparent black box, optionally turned on its side.
+
+Also keeps rendered labels, from either engine, in an LRU cache, since a batch often puts the same caption on many
+images. The cache can be kept on disk between runs by naming a directory in the `IMA_LABEL_CACHE` environment variable.
+"""
+
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, NamedTuple, Optional
+
+from PIL import Image, ImageDraw, ImageFont
+
+BACKGROUND = (0, 0, 0, 0x99)  # #00000099
+FOREGROUND = "white"
+# ImageMagick is run with -density 100, so a point is 100/72 pixels.
+DENSITY = 100
+FONT = "Liberation-Serif"
+FONT_FILES = ("LiberationSerif-Regular.ttf", "LiberationSerif.ttf", "Liberation Serif")
+LABEL_CACHE_ENV = "IMA_LABEL_CACHE"
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class Label(NamedTuple):
+    """A rendered label, with its size so it never has to be measured again."""
+
+    blob: bytes  # MIFF from ImageMagick, or raw RGBA pixels from Pillow
+    width: int
+    height: int
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> "Label":
+        return cls(image.convert("RGBA").tobytes(), image.width, image.height)
+
+    def image(self) -> Image.Image:
+        """The label as an RGBA image. Only for labels rendered by Pillow."""
+        return Image.frombytes("RGBA", (self.width, self.height), self.blob)
+
+
+def pixel_size(pointsize: int) -> int:
+    return round(pointsize * DENSITY / 72)
+
+
+def load_font(pointsize: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
+    """Liberation Serif at the given point size, or Pillow's default font if Liberation isn't installed."""
+    size = pixel_size(pointsize)
+    for name in FONT_FILES:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+def render_label(text: str, pointsize: int, rotate: bool = False) -> Image.Image:
+    """
+    Produce the text label as an RGBA image, sized to fit the text like `label:` does.
+    :param text: Text for the label. As with `label: {text}`, it gets a leading space.
+    :param pointsize: Font size in points.
+    :param rotate: Turn the label 90 degrees clockwise, for vertical labels.
+    :return: The label.
+    """
+    text = f" {text}"
+    font = load_font(pointsize)
+    ascent, descent = font.getmetrics() if isinstance(font, ImageFont.FreeTypeFont) else (font.getbbox(text)[3], 0)
+    width = max(int(font.getlength(text) + 0.5), 1)
+    label = Image.new("RGBA", (width, ascent + descent), BACKGROUND)
+    ImageDraw.Draw(label).text((0, 0), text, font=font, fill=FOREGROUND)
+    if rotate:
+        label = label.transpose(Image.Transpose.ROTATE_270)
+    return label
+
+
+class LabelCache:
+    """
+    Least-recently-used cache of rendered labels, bounded by the total size of the label blobs. Safe to share between
+    threads. With a directory, labels are also saved there, and found there by later runs and other processes.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES, directory: Optional[str] = None) -> None:
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.labels: OrderedDict[Hashable, Label] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: Hashable, render: Callable[[], Label]) -> Label:
+        """
+        Return the label for `key`, rendering it if it isn't cached.
+        :param key: Everything that affects how the label looks, e.g. (engine, text, size, font, rotate).
+        :param render: Renders the label.
+        """
+        with self.lock:
+            label = self.labels.get(key)
+            if label:
+                self.labels.move_to_end(key)
+                return label
+        label = self.load(key)
+        if label is None:
+            label = render()
+            self.save(key, label)
+        self.add(key, label)
+        return label
+
+    def add(self, key: Hashable, label: Label) -> None:
+        with self.lock:
+            if key in self.labels or len(label.blob) > self.max_bytes:
+                return
+            self.labels[key] = label
+            self.size += len(label.blob)
+            while self.size > self.max_bytes:
+                _key, evicted = self.labels.popitem(last=False)
+                self.size -= len(evicted.blob)
+
+    def path(self, key: Hashable) -> Optional[str]:
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + ".label")
+
+    def load(self, key: Hashable) -> Optional[Label]:
+        path = self.path(key)
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        width, height = struct.unpack(">II", data[:8])
+        return Label(data[8:], width, height)
+
+    def save(self, key: Hashable, label: Label) -> None:
+        path = self.path(key)
+        if not path:
+            return
+        # Write to a temporary file first, so other processes never see half a label.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(struct.pack(">II", label.width, label.height) + label.blob)
+        os.replace(tmp_path, path)
+
+
+_label_cache: Optional[LabelCache] = None
+
+
+def label_cache() -> LabelCache:
+    """The label cache for this process, saved in $IMA_LABEL_CACHE if that's set."""
+    global _label_cache
+    if _label_cache is None:
+        _label_cache = LabelCache(directory=os.environ.get(LABEL_CACHE_ENV) or None)
+    return _label_cache
@@ -0,0 +1,184 @@
+"""
+Record of which version of each source image a gallery's thumbnails were made from, so `ima-showth` only remakes the
+thumbnails of images that have changed, and can tidy away those of images that are gone.
+
+The manifest is a small JSON file in the thumbnail directory, keyed by source file name:
+
+    {"version": 1, "images": {"a.jpg": {"thumbnail": "th/a.th.jpg", "size": 123, "mtime_ns": 1700000000000000000,
+                                        "params": {"width": 160, "height": 120}}}}
+
+An image counts as changed when its size or modification time differs from the manifest, or, when content hashes are
+turned on, when its SHA-256 does. Thumbnails made with different parameters (e.g. size) are also out of date.
+
+The manifest also keeps a digest of everything each HTML page was rendered from, under "pages", so pages whose
+content hasn't changed aren't rendered or written again, and a "signature" of the whole gallery directory, so a
+recursive build can skip directories that haven't changed at all.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+MANIFEST_FILE = "manifest.json"
+VERSION = 1
+HASH_CHUNK = 1024 * 1024
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's content, as hex."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    The manifest of one thumbnail directory. Changes are kept in memory until `save`.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        use_hash: bool = False,
+        params: Optional[Dict[str, Any]] = None,
+        root: str = "",
+        adopt_params: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        :param directory: The thumbnail directory the manifest lives in, relative to `root`.
+        :param use_hash: Compare content hashes rather than sizes and modification times.
+        :param params: Everything else the thumbnails depend on; thumbnails made with other parameters are out of date.
+        :param root: The gallery directory. Image and thumbnail names are relative to it.
+        :param adopt_params: The parameters thumbnails made before there was a manifest were made with. Those are only
+            taken on trust (see `is_current`) when `params` are the same. None: never.
+        """
+        self.directory = directory
+        self.root = root
+        self.path = os.path.join(root, directory, MANIFEST_FILE)
+        self.use_hash = use_hash
+        self.params = params or {}
+        self.adopt = adopt_params is not None and adopt_params == self.params
+        self.images: Dict[str, Dict[str, Any]] = {}
+        self.pages: Dict[str, str] = {}
+        self.signature: Optional[str] = None
+        self.changed = False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("version") == VERSION and isinstance(data.get("images"), dict):
+            self.images = data["images"]
+            # Share one params dict between the entries made with the current parameters, rather than keeping the
+            # copy json.load made for each of them: for a huge gallery that's about half the manifest's memory.
+            for entry in self.images.values():
+                if isinstance(entry, dict) and entry.get("params") == self.params:
+                    entry["params"] = self.params
+            self.pages = data.get("pages") or {}
+            self.signature = data.get("signature")
+
+    def fingerprint(self, name: str, st: Optional[os.stat_result] = None) -> Dict[str, Any]:
+        """What's recorded about the current version of source image `name`."""
+        st = st or os.stat(os.path.join(self.root, name))
+        entry: Dict[str, Any] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "params": self.params}
+        if self.use_hash:
+            entry["sha256"] = file_digest(os.path.join(self.root, name))
+        return entry
+
+    def is_current(self, name: str, thumbnail: str) -> bool:
+        """
+        Whether `thumbnail` exists and was made from the current version of `name`, with the current parameters.
+
+        A thumbnail the manifest doesn't know about, e.g. from before there was a manifest, is taken on trust if it's
+        newer than its source and the parameters are `adopt_params`, and recorded.
+        """
+        try:
+            st = os.stat(os.path.join(self.root, name))
+            thumb_mtime_ns = os.stat(os.path.join(self.root, thumbnail)).st_mtime_ns
+        except OSError:
+            return False
+        entry = self.images.get(name)
+        if entry is None or entry.get("thumbnail") != thumbnail:
+            if not self.adopt or thumb_mtime_ns < st.st_mtime_ns:
+                return False
+            self.record(name, thumbnail, st)
+            return True
+        if entry.get("params") != self.params:
+            return False
+        unchanged = (entry.get("size"), entry.get("mtime_ns")) == (st.st_size, st.st_mtime_ns)
+        if self.use_hash and "sha256" in entry:
+            if entry["sha256"] != file_digest(os.path.join(self.root, name)):
+                return False
+            if not unchanged:
+                self.record(name, thumbnail, st)  # touched or copied, but the same picture
+            return True
+        if unchanged and self.use_hash:
+            self.record(name, thumbnail, st)  # hashes just turned on
+        return unchanged
+
+    def record(self, name: str, thumbnail: str, st: Optional[os.stat_result] = None) -> None:
+        """Note that `thumbnail` has just been made from the current version of `name`."""
+        try:
+            self.images[name] = {"thumbnail": thumbnail, **self.fingerprint(name, st)}
+        except OSError:
+            return
+        self.changed = True
+
+    def record_page(self, page: str, digest: Optional[str]) -> None:
+        """Note the digest of what `page` was just rendered from, or with None, that the page is gone."""
+        if self.pages.get(page) == digest:
+            return
+        if digest is None:
+            del self.pages[page]
+        else:
+            self.pages[page] = digest
+        self.changed = True
+
+    def set_signature(self, signature: Optional[str]) -> None:
+        """Note the signature of the gallery directory as it was just built, or with None, that it needs building."""
+        if self.signature != signature:
+            self.signature = signature
+            self.changed = True
+
+    def prune(self, current: Dict[str, List[str]], suffix: Union[str, Tuple[str, ...]] = ".th.jpg") -> List[str]:
+        """
+        Forget the images that are gone, and delete the thumbnails in the directory that no current image uses.
+        :param current: Thumbnail paths of each current source image.
+        :param suffix: Only files with this ending, or one of these endings, count as thumbnails.
+        :return: The deleted thumbnails, including `root`.
+        """
+        for name in list(self.images):
+            if name not in current:
+                del self.images[name]
+                self.changed = True
+        in_use = {thumbnail for thumbnails in current.values() for thumbnail in thumbnails}
+        removed: List[str] = []
+        thumb_dir = os.path.join(self.root, self.directory)
+        if not os.path.isdir(thumb_dir):
+            return removed
+        for entry in os.scandir(thumb_dir):
+            if (
+                entry.is_file()
+                and entry.name.endswith(suffix)
+                and os.path.join(self.directory, entry.name) not in in_use
+            ):
+                os.remove(entry.path)
+                removed.append(entry.path)
+        return sorted(removed)
+
+    def save(self) -> None:
+        """Write the manifest out, if anything changed. Written to a temporary file first, so it's never half there."""
+        if not self.changed:
+            return
+        thumb_dir = os.path.join(self.root, self.directory)
+        os.makedirs(thumb_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=thumb_dir, suffix=".tmp")
+        data = {"version": VERSION, "images": self.images, "pages": self.pages, "signature": self.signature}
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.changed = False
@@ -0,0 +1,223 @@
+"""
+Write an image caption into JPEG metadata in-process, as `ImageAnnotate.exif_cmd` does with exiv2:
+
+    • Exif.Photo.UserComment (EXIF, APP1)
+    • Xmp.dc.description (XMP, APP1)
+    • Iptc.Application2.Caption (IPTC, inside the Photoshop APP13 segment)
+
+Only the metadata segments are rewritten; the compressed image data is copied as it is. Other EXIF tags, XMP
+properties, IPTC datasets and Photoshop resources already in the file are kept.
+"""
+
+import struct
+import sys
+import xml.etree.ElementTree as ET
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import piexif
+import piexif.helper
+
+from image_manipulation.probe import APP1, EXIF_HEADER, SOI, SOS, STANDALONE_MARKERS
+
+APP0 = 0xE0
+APP13 = 0xED
+XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+PHOTOSHOP_HEADER = b"Photoshop 3.0\x00"
+IPTC_RESOURCE = 0x0404
+IPTC_TAG = 0x1C
+IPTC_CAPTION = (2, 120)
+IPTC_CHARSET = (1, 90)
+UTF8_CHARSET = b"\x1b%G"
+MAX_PAYLOAD = 0xFFFF - 2
+
+NS = {
+    "x": "adobe:ns:meta/",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "xml": "http://www.w3.org/XML/1998/namespace",
+}
+
+for _prefix, _uri in NS.items():
+    if _prefix != "xml":
+        ET.register_namespace(_prefix, _uri)
+
+Segment = Tuple[int, bytes]
+
+
+def with_caption(jpeg: bytes, text: str) -> bytes:
+    """
+    Return a copy of a JPEG file with `text` set as its EXIF user comment, XMP description and IPTC caption.
+    :param jpeg: The whole JPEG file.
+    :param text: The caption.
+    :return: The new JPEG file.
+    """
+    segments, scan = split_segments(jpeg)
+    exif = xmp = photoshop = None
+    jfif: List[Segment] = []
+    rest: List[Segment] = []
+    for marker, payload in segments:
+        if marker == APP0 and not rest and payload.startswith(b"JFIF"):
+            jfif.append((marker, payload))
+        elif marker == APP1 and payload.startswith(EXIF_HEADER) and exif is None:
+            exif = payload
+        elif marker == APP1 and payload.startswith(XMP_HEADER) and xmp is None:
+            xmp = payload[len(XMP_HEADER) :]
+        elif marker == APP13 and payload.startswith(PHOTOSHOP_HEADER) and photoshop is None:
+            photoshop = payload[len(PHOTOSHOP_HEADER) :]
+        else:
+            rest.append((marker, payload))
+    metadata = [
+        (APP1, exif_with_comment(exif, text)),
+        (APP1, XMP_HEADER + xmp_with_description(xmp, text)),
+        (APP13, PHOTOSHOP_HEADER + photoshop_with_caption(photoshop, text)),
+    ]
+    return join_segments(jfif + metadata + rest, scan)
+
+
+def split_segments(jpeg: bytes) -> Tuple[List[Segment], bytes]:
+    """
+    Split a JPEG file into its header segments and the rest.
+    :return: (marker, payload) for each segment before the first scan, and the data from the SOS marker to the end.
+    """
+    if jpeg[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG file")
+    segments: List[Segment] = []
+    pos = 2
+    while True:
+        if jpeg[pos] != 0xFF:
+            raise ValueError(f"bad JPEG marker at byte {pos}")
+        while jpeg[pos] == 0xFF:
+            pos += 1
+        marker = jpeg[pos]
+        pos += 1
+        if marker == SOS:
+            return segments, b"\xff\xda" + jpeg[pos:]
+        if marker in STANDALONE_MARKERS:
+            segments.append((marker, b""))
+            continue
+        (length,) = struct.unpack(">H", jpeg[pos : pos + 2])
+        segments.append((marker, jpeg[pos + 2 : pos + length]))
+        pos += length
+
+
+def join_segments(segments: List[Segment], scan: bytes) -> bytes:
+    """Put a JPEG file back together from what `split_segments` returned."""
+    out = BytesIO()
+    out.write(bytes((0xFF, SOI)))
+    for marker, payload in segments:
+        out.write(bytes((0xFF, marker)))
+        if marker not in STANDALONE_MARKERS:
+            if len(payload) > MAX_PAYLOAD:
+                raise ValueError(f"JPEG segment {marker:#x} is too large")
+            out.write(struct.pack(">H", len(payload) + 2))
+            out.write(payload)
+    out.write(scan)
+    return out.getvalue()
+
+
+def exif_with_comment(exif: Optional[bytes], text: str) -> bytes:
+    """
+    EXIF data with the user comment set. EXIF that piexif can't write back, e.g. a phone's SceneType stored as a number,
+    is kept as it is, without the comment: the caption still goes in the XMP and IPTC.
+    :param exif: Existing EXIF data, starting with 'Exif\\0\\0', if any.
+    :param text: The comment.
+    :return: The new EXIF data, starting with 'Exif\\0\\0'.
+    """
+    comment = piexif.helper.UserComment.dump(text, encoding="ascii" if text.isascii() else "unicode")
+    if not exif:
+        return piexif.dump({"0th": {}, "Exif": {piexif.ExifIFD.UserComment: comment}})
+    try:
+        exif_dict = piexif.load(exif)
+        exif_dict["Exif"][piexif.ExifIFD.UserComment] = comment
+        return piexif.dump(exif_dict)
+    except Exception as e:
+        print(f"WARN: existing EXIF data can't be rewritten, so it's kept without the comment: {e}", file=sys.stderr)
+        return exif
+
+
+def xmp_with_description(xmp: Optional[bytes], text: str) -> bytes:
+    """
+    An XMP packet with dc:description set, in the default language.
+    :param xmp: Existing XMP packet, if any.
+    :param text: The description.
+    :return: The new XMP packet.
+    """
+    root = _parse_xmp(xmp) if xmp else None
+    if root is None:
+        root = ET.Element(f"{{{NS['x']}}}xmpmeta")
+        ET.SubElement(
+            ET.SubElement(root, f"{{{NS['rdf']}}}RDF"), f"{{{NS['rdf']}}}Description", {f"{{{NS['rdf']}}}about": ""}
+        )
+    rdf = root if root.tag == f"{{{NS['rdf']}}}RDF" else root.find("rdf:RDF", NS)
+    if rdf is None:
+        rdf = ET.SubElement(root, f"{{{NS['rdf']}}}RDF")
+    description = rdf.find("rdf:Description", NS)
+    if description is None:
+        description = ET.SubElement(rdf, f"{{{NS['rdf']}}}Description", {f"{{{NS['rdf']}}}about": ""})
+    for parent in rdf.iterfind("rdf:Description", NS):
+        for old in parent.findall("dc:description", NS):
+            parent.remove(old)
+    alt = ET.SubElement(ET.SubElement(description, f"{{{NS['dc']}}}description"), f"{{{NS['rdf']}}}Alt")
+    ET.SubElement(alt, f"{{{NS['rdf']}}}li", {f"{{{NS['xml']}}}lang": "x-default"}).text = text
+    body = ET.tostring(root, encoding="unicode")
+    return f'<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>{body}<?xpacket end="w"?>'.encode()
+
+
+def _parse_xmp(xmp: bytes) -> Optional[ET.Element]:
+    """Parse an XMP packet, keeping its namespace prefixes. None if it isn't well-formed."""
+    try:
+        for _event, (prefix, uri) in ET.iterparse(BytesIO(xmp), events=("start-ns",)):
+            if prefix not in ("", "xml") and uri not in NS.values():
+                ET.register_namespace(prefix, uri)
+        return ET.fromstring(xmp)
+    except ET.ParseError:
+        return None
+
+
+def photoshop_with_caption(photoshop: Optional[bytes], text: str) -> bytes:
+    """
+    Photoshop image resources with the IPTC caption set.
+    :param photoshop: Existing resources, after the 'Photoshop 3.0\\0' header, if any.
+    :param text: The caption.
+    :return: The new resources, after the header.
+    """
+    resources = _parse_resources(photoshop or b"")
+    datasets = [d for d in _parse_iptc(resources.pop(IPTC_RESOURCE, b"")) if d[0] not in (IPTC_CAPTION, IPTC_CHARSET)]
+    datasets = [(IPTC_CHARSET, UTF8_CHARSET)] + datasets + [(IPTC_CAPTION, text.encode())]
+    resources[IPTC_RESOURCE] = b"".join(
+        struct.pack(">BBBH", IPTC_TAG, record, dataset, len(value)) + value for (record, dataset), value in datasets
+    )
+    out = BytesIO()
+    for resource_id, data in resources.items():
+        out.write(b"8BIM" + struct.pack(">H", resource_id) + b"\x00\x00" + struct.pack(">I", len(data)) + data)
+        if len(data) % 2:
+            out.write(b"\x00")
+    return out.getvalue()
+
+
+def _parse_resources(data: bytes) -> Dict[int, bytes]:
+    """Photoshop image resources by ID. Resource names are dropped; nothing uses them."""
+    resources = {}
+    pos = 0
+    while data[pos : pos + 4] == b"8BIM":
+        (resource_id,) = struct.unpack(">H", data[pos + 4 : pos + 6])
+        name_length = data[pos + 6]
+        pos += 6 + name_length + 1 + (name_length + 1) % 2
+        (size,) = struct.unpack(">I", data[pos : pos + 4])
+        resources[resource_id] = data[pos + 4 : pos + 4 + size]
+        pos += 4 + size + size % 2
+    return resources
+
+
+def _parse_iptc(data: bytes) -> List[Tuple[Tuple[int, int], bytes]]:
+    """IPTC datasets as ((record, dataset), value)."""
+    datasets = []
+    pos = 0
+    while pos + 5 <= len(data) and data[pos] == IPTC_TAG:
+        _tag, record, dataset, size = struct.unpack(">BBBH", data[pos : pos + 5])
+        if size & 0x8000:  # extended dataset; these don't turn up in practice
+            break
+        datasets.append(((record, dataset), data[pos + 5 : pos + 5 + size]))
+        pos += 5 + size
+    return datasets
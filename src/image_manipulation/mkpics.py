@@ -1,15 +1,54 @@
 import argparse
+import itertools
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List
 
 import piexif
 from PIL import Image
 
+from image_manipulation import annotate, catalog, dupes, probe, utils
+
 ANNOTATE_COMMAND = "ima-annotate"
+XML_SIDECAR = """<?xml version="1.0" encoding="UTF-8"?><image><description>
+      <field name="description"> </field>
+      <field name="title"> </field>
+      <field name="date"> {date} </field>
+   </description> <bins> </bins> <exif> </exif> </image>
+"""
 
 
 def cli_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--prefix", required=True)
     parser.add_argument("-x", "--xml", dest="xml", action="store_true")
+    parser.add_argument(
+        "--execute",
+        action="store_true",
+        help="Annotate the images now, instead of printing the commands to do it",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=utils.ENGINES,
+        default=utils.ENGINE_IMAGEMAGICK,
+        help="How --execute draws the text: ImageMagick's CLI, or in-process with Pillow (default: imagemagick)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of files to read dates from at the same time (default: 4 per CPU, up to 32), "
+        "or with --execute, to annotate at the same time (default: 1 per CPU)",
+    )
+    parser.add_argument(
+        "--duplicates",
+        choices=dupes.DUPLICATE_MODES,
+        help="Leave out all but the biggest of each set of duplicate images. With 'group', list each set as a comment "
+        "in the output",
+    )
     parser.add_argument("files", nargs="*")
     return parser.parse_args()
 
@@ -29,17 +68,62 @@ def annotation(file: str, prefix: str, xml: bool) -> str:
     -i {file} -o {newfile}
 """
     if xml:
-        out += f"""cat <<EOT > {newfile}.xml
-<?xml version="1.0" encoding="UTF-8"?><image><description>
-      <field name="description"> </field>
-      <field name="title"> </field>
-      <field name="date"> {date} </field>
-   </description> <bins> </bins> <exif> </exif> </image>
-EOT
-"""
+        out += f"cat <<EOT > {newfile}.xml\n{XML_SIDECAR.format(date=date)}EOT\n"
     return out
 
 
+def annotation_job(file: str, prefix: str) -> Dict[str, Any]:
+    """
+    Returns the annotation for this file as a row for `annotate.run_batch`, plus the date for the XML sidecar.
+    :param file:
+    :param prefix:
+    :return:
+    """
+    date, newfile = new_filename(file, prefix)
+    return {"input": file, "output": newfile, "text": f" {date} - ", "date": date}
+
+
+def try_annotation_job(file: str, prefix: str) -> Dict[str, Any]:
+    """
+    Like `annotation_job`, but a file whose date can't be read gives a failed result, as `annotate.annotate_row` does.
+    """
+    try:
+        return annotation_job(file, prefix)
+    except Exception as e:
+        return {"input": file, "ok": False, "error": str(e)}
+
+
+def execute(files: List[str], prefix: str, xml: bool, jobs: int, engine: str) -> int:
+    """
+    Annotate the files in this process, `jobs` at a time, reporting progress as it goes. Writes the XML sidecars too,
+    if asked, for the files annotated. Files whose date can't be read are reported as failed first, and the rest are
+    still annotated.
+    :return: Number of files that could not be annotated.
+    """
+    with ThreadPoolExecutor(max_workers=scan_jobs(jobs)) as executor:
+        prepared = list(executor.map(partial(try_annotation_job, prefix=prefix), files))
+    undated = [result for result in prepared if "error" in result]
+    rows = [row for row in prepared if "error" not in row]
+    dates = {row["output"]: row["date"] for row in rows}
+    failed = 0
+    results = itertools.chain(undated, annotate.run_batch(rows, jobs or os.cpu_count() or 1, engine))
+    for done, result in enumerate(results, start=1):
+        if result["ok"]:
+            if xml:
+                with open(f"{result['output']}.xml", "w", encoding="utf-8") as f:
+                    f.write(XML_SIDECAR.format(date=dates[result["output"]]))
+            print(f"[{done}/{len(files)}] {result['input']} -> {result['output']}", flush=True)
+        else:
+            failed += 1
+            print(f"[{done}/{len(files)}] {result['input']} FAILED: {result['error']}", file=sys.stderr, flush=True)
+    return failed
+
+
+def scan_jobs(jobs: int | None) -> int:
+    """Number of threads for reading dates. It's mostly waiting for the disk, so use more than there are CPUs."""
+    return jobs or min(32, (os.cpu_count() or 1) * 4)
+
+
 def new_filename(file: str, prefix: str) -> tuple[str, str]:
     """
     Returns new file name. Drops the year because I place files in a folder by year. Names the new file by month, day,
@@ -48,20 +132,15 @@ def new_filename(file: str, prefix: str) -> tuple[str, str]:
     :param prefix:
     :return:
     """
-    img = Image.open(file)
-    exif_info = img.info.get("exif")
-    if exif_info:
-        exif_data = piexif.load(exif_info)
-        datetime = exif_data["Exif"].get(piexif.ExifIFD.DateTimeOriginal)
-        if not datetime:
-            datetime = exif_data["0th"].get(piexif.ImageIFD.DateTime)
-        datetime = datetime.decode()
-    elif file.startswith("IMG-") and "-WA" in file:  # whatsapp image
-        d = file.split("-")
+    name = os.path.basename(file)
+    if name.startswith("IMG-") and "-WA" in name:  # whatsapp image, dated in its name
+        d = name.split("-")
         time = d[2][2:6]
         datetime = f"{d[1]} {time}"
     else:
-        datetime = ""
+        datetime = exif_datetime(file)
+    if not datetime:
+        raise ValueError("no date in the EXIF data")
     date, time = datetime.replace(":", "").split()
     short_date = date[4:]
     time = time[:4]
@@ -69,10 +148,65 @@ def new_filename(file: str, prefix: str) -> tuple[str, str]:
     return date, newfile
 
 
+def exif_datetime(file: str) -> str:
+    """
+    Returns the date the image was taken, from its EXIF data, as 'YYYY:MM:DD HH:MM:SS'. Falls back to the date it was
+    last modified if it has no original date. Uses the catalog if it's turned on.
+    :param file:
+    :return: The date, or '' if the image has no EXIF data.
+    """
+    taken = catalog.cached(file, ("taken",), lambda: (read_exif_datetime(file),))
+    return taken[0] if taken else ""
+
+
+def read_exif_datetime(file: str) -> str:
+    """
+    Reads the date from the EXIF data. For JPEGs only the APP1 segment at the start of the file is read; other formats
+    are opened with Pillow.
+    """
+    tiff = probe.read_exif(file)
+    if tiff is not None:
+        return probe.exif_datetime(tiff)
+    img = Image.open(file)
+    exif_info = img.info.get("exif")
+    img.close()
+    if not exif_info:
+        return ""
+    exif_data = piexif.load(exif_info)
+    datetime = exif_data["Exif"].get(piexif.ExifIFD.DateTimeOriginal)
+    if not datetime:
+        datetime = exif_data["0th"].get(piexif.ImageIFD.DateTime, b"")
+    return datetime.decode()
+
+
+def drop_duplicates(files: List[str], mode: str, jobs: int | None) -> List[str]:
+    """
+    Leave out the duplicate images, noting each on stderr. With DUPLICATES_GROUP, each set of duplicates is also
+    printed as a shell comment.
+    :return: The files to work on, in the same order.
+    """
+    kept, copies = dupes.split_duplicates(files, scan_jobs(jobs))
+    for file, others in copies.items():
+        for other in others:
+            print(f"Skipping {other}: duplicate of {file}", file=sys.stderr)
+        if mode == dupes.DUPLICATES_GROUP:
+            print(f"# {file} duplicates: {' '.join(others)}")
+    return kept
+
+
 def main() -> None:
     args = cli_args()
-    for file in args.files:
-        print(annotation(file, args.prefix, args.xml))
+    if args.jobs is not None and args.jobs < 1:
+        args.jobs = 1
+    if args.duplicates:
+        args.files = drop_duplicates(args.files, args.duplicates, args.jobs)
+    if args.execute:
+        if execute(args.files, args.prefix, args.xml, args.jobs, args.engine):
+            sys.exit(1)
+        return
+    with ThreadPoolExecutor(max_workers=scan_jobs(args.jobs)) as executor:
+        for out in executor.map(partial(annotation, prefix=args.prefix, xml=args.xml), args.files):
+            print(out)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+"""
+Read image facts straight out of file headers, without decoding the image or starting ImageMagick.
+
+Understands JPEG (SOFn markers, plus the EXIF orientation tag in APP1), PNG (IHDR), GIF and WebP (VP8, VP8L, VP8X).
+Anything else gets `None`, and callers fall back to something slower.
+
+Also reads the capture date and the embedded preview thumbnail from a JPEG's EXIF data, again without decoding the
+image.
+"""
+
+import struct
+from typing import BinaryIO, Dict, Iterator, NamedTuple, Optional, Tuple
+
+# JPEG markers
+SOI = 0xD8
+SOS = 0xDA
+EOI = 0xD9
+APP1 = 0xE1
+# SOF0..SOF15, apart from DHT (C4), JPG (C8) and DAC (CC), which share the range.
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers that have no length field.
+STANDALONE_MARKERS = frozenset(range(0xD0, 0xD8)) | {0x01, SOI, EOI}
+
+EXIF_HEADER = b"Exif\x00\x00"
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_THUMBNAIL_OFFSET = 0x0201  # JPEGInterchangeFormat, in IFD1
+TAG_THUMBNAIL_LENGTH = 0x0202  # JPEGInterchangeFormatLength
+# TIFF field types
+ASCII = 2
+SHORT = 3
+LONG = 4
+
+
+class Header(NamedTuple):
+    width: int
+    height: int
+    orientation: int = 1
+
+    def dimensions(self, oriented: bool = False) -> tuple[int, int]:
+        """
+        Width and height in pixels as stored. With `oriented`, as displayed, i.e. swapped if the EXIF orientation
+        turns the image on its side (orientations 5-8).
+        """
+        if oriented and self.orientation in (5, 6, 7, 8):
+            return self.height, self.width
+        return self.width, self.height
+
+
+def read_header(path: str) -> Optional[Header]:
+    """
+    Read the size and orientation of an image file from its header.
+    :param path: Image file.
+    :return: The header, or None if the format isn't recognised, the header is broken, or the file can't be read.
+    """
+    try:
+        with open(path, "rb") as f:
+            return read_header_from(f)
+    except (OSError, struct.error, ValueError):
+        return None
+
+
+def read_header_from(f: BinaryIO) -> Optional[Header]:
+    """Same as `read_header`, for an open binary file positioned at the start of the image."""
+    start = f.read(30)
+    if start[:2] == b"\xff\xd8":
+        f.seek(-len(start) + 2, 1)
+        return _jpeg_header(f)
+    if start[:8] == b"\x89PNG\r\n\x1a\n" and start[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", start[16:24])
+        return Header(width, height)
+    if start[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = struct.unpack("<HH", start[6:10])
+        return Header(width, height)
+    if start[:4] == b"RIFF" and start[8:12] == b"WEBP":
+        return _webp_header(start)
+    return None
+
+
+def _jpeg_header(f: BinaryIO) -> Optional[Header]:
+    """Walk the JPEG markers up to the first SOFn, picking up the EXIF orientation on the way."""
+    orientation = 1
+    for marker, size in _segments(f):
+        if marker in SOF_MARKERS:
+            _precision, height, width = struct.unpack(">BHH", _read_exactly(f, 5))
+            return Header(width, height, orientation)
+        if marker == APP1:
+            payload = _read_exactly(f, size)
+            if payload.startswith(EXIF_HEADER):
+                orientation = exif_orientation(payload[len(EXIF_HEADER) :])
+    return None
+
+
+def _segments(f: BinaryIO) -> Iterator[Tuple[int, int]]:
+    """
+    Yield the marker and payload size of each JPEG segment before the first scan, with `f` at the start of the
+    payload. The payload can be read or left alone.
+    """
+    while True:
+        marker = _next_marker(f)
+        if marker is None or marker in (SOS, EOI):
+            return
+        if marker in STANDALONE_MARKERS:
+            continue
+        (length,) = struct.unpack(">H", _read_exactly(f, 2))
+        start = f.tell()
+        yield marker, length - 2
+        f.seek(start + length - 2)
+
+
+def _next_marker(f: BinaryIO) -> Optional[int]:
+    """Return the next marker code, skipping any fill bytes. None at end of file."""
+    byte = f.read(1)
+    if byte != b"\xff":
+        return None
+    while byte == b"\xff":
+        byte = f.read(1)
+    return byte[0] if byte else None
+
+
+def _read_exactly(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated image header")
+    return data
+
+
+def _webp_header(start: bytes) -> Optional[Header]:
+    chunk = start[12:16]
+    if chunk == b"VP8 " and start[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack("<HH", start[26:30])
+        return Header(width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L" and start[20:21] == b"\x2f":
+        (bits,) = struct.unpack("<I", start[21:25])
+        return Header((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b"VP8X" and len(start) >= 30:
+        width = int.from_bytes(start[24:27], "little") + 1
+        height = int.from_bytes(start[27:30], "little") + 1
+        return Header(width, height)
+    return None
+
+
+def read_exif(path: str) -> Optional[bytes]:
+    """
+    Read the EXIF data from the APP1 segment at the start of a JPEG file, without reading the rest of it.
+    :param path: Image file.
+    :return: The EXIF (TIFF) data, after the 'Exif\\0\\0' header. b'' if the JPEG has no EXIF data. None if the file
+        isn't a JPEG or can't be read.
+    """
+    try:
+        with open(path, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return None
+            for marker, size in _segments(f):
+                if marker in SOF_MARKERS:
+                    break
+                if marker == APP1:
+                    payload = _read_exactly(f, size)
+                    if payload.startswith(EXIF_HEADER):
+                        return payload[len(EXIF_HEADER) :]
+            return b""
+    except (OSError, struct.error, ValueError):
+        return None
+
+
+def exif_datetime(tiff: bytes) -> str:
+    """
+    Return the date the image was taken, or if that's missing, when it was last changed, from EXIF data.
+    :param tiff: The EXIF data, after the 'Exif\\0\\0' header.
+    :return: The date as 'YYYY:MM:DD HH:MM:SS', or '' if neither date is there.
+    """
+    try:
+        endian = _tiff_endian(tiff)
+        (ifd_offset,) = struct.unpack(endian + "I", tiff[4:8])
+        ifd0 = _ifd(tiff, ifd_offset, endian)
+        if TAG_EXIF_IFD in ifd0:
+            exif_ifd = _ifd(tiff, _int_value(endian, ifd0[TAG_EXIF_IFD]), endian)
+            if TAG_DATETIME_ORIGINAL in exif_ifd:
+                return _str_value(tiff, endian, exif_ifd[TAG_DATETIME_ORIGINAL])
+        if TAG_DATETIME in ifd0:
+            return _str_value(tiff, endian, ifd0[TAG_DATETIME])
+    except (struct.error, ValueError):
+        pass
+    return ""
+
+
+def exif_orientation(tiff: bytes) -> int:
+    """
+    Return the orientation tag from IFD0 of an EXIF (TIFF) blob, or 1 if it isn't there.
+    :param tiff: The EXIF data, after the 'Exif\\0\\0' header.
+    """
+    try:
+        endian = _tiff_endian(tiff)
+        (ifd_offset,) = struct.unpack(endian + "I", tiff[4:8])
+        entry = _ifd(tiff, ifd_offset, endian).get(TAG_ORIENTATION)
+        value = _int_value(endian, entry) if entry else 1
+        return value if 1 <= value <= 8 else 1
+    except (struct.error, ValueError):
+        return 1
+
+
+def exif_thumbnail(tiff: bytes) -> Optional[bytes]:
+    """
+    Return the JPEG preview thumbnail that cameras store in IFD1 of the EXIF data.
+    :param tiff: The EXIF data, after the 'Exif\\0\\0' header.
+    :return: The thumbnail, a complete JPEG file, or None if there isn't one.
+    """
+    try:
+        endian = _tiff_endian(tiff)
+        (ifd0_offset,) = struct.unpack(endian + "I", tiff[4:8])
+        (count,) = struct.unpack(endian + "H", tiff[ifd0_offset : ifd0_offset + 2])
+        next_ifd = ifd0_offset + 2 + count * 12
+        (ifd1_offset,) = struct.unpack(endian + "I", tiff[next_ifd : next_ifd + 4])
+        if not ifd1_offset:
+            return None
+        ifd1 = _ifd(tiff, ifd1_offset, endian)
+        if TAG_THUMBNAIL_OFFSET not in ifd1 or TAG_THUMBNAIL_LENGTH not in ifd1:
+            return None
+        offset = _int_value(endian, ifd1[TAG_THUMBNAIL_OFFSET])
+        length = _int_value(endian, ifd1[TAG_THUMBNAIL_LENGTH])
+    except (struct.error, ValueError):
+        return None
+    thumbnail = tiff[offset : offset + length]
+    return thumbnail if len(thumbnail) == length and thumbnail[:2] == b"\xff\xd8" else None
+
+
+# An IFD entry: field type, count, and the 4-byte value (or offset of the value).
+Entry = Tuple[int, int, bytes]
+
+
+def _ifd(tiff: bytes, offset: int, endian: str) -> Dict[int, Entry]:
+    """The entries of the IFD at `offset`, by tag."""
+    (count,) = struct.unpack(endian + "H", tiff[offset : offset + 2])
+    entries = {}
+    for i in range(count):
+        start = offset + 2 + i * 12
+        tag, field_type, value_count = struct.unpack(endian + "HHI", tiff[start : start + 8])
+        entries[tag] = (field_type, value_count, tiff[start + 8 : start + 12])
+    return entries
+
+
+def _int_value(endian: str, entry: Entry) -> int:
+    """The (first) value of a SHORT or LONG entry."""
+    field_type, _count, value = entry
+    if field_type == SHORT:
+        return struct.unpack(endian + "H", value[:2])[0]
+    if field_type == LONG:
+        return struct.unpack(endian + "I", value)[0]
+    raise ValueError(f"TIFF field type {field_type} isn't an integer")
+
+
+def _str_value(tiff: bytes, endian: str, entry: Entry) -> str:
+    """The value of an ASCII entry."""
+    field_type, count, value = entry
+    if field_type != ASCII:
+        raise ValueError(f"TIFF field type {field_type} isn't ASCII")
+    if count > 4:
+        (offset,) = struct.unpack(endian + "I", value)
+        value = tiff[offset : offset + count]
+    return value[:count].split(b"\x00", 1)[0].decode("ascii", "replace").strip()
+
+
+def _tiff_endian(tiff: bytes) -> str:
+    if tiff[:4] == b"II*\x00":
+        return "<"
+    if tiff[:4] == b"MM\x00*":
+        return ">"
+    raise ValueError("not a TIFF header")
@@ -1,20 +1,29 @@
 import argparse
 import logging
 import subprocess
+import sys
 import tempfile
 import shutil
 import os
-from typing import Tuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Iterable, List, Optional, Tuple
 
-from image_manipulation import utils
+from PIL import Image
+
+from image_manipulation import dupes, utils
 
 logging.basicConfig(level=logging.INFO)
 
+BACKGROUND = "#dddddd"
+# Palette images are padded in the colour mode they stand for, so the background needn't be in their palette.
+PALETTE_MODES = {"P": "RGB", "PA": "RGBA"}
+
 
 def parse_args() -> argparse.Namespace:
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(
-        description="Pad images to a fixed aspect ratio using ImageMagick CLI (overwrites by default)."
+        description="Pad images to a fixed aspect ratio using ImageMagick CLI or Pillow (overwrites by default)."
     )
     parser.add_argument(
         "-b", "--border", type=int, default=0, help="Border size to apply before aspect ratio correction (default: 0)."
@@ -22,6 +31,20 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "-d", "--dry-run", action="store_true", help="Show what would be done without modifying any files."
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=utils.ENGINES,
+        default=utils.ENGINE_IMAGEMAGICK,
+        help="Pad with ImageMagick's CLI, or in-process with Pillow (default: imagemagick).",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of images to process in parallel (default: number of CPUs).",
+    )
     parser.add_argument("-q", "--quiet", action="store_true", help="Don't log what we're doing")
     parser.add_argument(
         "-r",
@@ -30,6 +53,12 @@ def parse_args() -> argparse.Namespace:
         default="4x6",
         help="Aspect ratio to use for resizing (default: 4x6). The script automatically adjusts the orientation.",
     )
+    parser.add_argument(
+        "--duplicates",
+        choices=dupes.DUPLICATE_MODES,
+        help="Only pad the biggest of each set of duplicate images, noting each one skipped ('skip') or each set "
+        "('group').",
+    )
     parser.add_argument("images", nargs="+", help="Image files to process")
     return parser.parse_args()
 
@@ -70,7 +99,20 @@ def fix_ratio(w: int, h: int, ratio_key: str) -> Tuple[int, int]:
         return int(round(h * ratio)), h
 
 
-def process_image(path: str, border: int, dry_run: bool, ratio: str) -> None:
+def padded_size(w: int, h: int, border: int, ratio: str) -> Optional[Tuple[int, int]]:
+    """
+    Work out the padded size for an image of the given size.
+    :return: (new_width, new_height), or None if the image already has the right ratio.
+    """
+    new_w, new_h = fix_ratio(w + border, h + border, ratio)
+    if new_w == w and new_h == h:
+        logging.info("no resize needed")
+        return None
+    logging.info(f"{w}x{h} -> {new_w}x{new_h} (border: {border})")
+    return new_w, new_h
+
+
+def process_image(path: str, border: int, dry_run: bool, ratio: str, engine: str = utils.ENGINE_IMAGEMAGICK) -> None:
     """
     Process a single image:
     - Compute padded dimensions
@@ -80,15 +122,19 @@ def process_image(path: str, border: int, dry_run: bool, ratio: str) -> None:
     :param path: Path to the image file
     :param border: Border size to apply before ratio check
     :param dry_run: If True, only simulate the changes
+    :param engine: 'imagemagick' to shell out to identify/convert, 'pillow' to open the image once in-process
     """
     logging.info(f"*** Processing: {path} ***")
-    w, h = utils.image_dimensions(path)
-    new_w, new_h = fix_ratio(w + border, h + border, ratio)
-    if new_w == w and new_h == h:
-        logging.info("no resize needed")
+    if engine == utils.ENGINE_PILLOW:
+        with Image.open(path) as img:
+            new_size = padded_size(img.width, img.height, border, ratio)
+            if new_size:
+                resize_pillow(dry_run, new_size[1], new_size[0], path, img)
         return
-    logging.info(f"{w}x{h} -> {new_w}x{new_h} (border: {border})")
-    resize(dry_run, new_h, new_w, path)
+    w, h = utils.image_dimensions(path)
+    new_size = padded_size(w, h, border, ratio)
+    if new_size:
+        resize(dry_run, new_size[1], new_size[0], path)
 
 
 def resize(dry_run: bool, new_h: int, new_w: int, path: str) -> None:
@@ -100,7 +146,7 @@ def resize(dry_run: bool, new_h: int, new_w: int, path: str) -> None:
     :param path: image file
     :return:
     """
-    cmd = ["convert", path, "-background", "#dddddd", "-gravity", "center", "-extent", f"{new_w}x{new_h}"]
+    cmd = ["convert", path, "-background", BACKGROUND, "-gravity", "center", "-extent", f"{new_w}x{new_h}"]
     if dry_run:
         logging.info(f"[DRY RUN] Would pad and overwrite: {' '.join(cmd)}")
         return
@@ -120,12 +166,149 @@ def resize(dry_run: bool, new_h: int, new_w: int, path: str) -> None:
     logging.info(f"Updated: {path}")
 
 
+def canvas_mode(img: Image.Image) -> str:
+    """The mode to pad `img` in: its own, keeping alpha and bit depth, except that palette images become RGB(A)."""
+    if img.mode == "P" and "transparency" in img.info:
+        return "RGBA"
+    return PALETTE_MODES.get(img.mode, img.mode)
+
+
+def background(mode: str) -> Any:
+    """
+    BACKGROUND as a pixel value in `mode`. `Image.new(mode, size, BACKGROUND)` would use the colour's RGB values as
+    they are, which in CMYK are nearly black.
+    """
+    if mode.startswith("I;16") or mode == "I":
+        return Image.new("RGB", (1, 1), BACKGROUND).convert("L").getpixel((0, 0)) * 257  # type: ignore[operator]
+    return Image.new("RGB", (1, 1), BACKGROUND).convert(mode).getpixel((0, 0))
+
+
+def resize_pillow(dry_run: bool, new_h: int, new_w: int, path: str, img: Image.Image) -> None:
+    """
+    Pillow version of `resize`: centre `img` on a #dddddd canvas of the new size, as `convert -gravity center -extent`
+    does. Overwrite the original file unless in dry-run mode.
+    :param dry_run:
+    :param new_h:
+    :param new_w:
+    :param path: image file
+    :param img: the already-open image from `path`
+    :return:
+    """
+    if dry_run:
+        logging.info(f"[DRY RUN] Would pad and overwrite: {path} to {new_w}x{new_h}")
+        return
+    mode = canvas_mode(img)
+    canvas = Image.new(mode, (new_w, new_h), background(mode))
+    canvas.paste(img.convert(mode), ((new_w - img.width) // 2, (new_h - img.height) // 2))
+    tmp = tempfile.NamedTemporaryFile(suffix=os.path.splitext(path)[1], delete=False)
+    tmp.close()  # Avoids issues on Windows
+    tmp_path = tmp.name
+    try:
+        try:
+            canvas.save(tmp_path, format=img.format, **utils.save_options(img))
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Error processing {path}: {e}") from e
+        # Replace original file
+        shutil.move(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logging.info(f"Updated: {path}")
+
+
+class RecordCollector(logging.Handler):
+    """Keeps log records instead of printing them, so they can be sent back to the parent process."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Format now: the arguments might not survive pickling.
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def process_collecting_logs(
+    path: str, border: int, dry_run: bool, ratio: str, engine: str, level: int
+) -> Tuple[bool, List[logging.LogRecord]]:
+    """
+    Run `process_image` on one file, holding back its log output. Errors are logged rather than raised so one bad
+    image doesn't stop the rest of the batch.
+    :param level: Log level to use while processing.
+    :return: Whether the image was processed successfully, and the log records for it.
+    """
+    root = logging.getLogger()
+    collector = RecordCollector()
+    saved_handlers, saved_level = root.handlers, root.level
+    root.handlers = [collector]
+    root.setLevel(level)
+    ok = True
+    try:
+        process_image(path, border, dry_run, ratio, engine)
+    except Exception as e:
+        logging.error(f"Failed: {path}: {e}")
+        ok = False
+    finally:
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+    return ok, collector.records
+
+
+def process_images(
+    images: List[str], border: int, dry_run: bool, ratio: str, engine: str = utils.ENGINE_IMAGEMAGICK, jobs: int = 1
+) -> List[str]:
+    """
+    Process many images, `jobs` at a time in worker processes. Log output is printed one image at a time, in the same
+    order as `images`.
+    :return: The images that could not be processed.
+    """
+    level = logging.getLogger().level
+    work = partial(process_collecting_logs, border=border, dry_run=dry_run, ratio=ratio, engine=engine, level=level)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return report_results(images, executor.map(work, images))
+    return report_results(images, map(work, images))
+
+
+def report_results(images: List[str], results: Iterable[Tuple[bool, List[logging.LogRecord]]]) -> List[str]:
+    """Print each image's held-back log records as its result comes in, and return the images that failed."""
+    root = logging.getLogger()
+    failed = []
+    for path, (ok, records) in zip(images, results):
+        for record in records:
+            root.handle(record)
+        if not ok:
+            failed.append(path)
+    return failed
+
+
+def drop_duplicates(images: List[str], mode: str, jobs: int) -> List[str]:
+    """Leave out the duplicate images, logging what was left out. Returns the images to process, in the same order."""
+    kept, copies = dupes.split_duplicates(images, jobs)
+    for image, others in copies.items():
+        if mode == dupes.DUPLICATES_GROUP:
+            logging.info(f"{image} duplicates, not padded: {' '.join(others)}")
+        else:
+            for other in others:
+                logging.info(f"Skipping {other}: duplicate of {image}")
+    return kept
+
+
 def main() -> None:
     args = parse_args()
     if args.quiet:
         logging.getLogger().setLevel(logging.WARNING)
-    for img in args.images:
-        process_image(img, args.border, args.dry_run, args.ratio)
+    if args.duplicates:
+        args.images = drop_duplicates(args.images, args.duplicates, max(args.jobs, 1))
+    failed = process_images(args.images, args.border, args.dry_run, args.ratio, args.engine, max(args.jobs, 1))
+    done = len(args.images) - len(failed)
+    logging.info(f"{done} of {len(args.images)} images processed, {len(failed)} failed")
+    if failed:
+        logging.error("Failed: " + " ".join(failed))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+"""
+Serve a gallery over HTTP, making its thumbnails only when they're first asked for, for `ima-showth --serve`.
+
+A thumbnail is made by one worker however many requests for it arrive at once; the others wait for it. Thumbnails are
+kept on disk in a least-recently-used cache bounded by their total size, so a big archive only ever holds thumbnails
+for what's been looked at lately. How recently each was used is kept in its modification time, so it carries over to
+the next run.
+"""
+
+import functools
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+
+
+class DiskCache:
+    """
+    Least-recently-used set of files on disk, bounded by their total size. Files are kept in groups, e.g. the
+    thumbnails of one image, which are used and deleted together. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, Tuple[List[str], int]] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def load(self, groups: Mapping[str, Sequence[str]]) -> List[str]:
+        """
+        Take in the groups whose files are already on disk, least recently used first by modification time, deleting
+        the oldest if they don't all fit.
+        :return: The deleted files.
+        """
+        found = []
+        for key, paths in groups.items():
+            mtimes = [os.stat(path).st_mtime_ns for path in paths if os.path.exists(path)]
+            if mtimes:
+                found.append((max(mtimes), key))
+        removed = []
+        for _mtime, key in sorted(found):
+            removed += self.add(key, groups[key])
+        return removed
+
+    def add(self, key: str, paths: Sequence[str]) -> List[str]:
+        """
+        Note that the files of group `key` were just made, deleting the least recently used groups if the cache is
+        now too big. The newest group is never deleted, even if it's bigger than the cache on its own.
+        :return: The deleted files.
+        """
+        existing = [path for path in paths if os.path.exists(path)]
+        size = sum(os.path.getsize(path) for path in existing)
+        removed: List[str] = []
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (existing, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _key, (evicted, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                removed += evicted
+        for path in removed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return removed
+
+    def touch(self, key: str) -> bool:
+        """Note that group `key` was just used. Returns False if it isn't in the cache."""
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+            paths = self.entries[key][0]
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return True
+
+
+class LazyThumbnails:
+    """
+    Makes thumbnails when they're asked for. The thumbnails of each image are made together, by one of `jobs` worker
+    threads, and kept in a `DiskCache`.
+    """
+
+    def __init__(
+        self,
+        images: Dict[str, List[str]],
+        make: Callable[[str], Optional[str]],
+        is_current: Callable[[str], bool],
+        made: Callable[[str], None],
+        cache: DiskCache,
+        jobs: int = os.cpu_count() or 1,
+    ) -> None:
+        """
+        :param images: The thumbnail paths of each image, by image name. The first is the one made from the image.
+        :param make: Makes the thumbnails of an image, returning an error message or None.
+        :param is_current: Whether the thumbnails of an image are there and up to date.
+        :param made: Called, one at a time, after the thumbnails of an image have been made.
+        """
+        self.images = images
+        self.owners = {os.path.normpath(path): name for name, paths in images.items() for path in paths}
+        self.make = make
+        self.is_current = is_current
+        self.made = made
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.pending: Dict[str, Future] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+        for path in cache.load(images):
+            print(f"Removed {path}")
+
+    def owner(self, path: str) -> Optional[str]:
+        """The image whose thumbnail `path` is, if it's one."""
+        return self.owners.get(os.path.normpath(path))
+
+    def ensure(self, name: str) -> Optional[str]:
+        """
+        Make sure the thumbnails of image `name` are there, making them or waiting for them if need be.
+        :return: The error message if they couldn't be made, otherwise None.
+        """
+        with self.lock:
+            future = self.pending.get(name)
+            if future is None:
+                if self.is_current(name):
+                    if not self.cache.touch(name):
+                        self.cache.add(name, self.images[name])
+                    return None
+                future = self.executor.submit(self._make, name)
+                self.pending[name] = future
+        return future.result()
+
+    def _make(self, name: str) -> Optional[str]:
+        try:
+            error = self.make(name)
+            with self.lock:
+                if not error:
+                    self.made(name)
+            if not error:
+                for path in self.cache.add(name, self.images[name]):
+                    print(f"Removed {path}")
+            return error
+        finally:
+            with self.lock:
+                del self.pending[name]
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+class GalleryHandler(SimpleHTTPRequestHandler):
+    """Serves the gallery's files, making thumbnails that aren't there yet on the way."""
+
+    def __init__(self, *args: Any, thumbnails: LazyThumbnails, **kwargs: Any) -> None:
+        self.thumbnails = thumbnails
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        if self.ensure_thumbnail():
+            super().do_GET()
+
+    def do_HEAD(self) -> None:
+        if self.ensure_thumbnail():
+            super().do_HEAD()
+
+    def ensure_thumbnail(self) -> bool:
+        """If the request is for a thumbnail, make sure it's there. Returns False if an error was sent instead."""
+        path = os.path.relpath(self.translate_path(self.path), self.directory)
+        name = self.thumbnails.owner(path)
+        if name is None:
+            return True
+        error = self.thumbnails.ensure(name)
+        if error:
+            print(f"FAILED: {name}: {error}", file=sys.stderr)
+            self.send_error(500, f"Thumbnail of {name} couldn't be made")
+            return False
+        return True
+
+
+def make_server(directory: str, port: int, thumbnails: LazyThumbnails, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """An HTTP server for the gallery in `directory`. Port 0 picks a free port."""
+    handler = functools.partial(GalleryHandler, directory=directory, thumbnails=thumbnails)
+    return ThreadingHTTPServer((host, port), handler)
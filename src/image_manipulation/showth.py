@@ -3,24 +3,45 @@
 showth.py — Generate paginated HTML thumbnail galleries
 
 This script scans the current directory for JPG images and creates
-thumbnail versions (160×120) using ImageMagick's `convert` command.
+thumbnail versions (160×120) using ImageMagick's `convert` command,
+or in-process with Pillow (`-e pillow`).
 It then generates simple HTML index pages (index.html, index2.html, …)
 using a Jinja2 template (`tmpl.html`).
 
 Features:
     • Automatically creates `th/` directory for thumbnails
-    • Uses up to 8 threads for parallel thumbnail generation
-    • Paginates output (12 images per page)
+    • Only remakes the thumbnails of images that changed, and deletes those of images that are gone
+      (`th/manifest.json`)
+    • Makes thumbnails in parallel, one per CPU by default, largest images first
+    • Paginates output (12 images per page), rendered in parallel, only rewriting the pages that changed
+    • Uses the packaged `tmpl.html` when the gallery has none, and keeps the compiled template in `th/`
+    • Optionally writes one page that loads the images from JSON shards as it's scrolled, for huge directories
+      (`--layout shards`)
+    • Optionally builds Deep Zoom tile pyramids of very large images, linked to a pan-and-zoom viewer (`--tiles-over`)
+    • Optionally serves the gallery over HTTP, making thumbnails only when they're first looked at, and keeping no
+      more of them than fit in a size limit (`--serve`)
     • Adds next/previous navigation links
     • Optional "Up one level" link to parent directory (pass 1 as argument)
+    • Optionally reuses the preview thumbnail cameras embed in the EXIF data (`--exif-thumbs`)
+    • Optionally builds a gallery in every directory of a tree, linked together (`--recursive ROOT`)
+    • Optionally writes each page as soon as its thumbnails are ready, for huge directories (`--stream`)
+    • Optionally makes bigger thumbnails too, for HiDPI screens, from the same decode (`--sizes 160,320,1024`)
+    • Optionally packs each page's thumbnails into one sprite image, so a page loads in a few requests (`--sprites`)
+    • Optionally writes progressive JPEG or WebP thumbnails, at a chosen quality (`--thumb-format`, `--quality`)
+    • Optionally leaves out duplicate images, or lists them under the one shown (`--duplicates skip|group`)
 
 Dependencies:
-    • Python 3.8+
+    • Python 3.10+
     • Jinja2 (for templating)
-    • ImageMagick (CLI `convert` command available in PATH)
+    • Pillow
+    • ImageMagick (CLI `convert` command available in PATH), unless using `-e pillow`
 
 Usage:
-    python showth.py [linktoparent]
+    python showth.py [-e imagemagick|pillow] [--exif-thumbs] [-j JOBS] [--workers thread|process] [--hash]
+                     [--sizes WIDTH,...] [--thumb-format jpeg|webp] [--quality N] [--sprites]
+                     [--layout pages|shards] [--tiles-over MP] [--duplicates skip|group] [--port PORT]
+                     [--cache-size MB]
+                     [--recursive ROOT | --stream | --serve] [linktoparent]
 
 Example:
     python showth.py       # no parent link
@@ -40,112 +61,1317 @@ Typical folder layout:
     └── tmpl.html
 """
 
+import argparse
+import glob
+import hashlib
+import io
+import json
 import os
-import sys
+import re
 import time
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from importlib.resources import files
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape, Template
-from typing import List, Dict, Any
+from jinja2 import (
+    ChoiceLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    FunctionLoader,
+    select_autoescape,
+    Template,
+)
+from PIL import Image, ImageOps
+from typing import List, Dict, Any, Deque, NamedTuple, Optional, Sequence, Tuple, Union
+
+from image_manipulation import dupes, probe, server, tiles, utils
+from image_manipulation.manifest import Manifest
 
 THUMB_DIR = "th"
+TILES_DIR = os.path.join(THUMB_DIR, "tiles")
+TEMPLATE = "tmpl.html"
+SHARDS_TEMPLATE = "shards.html"
+# Compiled templates are kept in the thumbnail directory, named like this.
+BYTECODE_PATTERN = "__jinja2_%s.cache"
 THUMB_WIDTH = 160
 THUMB_HEIGHT = 120
-MAX_THREADS = 8
+# An image in a gallery: the dict from `get_image_info`, or an `ImageRecord`.
+ImageInfo = Union[Dict[str, Any], "ImageRecord"]
+# A thumbnail to write: path, width and height of the box it fits in.
+Output = Tuple[str, int, int]
+WORKERS_THREAD = "thread"
+WORKERS_PROCESS = "process"
 IMAGES_PER_PAGE = 12
+IMAGES_PER_SHARD = 240
+LAYOUT_PAGES = "pages"
+LAYOUT_SHARDS = "shards"
+# Tile pyramids built at once. Each holds its whole decoded image, which for these images can be gigabytes.
+TILES_JOBS = 2
+THUMB_QUALITY = 90
+FORMAT_JPEG = "jpeg"
+FORMAT_WEBP = "webp"
+THUMB_FORMATS = (FORMAT_JPEG, FORMAT_WEBP)
+# Endings of the thumbnail files, in each format. Thumbnails made before --thumb-format existed are plain JPEGs.
+THUMB_EXTENSIONS = {FORMAT_JPEG: ".th.jpg", FORMAT_WEBP: ".th.webp"}
+# How to turn an image upright for each EXIF orientation, as ImageOps.exif_transpose does.
+TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a paginated HTML thumbnail gallery for the JPG images here.")
+    parser.add_argument(
+        "linktoparent",
+        nargs="?",
+        type=int,
+        default=0,
+        help="If nonzero, the 'Up one level' link points to the parent folder's index.html",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=utils.ENGINES,
+        default=utils.ENGINE_IMAGEMAGICK,
+        help="Make thumbnails with ImageMagick's CLI, or in-process with Pillow (default: imagemagick)",
+    )
+    parser.add_argument(
+        "--exif-thumbs",
+        action="store_true",
+        help="Use the preview thumbnail embedded in a JPEG's EXIF data, when it's big enough, instead of decoding the "
+        "whole image",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of thumbnails to make in parallel (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--workers",
+        choices=(WORKERS_THREAD, WORKERS_PROCESS),
+        default=WORKERS_THREAD,
+        help="Make thumbnails in threads, or in worker processes, which is faster with -e pillow (default: thread)",
+    )
+    parser.add_argument(
+        "--hash",
+        action="store_true",
+        help="Tell whether an image changed by its content hash, rather than its size and modification time",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_sizes,
+        default=(),
+        metavar="WIDTH,...",
+        help=f"Thumbnail widths to make, e.g. 160,320,1024, all from one decode of each image. Pages offer the bigger "
+        f"ones to HiDPI screens (default: {THUMB_WIDTH} only)",
+    )
+    parser.add_argument(
+        "--thumb-format",
+        choices=THUMB_FORMATS,
+        help="Write thumbnails as progressive JPEG, or as WebP, which is smaller still (default: baseline JPEG, as "
+        "before)",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        choices=range(1, 101),
+        metavar="N",
+        help=f"Thumbnail quality, 1-100 (default: {THUMB_QUALITY} with -e pillow, ImageMagick's own otherwise)",
+    )
+    parser.add_argument(
+        "--sprites",
+        action="store_true",
+        help="Pack each page's thumbnails into one image (th/spriteN.jpg) shown with CSS, to save requests",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=(LAYOUT_PAGES, LAYOUT_SHARDS),
+        default=LAYOUT_PAGES,
+        help=f"Write an HTML page per {IMAGES_PER_PAGE} images, or one page that loads the images as it's scrolled, "
+        f"from JSON files of {IMAGES_PER_SHARD} images each (th/shardN.json) (default: pages)",
+    )
+    parser.add_argument(
+        "--tiles-over",
+        type=float,
+        metavar="MP",
+        help="Build a Deep Zoom tile pyramid (th/tiles/) of each image bigger than MP megapixels, and link the image "
+        "to a pan-and-zoom viewer of it instead of the image file",
+    )
+    parser.add_argument(
+        "--duplicates",
+        choices=dupes.DUPLICATE_MODES,
+        help="Only show the biggest of each set of duplicate images, such as re-saved or resized copies. With 'group', "
+        "list the others under it (not with --stream or --layout shards)",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--recursive",
+        metavar="ROOT",
+        help="Build a gallery in ROOT and every directory under it that has JPG images, linked to each other",
+    )
+    mode.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write each page as soon as its thumbnails are made, keeping little in memory; for huge directories",
+    )
+    mode.add_argument(
+        "--serve",
+        action="store_true",
+        help="Write the pages, then serve the gallery on http://127.0.0.1:PORT/, making each thumbnail when it's "
+        "first asked for",
+    )
+    parser.add_argument("--port", type=int, default=8000, help="Port for --serve (default: 8000)")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=server.DEFAULT_CACHE_BYTES // (1024 * 1024),
+        metavar="MB",
+        help="With --serve, delete the least recently viewed thumbnails to keep them under this many megabytes "
+        "(default: %(default)s)",
+    )
+    args = parser.parse_args()
+    if args.layout == LAYOUT_SHARDS and (args.stream or args.sprites):
+        parser.error("--layout shards can't be combined with --stream or --sprites, which write HTML pages")
+    if args.serve and args.sprites:
+        parser.error("--serve can't be combined with --sprites, which need every thumbnail up front")
+    if args.tiles_over is not None and (args.stream or args.serve):
+        parser.error("--tiles-over can't be combined with --stream or --serve")
+    return args
+
+
+def parse_sizes(value: str) -> Tuple[int, ...]:
+    """Parse --sizes: thumbnail widths, separated by commas."""
+    try:
+        sizes = sorted({int(size) for size in value.split(",") if size.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a list of widths: {value!r}")
+    if not sizes or sizes[0] < 1:
+        raise argparse.ArgumentTypeError(f"not a list of widths: {value!r}")
+    return tuple(sizes)
+
+
+def size_box(width: int) -> Tuple[int, int]:
+    """The box a thumbnail of the given width fits in, in the same proportions as the standard thumbnail."""
+    return width, round(width * THUMB_HEIGHT / THUMB_WIDTH)
+
+
+class ThumbSpec(NamedTuple):
+    """How a gallery's thumbnails are made, besides the standard size. The defaults make them as they always were."""
+
+    sizes: Tuple[int, ...] = ()  # widths to make besides the standard one
+    format: Optional[str] = None  # FORMAT_JPEG for progressive JPEG, FORMAT_WEBP; None for baseline JPEG
+    quality: Optional[int] = None
+    tiles_over: Optional[float] = None  # megapixels over which an image gets a tile pyramid, and is opened as one
+
+    @property
+    def extension(self) -> str:
+        return THUMB_EXTENSIONS[self.format or FORMAT_JPEG]
+
+    def convert_options(self) -> List[str]:
+        """ImageMagick settings for writing the thumbnails. WebP is picked by `convert` from the file name."""
+        options = ["-quality", str(self.quality)] if self.quality else []
+        if self.format == FORMAT_JPEG:
+            options += ["-interlace", "Plane"]
+        return options
+
+    def save_options(self) -> Dict[str, Any]:
+        """Keyword arguments for Pillow's `Image.save`."""
+        quality = self.quality or THUMB_QUALITY
+        if self.format == FORMAT_WEBP:
+            return {"format": "WEBP", "quality": quality}
+        if self.format == FORMAT_JPEG:
+            return {"format": "JPEG", "quality": quality, "progressive": True, "optimize": True}
+        return {"format": "JPEG", "quality": quality}
 
 
-def make_thumbnail(img_path: str, out_path: str, width: int, height: int) -> None:
-    """Generate a thumbnail using ImageMagick's convert command."""
-    subprocess.run(["convert", img_path, "-strip", "-resize", f"{width}x{height}", out_path], check=False)
+DEFAULT_SPEC = ThumbSpec()
+
+
+def make_thumbnail(
+    img_path: str,
+    out_path: str,
+    width: int,
+    height: int,
+    extra: Sequence[Output] = (),
+    spec: ThumbSpec = DEFAULT_SPEC,
+) -> None:
+    """
+    Generate a thumbnail using ImageMagick's convert command.
+    :param extra: Bigger thumbnails to write from the same decode. Each size is shrunk from the one before.
+    :param spec: The format and quality to write the thumbnails in.
+    """
+    cmd = ["convert", img_path, "-strip", *spec.convert_options()]
+    for extra_path, extra_width, extra_height in sorted(extra, key=lambda o: o[1] * o[2], reverse=True):
+        cmd += ["-resize", f"{extra_width}x{extra_height}", "-write", extra_path]
+    subprocess.run(cmd + ["-resize", f"{width}x{height}", out_path], check=True)
     print(f"{img_path} -> {out_path}")
 
 
-def get_image_info(img: str, width: int, height: int) -> Dict[str, Any]:
-    """Collect metadata for an image."""
-    st = os.stat(img)
-    date_str = time.strftime("%b %d %Y", time.localtime(st.st_mtime))
-    out_name = os.path.join(THUMB_DIR, os.path.splitext(os.path.basename(img))[0] + ".th.jpg")
+def make_thumbnail_pillow(
+    img_path: str,
+    out_path: str,
+    width: int,
+    height: int,
+    extra: Sequence[Output] = (),
+    spec: ThumbSpec = DEFAULT_SPEC,
+) -> None:
+    """
+    Generate a thumbnail in-process with Pillow, turned upright according to its EXIF orientation. JPEGs are only
+    decoded at 1/2, 1/4 or 1/8 scale (draft mode), as long as that's still bigger than the thumbnail, before the final
+    resize.
+    :param extra: Bigger thumbnails to write from the same decode. Each size is shrunk from the one before.
+    :param spec: The format and quality to write the thumbnails in.
+    """
+    outputs = sorted([(out_path, width, height), *extra], key=lambda o: o[1] * o[2], reverse=True)
+    _path, draft_width, draft_height = outputs[0]
+    with open_source(img_path, spec) as img:
+        sideways = img.getexif().get(probe.TAG_ORIENTATION, 1) in (5, 6, 7, 8)
+        img.draft("RGB", (draft_height, draft_width) if sideways else (draft_width, draft_height))
+        thumb = ImageOps.exif_transpose(img)
+        for path, box_width, box_height in outputs:
+            thumb = ImageOps.contain(thumb, (box_width, box_height), Image.Resampling.LANCZOS)
+            thumb.convert("RGB").save(path, **spec.save_options())
+    print(f"{img_path} -> {out_path}")
+
+
+def open_source(img_path: str, spec: ThumbSpec = DEFAULT_SPEC) -> Image.Image:
+    """
+    Open an image to make thumbnails from. Images big enough to get a tile pyramid are opened as `tiles.build_pyramid`
+    opens them, without Pillow's decompression bomb check, so their thumbnails don't fail where their tiles work.
+    """
+    if spec.tiles_over is not None:
+        header = utils.image_header(img_path)
+        if header and header.width * header.height > spec.tiles_over * 1e6:
+            return tiles.open_large(img_path)
+    return Image.open(img_path)
+
+
+def fit(size: tuple[int, int], box: tuple[int, int]) -> tuple[int, int]:
+    """The size of an image of `size` scaled to fit inside `box`, keeping its aspect ratio, as ImageOps.contain does."""
+    width, height = size
+    if width * box[1] > height * box[0]:
+        return box[0], round(height / width * box[0])
+    if width * box[1] < height * box[0]:
+        return round(width / height * box[1]), box[1]
+    return box
+
+
+def make_thumbnail_exif(img_path: str, out_path: str, width: int, height: int, spec: ThumbSpec = DEFAULT_SPEC) -> bool:
+    """
+    Generate a thumbnail from the preview embedded in the image's EXIF data, without decoding the image itself. The
+    preview is written out as it is if it's already the right size and upright, and a plain JPEG is wanted; otherwise
+    it's turned, shrunk and encoded as `spec` says.
+    :return: False if there's no preview, or it's smaller than the thumbnail or has a different aspect ratio (e.g.
+        letterboxed), and nothing was written.
+    """
+    tiff = probe.read_exif(img_path)
+    header = utils.image_header(img_path)
+    preview = probe.exif_thumbnail(tiff) if tiff and header else None
+    preview_header = probe.read_header_from(io.BytesIO(preview)) if preview else None
+    if not header or not preview or not preview_header:
+        return False
+    target = fit(header.dimensions(oriented=True), (width, height))
+    size = probe.Header(preview_header.width, preview_header.height, header.orientation).dimensions(oriented=True)
+    if size[0] < target[0] or size[1] < target[1] or fit(size, target) != target:
+        return False
+    if size == target and header.orientation == 1 and spec == DEFAULT_SPEC:
+        with open(out_path, "wb") as f:
+            f.write(preview)
+    else:
+        with Image.open(io.BytesIO(preview)) as img:
+            upright = img.transpose(TRANSPOSE[header.orientation]) if header.orientation in TRANSPOSE else img
+            thumb = upright.resize(target, Image.Resampling.LANCZOS) if upright.size != target else upright
+            thumb.convert("RGB").save(out_path, **spec.save_options())
+    print(f"{img_path} -> {out_path} (EXIF thumbnail)")
+    return True
 
+
+def make_thumbnail_any(
+    img_path: str,
+    out_path: str,
+    width: int,
+    height: int,
+    engine: str = utils.ENGINE_IMAGEMAGICK,
+    exif_thumbs: bool = False,
+    extra: Sequence[Output] = (),
+    spec: ThumbSpec = DEFAULT_SPEC,
+) -> None:
+    """
+    Generate a thumbnail, from the EXIF preview if asked and it's good enough, otherwise with `engine`.
+    :param extra: Bigger thumbnails to write from the same decode. EXIF previews are never big enough for these, so
+        `exif_thumbs` only applies without them.
+    :param spec: The format and quality to write the thumbnails in.
+    """
+    # Only pass on the options that are set, so the thumbnail makers are called just as they were without them.
+    options: Dict[str, Any] = {}
+    if extra:
+        options["extra"] = extra
+    if spec != DEFAULT_SPEC:
+        options["spec"] = spec
+    if exif_thumbs and not extra and make_thumbnail_exif(img_path, out_path, width, height, spec):
+        pass  # made from the embedded preview
+    elif engine == utils.ENGINE_PILLOW:
+        make_thumbnail_pillow(img_path, out_path, width, height, **options)
+    else:
+        make_thumbnail(img_path, out_path, width, height, **options)
+
+
+def make_thumbnail_job(img: ImageInfo, engine: str, exif_thumbs: bool, spec: ThumbSpec = DEFAULT_SPEC) -> Optional[str]:
+    """
+    Make one image's thumbnail, and the bigger ones in `spec.sizes`. Errors are returned rather than raised, so one bad
+    image doesn't stop the rest.
+    :return: The error message, or None if the thumbnail was made.
+    """
+    extra = [
+        (os.path.join(img.get("dir", ""), thumb_name(img["name"], size, spec.extension)), *size_box(size))
+        for size in spec.sizes
+        if size != THUMB_WIDTH
+    ]
+    try:
+        make_thumbnail_any(
+            source_path(img), thumb_path(img), THUMB_WIDTH, THUMB_HEIGHT, engine, exif_thumbs, extra, spec
+        )
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return None
+
+
+def has_thumbnail(img: ImageInfo, manifest: Optional[Manifest] = None, spec: ThumbSpec = DEFAULT_SPEC) -> bool:
+    """
+    Whether the image's thumbnails, in every size in `spec`, have already been made. With a manifest, they must also
+    have been made from the current version of the image.
+    """
+    others = thumb_names(img["name"], spec)[1:]
+    if not all(os.path.exists(os.path.join(img.get("dir", ""), name)) for name in others):
+        return False
+    if manifest:
+        return manifest.is_current(img["name"], img["tname"])
+    return os.path.exists(thumb_path(img))
+
+
+def is_image(name: str) -> bool:
+    return name.lower().endswith(".jpg") and not name.lower().endswith(".th.jpg")
+
+
+def thumb_name(name: str, width: int = THUMB_WIDTH, extension: str = THUMB_EXTENSIONS[FORMAT_JPEG]) -> str:
+    """Where the thumbnail of image `name` goes, relative to the gallery's directory. Other sizes get their width."""
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return os.path.join(THUMB_DIR, stem + (extension if width == THUMB_WIDTH else f".{width}w{extension}"))
+
+
+def thumb_names(name: str, spec: ThumbSpec = DEFAULT_SPEC) -> List[str]:
+    """All the thumbnails of image `name`: the standard one and the other sizes in `spec`."""
+    widths = [THUMB_WIDTH] + [size for size in spec.sizes if size != THUMB_WIDTH]
+    return [thumb_name(name, width, spec.extension) for width in widths]
+
+
+def srcset(name: str, spec: ThumbSpec = DEFAULT_SPEC) -> str:
+    """The `srcset` attribute offering all the thumbnails of image `name`, by pixel density. Empty for just the one."""
+    if not any(size != THUMB_WIDTH for size in spec.sizes):
+        return ""
+    widths = sorted({THUMB_WIDTH, *spec.sizes})
+    return ", ".join(f"{thumb_name(name, width, spec.extension)} {width / THUMB_WIDTH:g}x" for width in widths)
+
+
+def source_path(img: ImageInfo) -> str:
+    """Where the image is. Its "name" is relative to its gallery's directory, as linked from the gallery."""
+    return os.path.join(img.get("dir", ""), img["name"])
+
+
+def thumb_path(img: ImageInfo) -> str:
+    return os.path.join(img.get("dir", ""), img["tname"])
+
+
+def get_image_info(
+    img: str,
+    width: int,
+    height: int,
+    directory: str = "",
+    st: Optional[os.stat_result] = None,
+    spec: ThumbSpec = DEFAULT_SPEC,
+) -> Dict[str, Any]:
+    """
+    Collect metadata for an image in the gallery in `directory` (default: the current directory).
+    :param spec: How the thumbnails are made: their file names, and the bigger sizes offered in "srcset".
+    """
+    st = st or os.stat(os.path.join(directory, img))
+    date_str = time.strftime("%b %d %Y", time.localtime(st.st_mtime))
     return {
         "name": img,
-        "tname": out_name,
+        "dir": directory,
+        "tname": thumb_name(img, extension=spec.extension),
+        "srcset": srcset(img, spec),
         "date": date_str,
         "ddate": st.st_mtime,
         "size": f"{st.st_size / 1024:.2f}kB",
+        "bytes": st.st_size,
         "width": width,
         "height": height,
     }
 
 
-def render_page(page_data: List[Dict], i: int, total: int, tmpl: Template, linktoparent: bool = False) -> None:
-    """Render paginated HTML pages using Jinja2."""
+class ImageRecord:
+    """
+    What the gallery needs to know about one image, in a lot less memory than the dict from `get_image_info`. The
+    rest of that dict's keys are worked out when asked for, by attribute (as templates do) or by key.
+    """
+
+    __slots__ = ("name", "dir", "ddate", "bytes", "spec")
+
+    def __init__(self, name: str, directory: str, ddate: float, size: int, spec: ThumbSpec = DEFAULT_SPEC) -> None:
+        self.name = name
+        self.dir = directory
+        self.ddate = ddate
+        self.bytes = size
+        self.spec = spec  # shared by all the records of a gallery
+
+    @classmethod
+    def from_file(
+        cls, name: str, directory: str = "", st: Optional[os.stat_result] = None, spec: ThumbSpec = DEFAULT_SPEC
+    ) -> "ImageRecord":
+        st = st or os.stat(os.path.join(directory, name))
+        return cls(name, directory, st.st_mtime, st.st_size, spec)
+
+    @property
+    def tname(self) -> str:
+        return thumb_name(self.name, extension=self.spec.extension)
+
+    @property
+    def srcset(self) -> str:
+        return srcset(self.name, self.spec)
+
+    @property
+    def date(self) -> str:
+        return time.strftime("%b %d %Y", time.localtime(self.ddate))
+
+    @property
+    def size(self) -> str:
+        return f"{self.bytes / 1024:.2f}kB"
+
+    @property
+    def width(self) -> int:
+        return THUMB_WIDTH
+
+    @property
+    def height(self) -> int:
+        return THUMB_HEIGHT
+
+    KEYS = ("name", "dir", "tname", "srcset", "date", "ddate", "size", "bytes", "width", "height")
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self.KEYS else default
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: self[key] for key in self.KEYS}
+
+
+def page_file(i: int) -> str:
+    return f"index{i if i > 1 else ''}.html"
+
+
+def sprite_file(i: int) -> str:
+    """The sprite image of page `i`, relative to the gallery's directory."""
+    return os.path.join(THUMB_DIR, f"sprite{i}.jpg")
+
+
+def sprite_layout(page_data: Sequence[ImageInfo], i: int, directory: str = "") -> Dict[str, Any]:
+    """
+    Lay the page's thumbnails out side by side in a sprite image, going by the sizes in their headers.
+    :return: The sprite's "src" and size, and a "cell" for each image: the thumbnail's "x" offset and size in the
+        sprite, or None if there's no thumbnail.
+    """
+    cells: List[Optional[Dict[str, int]]] = []
+    x = height = 0
+    for img in page_data:
+        header = utils.image_header(thumb_path(img))
+        if header is None:
+            cells.append(None)
+            continue
+        cells.append({"x": x, "width": header.width, "height": header.height})
+        x += header.width
+        height = max(height, header.height)
+    return {"src": sprite_file(i), "width": x, "height": height, "cells": cells}
+
+
+def make_sprite(page_data: Sequence[ImageInfo], sprite: Dict[str, Any], directory: str = "") -> None:
+    """Paste the page's thumbnails into its sprite image, as laid out by `sprite_layout`."""
+    if not sprite["width"]:
+        return
+    sheet = Image.new("RGB", (sprite["width"], sprite["height"]), "white")
+    for img, cell in zip(page_data, sprite["cells"]):
+        if cell:
+            with Image.open(thumb_path(img)) as thumb:
+                sheet.paste(thumb.convert("RGB"), (cell["x"], 0))
+    sheet.save(os.path.join(directory, sprite["src"]), "JPEG", quality=THUMB_QUALITY)
+
+
+def thumb_mtimes(page_data: Sequence[ImageInfo]) -> List[Optional[int]]:
+    """When each of the page's thumbnails was made, or None for those that aren't there."""
+    mtimes: List[Optional[int]] = []
+    for img in page_data:
+        try:
+            mtimes.append(os.stat(thumb_path(img)).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def render_page(
+    page_data: Sequence[ImageInfo],
+    i: int,
+    total: int,
+    tmpl: Template,
+    linktoparent: bool = False,
+    manifest: Optional[Manifest] = None,
+    tmpl_digest: str = "",
+    directory: str = "",
+    children: Optional[List[str]] = None,
+    sprites: bool = False,
+) -> None:
+    """
+    Render paginated HTML pages using Jinja2. With a manifest, the page is skipped if it was last rendered from the same
+    data and template, and with sprites, the same thumbnails. Either way, the file is only written if its content
+    changed.
+    :param directory: The gallery's directory (default: the current directory).
+    :param children: Subdirectories with galleries of their own, to link to.
+    :param sprites: Make the page's sprite image, for the template to show the thumbnails from.
+    """
     prev_page = i - 1 if i > 1 else 0
     next_page = i + 1 if i < total else 0
+    sprite = sprite_layout(page_data, i, directory) if sprites else None
 
-    html = tmpl.render(
+    context = dict(
         data=page_data,
         prevlink=bool(prev_page),
         prev="" if prev_page == 1 else prev_page,
         next=next_page if next_page else 0,
         linktoparent=linktoparent,
         thispage=i,
+        children=[{"name": child, "href": f"{child}/index.html"} for child in children or []],
+        sprite=sprite,
+    )
+    out_file = page_file(i)
+    inputs = json.dumps(
+        context, sort_keys=True, default=lambda o: o.as_dict() if isinstance(o, ImageRecord) else str(o)
     )
+    if sprites:
+        # Remade thumbnails need a new sprite, even if the page itself would be the same.
+        inputs += json.dumps(thumb_mtimes(page_data))
+    digest = hashlib.sha256((tmpl_digest + inputs).encode()).hexdigest()
+    out_path = os.path.join(directory, out_file)
+    sprite_ready = not sprites or os.path.exists(os.path.join(directory, sprite_file(i)))
+    if manifest and manifest.pages.get(out_file) == digest and os.path.exists(out_path) and sprite_ready:
+        return
+
+    if sprite:
+        make_sprite(page_data, sprite, directory)
+    html = tmpl.render(**context)
+    if manifest:
+        manifest.record_page(out_file, digest)
+    write_if_changed(out_path, html)
+
 
-    out_file = f"index{i if i > 1 else ''}.html"
-    with open(out_file, "w", encoding="utf-8") as f:
-        f.write(html)
-    print(f"Wrote {out_file}")
+def write_if_changed(path: str, text: str) -> bool:
+    """Write `text` to the file, unless it already has exactly that content. Returns whether it was written."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    print(f"Wrote {path}")
+    return True
 
 
-def create_html(data: List[dict], linktoparent: bool) -> None:
+def create_html(
+    data: List[dict],
+    linktoparent: bool,
+    manifest: Optional[Manifest] = None,
+    directory: str = "",
+    children: Optional[List[str]] = None,
+    template_dirs: Optional[Sequence[str]] = None,
+    sprites: bool = False,
+    jobs: int = 1,
+) -> None:
+    """
+    Render the gallery's pages.
+    :param directory: The gallery's directory (default: the current directory).
+    :param children: Subdirectories with galleries of their own, linked from the first page.
+    :param template_dirs: Where to look for tmpl.html (default: the gallery's directory). The compiled template is
+        kept in the thumbnail directory of the last of them, so galleries sharing a template share its bytecode.
+    :param sprites: Make a sprite image for each page.
+    :param jobs: Number of pages to render at once, in threads.
+    """
     # Sort images (by name desc, then date desc)
     data.sort(key=lambda x: (x["name"].lower(), x["ddate"]), reverse=True)
     # Render template pages
-    env = Environment(loader=FileSystemLoader("."), autoescape=select_autoescape(["html"]))
-    tmpl = env.get_template("tmpl.html")
+    template_dirs = template_dirs or [directory or "."]
+    tmpl, tmpl_digest = load_template(template_dirs, os.path.join(template_dirs[-1], THUMB_DIR))
 
     pages = [data[i : i + IMAGES_PER_PAGE] for i in range(0, len(data), IMAGES_PER_PAGE)]
+    if children and not pages:
+        pages = [[]]
     total = len(pages)
-    for i, page_data in enumerate(pages, start=1):
-        render_page(page_data, i, total, tmpl, linktoparent)
+
+    def render(i: int) -> None:
+        page_children = children if i == 1 else None
+        render_page(
+            pages[i - 1], i, total, tmpl, linktoparent, manifest, tmpl_digest, directory, page_children, sprites
+        )
+
+    # Each page, and its sprite, is written by one thread only; the manifest notes a different page for each.
+    if jobs > 1 and total > 1:
+        with ThreadPoolExecutor(max_workers=min(jobs, total)) as executor:
+            list(executor.map(render, range(1, total + 1)))
+    else:
+        for i in range(1, total + 1):
+            render(i)
+    remove_pages_after(total, manifest, directory, sprites)
+
+
+def shard_file(i: int) -> str:
+    """The JSON shard `i` of a gallery with --layout shards, relative to the gallery's directory."""
+    return os.path.join(THUMB_DIR, f"shard{i}.json")
+
+
+def shard_entry(img: ImageInfo) -> List[Any]:
+    """
+    What a shard holds about an image: [name, thumbnail, date, size in bytes, width, height, srcset, tiles]. The size is
+    the thumbnail's own, from its header, so the page can lay it out before it loads.
+    """
+    header = utils.image_header(thumb_path(img))
+    width, height = (header.width, header.height) if header else (img["width"], img["height"])
+    return [
+        img["name"],
+        img["tname"],
+        img["date"],
+        img["bytes"],
+        width,
+        height,
+        img.get("srcset", ""),
+        img.get("tiles", ""),
+    ]
+
+
+def create_shards(
+    data: List[dict],
+    linktoparent: bool,
+    manifest: Optional[Manifest] = None,
+    directory: str = "",
+    children: Optional[List[str]] = None,
+    template_dirs: Optional[Sequence[str]] = None,
+    jobs: int = 1,
+) -> None:
+    """
+    Write the gallery as one page, index.html from shards.html, that fetches the images from JSON shards as it's
+    scrolled. Images go in name order, so adding images that sort last, as camera file names do, only rewrites the
+    last shard (and the page, which lists the shards). Shards whose content didn't change aren't written.
+    Takes the same parameters as `create_html`; `jobs` shards are put together at once.
+    """
+    data.sort(key=lambda x: (x["name"].lower(), x["ddate"]))
+    template_dirs = template_dirs or [directory or "."]
+    tmpl, _tmpl_digest = load_template(template_dirs, os.path.join(template_dirs[-1], THUMB_DIR), SHARDS_TEMPLATE)
+
+    shards = [data[i : i + IMAGES_PER_SHARD] for i in range(0, len(data), IMAGES_PER_SHARD)]
+    os.makedirs(os.path.join(directory, THUMB_DIR), exist_ok=True)
+
+    def write_shard(i: int) -> None:
+        entries = [shard_entry(img) for img in shards[i - 1]]
+        write_if_changed(os.path.join(directory, shard_file(i)), json.dumps(entries, separators=(",", ":")))
+
+    with ThreadPoolExecutor(max_workers=max(min(jobs, len(shards)), 1)) as executor:
+        list(executor.map(write_shard, range(1, len(shards) + 1)))
+
+    html = tmpl.render(
+        shards=[{"src": shard_file(i), "count": len(shard)} for i, shard in enumerate(shards, start=1)],
+        total=len(data),
+        linktoparent=linktoparent,
+        children=[{"name": child, "href": f"{child}/index.html"} for child in children or []],
+    )
+    write_if_changed(os.path.join(directory, page_file(1)), html)
+    remove_pages_after(1, manifest, directory, shards=len(shards))
+    if manifest:
+        manifest.record_page(page_file(1), None)  # not a page the pages layout can skip rendering
+
+
+def packaged_template(name: str) -> Optional[str]:
+    """The templates that come with the package, for galleries that don't have their own."""
+    if name not in (TEMPLATE, SHARDS_TEMPLATE):
+        return None
+    return files("image_manipulation").joinpath(name).read_text(encoding="utf-8")
+
+
+def template_environment(template_dirs: Sequence[str], cache_dir: Optional[str] = None) -> Environment:
+    """
+    A Jinja2 environment that finds templates in the first of `template_dirs` that has them, or else in the package.
+    :param cache_dir: Where to keep compiled templates between runs, if anywhere.
+    """
+    loader = ChoiceLoader([FileSystemLoader(list(template_dirs)), FunctionLoader(packaged_template)])
+    bytecode_cache = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir, BYTECODE_PATTERN)
+    return Environment(loader=loader, autoescape=select_autoescape(["html"]), bytecode_cache=bytecode_cache)
+
+
+def template_digest(env: Environment, name: str = TEMPLATE) -> str:
+    """The digest of the source of the template `env` finds."""
+    assert env.loader is not None
+    source, _filename, _uptodate = env.loader.get_source(env, name)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def load_template(
+    template_dirs: Sequence[str], cache_dir: Optional[str] = None, name: str = TEMPLATE
+) -> Tuple[Template, str]:
+    """
+    Load tmpl.html, or template `name`, from the first of `template_dirs` that has it, or the packaged one, returning
+    it with the digest of its source. With `cache_dir`, it's only compiled again when its source changes.
+    """
+    env = template_environment(template_dirs, cache_dir)
+    return env.get_template(name), template_digest(env, name)
+
+
+def remove_pages_after(
+    total: int, manifest: Optional[Manifest] = None, directory: str = "", sprites: bool = False, shards: int = 0
+) -> None:
+    """
+    Delete the pages left over from when there were more than `total` pages, and their sprite images. Without
+    `sprites`, all sprite images are deleted. Shards after the first `shards` are deleted too.
+    """
+    i = max(total, 1) + 1
+    while os.path.exists(os.path.join(directory, page_file(i))):
+        os.remove(os.path.join(directory, page_file(i)))
+        print(f"Removed {os.path.join(directory, page_file(i))}")
+        i += 1
+    keep = total if sprites else 0
+    for path in glob.glob(os.path.join(glob.escape(directory), THUMB_DIR, "sprite*.jpg")):
+        match = re.fullmatch(r"sprite(\d+)\.jpg", os.path.basename(path))
+        if match and int(match.group(1)) > keep:
+            os.remove(path)
+    for path in glob.glob(os.path.join(glob.escape(directory), THUMB_DIR, "shard*.json")):
+        match = re.fullmatch(r"shard(\d+)\.json", os.path.basename(path))
+        if match and int(match.group(1)) > shards:
+            os.remove(path)
+    if manifest:
+        current = {page_file(n) for n in range(1, total + 1)}
+        for page in [page for page in manifest.pages if page not in current]:
+            manifest.record_page(page, None)
+
+
+def thumb_params(spec: ThumbSpec = DEFAULT_SPEC) -> Dict[str, Any]:
+    """
+    The parameters the thumbnails are made with, as recorded in the manifest. Only those that are set are included, so
+    manifests written before they existed still match.
+    """
+    params: Dict[str, Any] = {"width": THUMB_WIDTH, "height": THUMB_HEIGHT}
+    if spec.sizes:
+        params["sizes"] = list(spec.sizes)
+    if spec.format:
+        params["format"] = spec.format
+    if spec.quality:
+        params["quality"] = spec.quality
+    return params
+
+
+def prune_thumbnails(manifest: Manifest, names: Sequence[str], spec: ThumbSpec = DEFAULT_SPEC) -> None:
+    """Delete the thumbnails, in any format, that none of the images `names` uses any more."""
+    current = {name: thumb_names(name, spec) for name in names}
+    for removed in manifest.prune(current, tuple(THUMB_EXTENSIONS.values())):
+        print(f"Removed {removed}")
+
+
+def thumbnail_usage(directories: Sequence[str]) -> Tuple[int, int]:
+    """The number of thumbnail files in the galleries in `directories`, and their total size in bytes."""
+    count = total = 0
+    for directory in directories:
+        try:
+            entries = list(os.scandir(os.path.join(directory, THUMB_DIR)))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(tuple(THUMB_EXTENSIONS.values())):
+                count += 1
+                total += entry.stat().st_size
+    return count, total
+
+
+def report_thumbnails(directories: Sequence[str]) -> None:
+    count, total = thumbnail_usage(directories)
+    print(f"Thumbnails: {count} files, {total / 1024:.1f}kB")
 
 
-def make_thumbnails(data: List[dict]) -> None:
+def make_thumbnails(
+    data: List[dict],
+    engine: str = utils.ENGINE_IMAGEMAGICK,
+    exif_thumbs: bool = False,
+    jobs: int = os.cpu_count() or 1,
+    workers: str = WORKERS_THREAD,
+    manifests: Optional[Dict[str, Manifest]] = None,
+    spec: ThumbSpec = DEFAULT_SPEC,
+) -> List[str]:
+    """
+    Make the thumbnails that don't exist yet or are out of date, `jobs` at a time in threads or worker processes. The
+    images can be from any number of galleries, sharing the workers. The biggest images are started first, so a large
+    panorama doesn't hold up the end of the run.
+    :param manifests: The manifest of each gallery directory. Tells which thumbnails are out of date, and gets the new
+        ones recorded in it.
+    :param spec: How to make the thumbnails: which sizes besides the standard one, in what format.
+    :return: The images whose thumbnails couldn't be made.
+    """
+    manifests = manifests or {}
+    for directory in {img.get("dir", "") for img in data} or {""}:
+        os.makedirs(os.path.join(directory, THUMB_DIR), exist_ok=True)
+    todo = sorted(
+        (img for img in data if not has_thumbnail(img, manifests.get(img.get("dir", "")), spec)),
+        key=lambda img: img.get("bytes", 0),
+        reverse=True,
+    )
+
+    failed = []
+    pool = ProcessPoolExecutor if workers == WORKERS_PROCESS else ThreadPoolExecutor
+    with pool(max_workers=max(jobs, 1)) as executor:
+        futures = {executor.submit(make_thumbnail_job, img, engine, exif_thumbs, spec): img for img in todo}
+        for future in as_completed(futures):
+            img = futures[future]
+            manifest = manifests.get(img.get("dir", ""))
+            error = future.result()
+            if error:
+                print(f"FAILED: {source_path(img)}: {error}", file=sys.stderr)
+                failed.append(source_path(img))
+            elif manifest:
+                manifest.record(img["name"], img["tname"])
+    return failed
+
+
+def dzi_name(name: str) -> str:
+    """Where the tile pyramid of image `name` is described, relative to the gallery's directory."""
+    return os.path.join(TILES_DIR, os.path.splitext(os.path.basename(name))[0] + ".dzi")
+
+
+def make_tiles_job(img: ImageInfo) -> Optional[str]:
+    """Build one image's tile pyramid. As with `make_thumbnail_job`, errors are returned rather than raised."""
+    try:
+        tiles.build_pyramid(source_path(img), os.path.join(img.get("dir", ""), dzi_name(img["name"])))
+    except Exception as e:
+        return str(e) or type(e).__name__
+    print(f"{source_path(img)} -> {os.path.join(img.get('dir', ''), dzi_name(img['name']))}")
+    return None
+
+
+def make_tiles(
+    data: List[dict],
+    min_pixels: float,
+    jobs: int = os.cpu_count() or 1,
+    workers: str = WORKERS_THREAD,
+    use_hash: bool = False,
+) -> List[str]:
+    """
+    Build tile pyramids of the images bigger than `min_pixels`, going by their headers, and set their "tiles" to the
+    link to the viewer. At most `TILES_JOBS` pyramids are built at once, however many `jobs`, to bound memory use. Each
+    gallery directory has a manifest of its pyramids, in th/tiles/, so only those of changed images are built again,
+    and those of images that are gone, or no longer big enough, are deleted.
+    :return: The images whose pyramids couldn't be built.
+    """
+    big: Dict[str, List[dict]] = {img.get("dir", ""): [] for img in data}
+    for img in data:
+        header = utils.image_header(source_path(img))
+        if header and header.width * header.height > min_pixels:
+            big[img.get("dir", "")].append(img)
+
+    manifests = {}
+    todo = []
+    for directory, images in big.items():
+        manifest = Manifest(TILES_DIR, use_hash, tiles.PARAMS, root=directory)
+        for removed in manifest.prune({img["name"]: [dzi_name(img["name"])] for img in images}, ".dzi"):
+            tiles.remove_pyramid(removed)
+            print(f"Removed {removed}")
+        manifests[directory] = manifest
+        todo += [img for img in images if not manifest.is_current(img["name"], dzi_name(img["name"]))]
+        if images:
+            os.makedirs(os.path.join(directory, TILES_DIR), exist_ok=True)
+            write_if_changed(os.path.join(directory, THUMB_DIR, tiles.VIEWER), tiles.viewer_html())
+
+    failed = []
+    pool = ProcessPoolExecutor if workers == WORKERS_PROCESS else ThreadPoolExecutor
+    with pool(max_workers=max(min(jobs, TILES_JOBS), 1)) as executor:
+        futures = {executor.submit(make_tiles_job, img): img for img in todo}
+        for future in as_completed(futures):
+            img = futures[future]
+            error = future.result()
+            if error:
+                print(f"FAILED: {source_path(img)}: {error}", file=sys.stderr)
+                failed.append(source_path(img))
+            else:
+                manifests[img.get("dir", "")].record(img["name"], dzi_name(img["name"]))
+
+    failed_set = set(failed)
+    for images in big.values():
+        for img in images:
+            if source_path(img) not in failed_set:
+                # The viewer is in th/, next to the tiles directory.
+                img["tiles"] = f"{THUMB_DIR}/{tiles.VIEWER}#{os.path.relpath(dzi_name(img['name']), THUMB_DIR)}"
+    for manifest in manifests.values():
+        manifest.save()
+    return failed
+
+
+def drop_duplicates(
+    names: Sequence[str], directory: str = "", jobs: int = os.cpu_count() or 1
+) -> Tuple[List[str], Dict[str, List[str]]]:
+    """
+    Leave out the images of a gallery that are duplicates of others in it (see `dupes`), noting each one.
+    :return: `names` without the duplicates, in the same order, and the names of the duplicates, by the name of the
+             image kept instead.
+    """
+    kept, copies = dupes.split_duplicates([os.path.join(directory, name) for name in names], jobs)
+    for path, others in copies.items():
+        for other in others:
+            print(f"Skipping {other}: duplicate of {path}")
+    return [os.path.basename(path) for path in kept], {
+        os.path.basename(path): [os.path.basename(other) for other in others] for path, others in copies.items()
+    }
+
+
+def group_duplicates(data: Sequence[Dict[str, Any]], copies: Dict[str, List[str]]) -> None:
+    """List each image's duplicates with it, for the template, as `duplicates`."""
+    for img in data:
+        if img["name"] in copies:
+            img["duplicates"] = copies[img["name"]]
+
+
+def stream_gallery(
+    names: List[str],
+    linktoparent: bool,
+    manifest: Optional[Manifest] = None,
+    engine: str = utils.ENGINE_IMAGEMAGICK,
+    exif_thumbs: bool = False,
+    jobs: int = os.cpu_count() or 1,
+    workers: str = WORKERS_THREAD,
+    spec: ThumbSpec = DEFAULT_SPEC,
+    sprites: bool = False,
+) -> List[str]:
+    """
+    Make the thumbnails and pages of the gallery in the current directory a page at a time, in page order, writing each
+    page as soon as its thumbnails are done. Images are looked at, and their thumbnails started, a few pages ahead of
+    the page being written; besides the names, what's held for the whole gallery is the manifest's entry per image.
+    :param names: The images in the gallery. Sorted in place.
+    :return: The images whose thumbnails couldn't be made.
+    """
+    names.sort(key=str.lower, reverse=True)
+    tmpl, tmpl_digest = load_template(["."], THUMB_DIR)
+    total = (len(names) + IMAGES_PER_PAGE - 1) // IMAGES_PER_PAGE
+    # Enough pages in flight to keep every worker busy while the oldest page is waited for.
+    window = max(jobs // IMAGES_PER_PAGE, 1) + 1
     os.makedirs(THUMB_DIR, exist_ok=True)
 
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = [
-            executor.submit(make_thumbnail, img["name"], img["tname"], THUMB_WIDTH, THUMB_HEIGHT)
-            for img in data
-            if not os.path.exists(img["tname"])
+    failed = []
+    pending: Deque[Tuple[int, List[ImageRecord], List[Tuple[ImageRecord, Future]]]] = deque()
+
+    def finish_page() -> None:
+        i, records, futures = pending.popleft()
+        for img, future in futures:
+            error = future.result()
+            if error:
+                print(f"FAILED: {img.name}: {error}", file=sys.stderr)
+                failed.append(img.name)
+            elif manifest:
+                manifest.record(img.name, img.tname)
+        render_page(records, i, total, tmpl, linktoparent, manifest, tmpl_digest, sprites=sprites)
+
+    pool = ProcessPoolExecutor if workers == WORKERS_PROCESS else ThreadPoolExecutor
+    with pool(max_workers=max(jobs, 1)) as executor:
+        for i, start in enumerate(range(0, len(names), IMAGES_PER_PAGE), start=1):
+            records = [ImageRecord.from_file(name, spec=spec) for name in names[start : start + IMAGES_PER_PAGE]]
+            futures = [
+                (img, executor.submit(make_thumbnail_job, img, engine, exif_thumbs, spec))
+                for img in records
+                if not has_thumbnail(img, manifest, spec)
+            ]
+            pending.append((i, records, futures))
+            if len(pending) > window:
+                finish_page()
+        while pending:
+            finish_page()
+    remove_pages_after(total, manifest, sprites=sprites)
+    return failed
+
+
+class Gallery(NamedTuple):
+    directory: str
+    images: List[os.DirEntry[str]]
+    children: List[str]  # subdirectories that have galleries
+
+
+def find_galleries(root: str) -> List[Gallery]:
+    """
+    Walk the tree under `root`, finding the directories that need a gallery: those with JPG images, or with
+    subdirectories that have galleries. Hidden directories and thumbnail directories are skipped.
+    :return: The galleries, each after those of its subdirectories.
+    """
+    galleries: List[Gallery] = []
+
+    def walk(directory: str) -> bool:
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name.lower())
+        except OSError as e:
+            print(f"WARN: skipping {directory}: {e}", file=sys.stderr)
+            return False
+        images = [entry for entry in entries if entry.is_file() and is_image(entry.name)]
+        subdirs = [
+            entry
+            for entry in entries
+            if entry.is_dir(follow_symlinks=False) and entry.name != THUMB_DIR and not entry.name.startswith(".")
         ]
-        for _ in as_completed(futures):
-            pass
+        children = [entry.name for entry in subdirs if walk(entry.path)]
+        if not images and not children:
+            return False
+        galleries.append(Gallery(directory, images, children))
+        return True
 
+    walk(root)
+    return galleries
 
-def main() -> None:
-    start_time = time.time()
-    linktoparent = bool(int(sys.argv[1])) if len(sys.argv) > 1 else False
 
-    files = sorted(
-        [f for f in os.listdir(".") if f.lower().endswith(".jpg") and not f.lower().endswith(".th.jpg")],
-        key=lambda x: x.lower(),
+def gallery_signature(gallery: Gallery, linktoparent: bool, tmpl_digest: str, params: Dict[str, Any]) -> str:
+    """A digest of everything a gallery is built from, as far as can be told without opening the images."""
+    images = [(entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in gallery.images]
+    inputs = [images, gallery.children, linktoparent, tmpl_digest, params]
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def build_tree(
+    root: str,
+    linktoparent: bool = False,
+    engine: str = utils.ENGINE_IMAGEMAGICK,
+    exif_thumbs: bool = False,
+    jobs: int = os.cpu_count() or 1,
+    workers: str = WORKERS_THREAD,
+    use_hash: bool = False,
+    spec: ThumbSpec = DEFAULT_SPEC,
+    sprites: bool = False,
+    layout: str = LAYOUT_PAGES,
+    tiles_over: Optional[float] = None,
+    duplicates: Optional[str] = None,
+) -> List[str]:
+    """
+    Build a gallery in every directory under `root` that needs one (see `find_galleries`), each linking to its parent
+    and its subdirectories' galleries. All the thumbnails are made by one set of workers. Directories whose images,
+    subdirectories and template haven't changed since they were last built are skipped.
+    :param linktoparent: Link the gallery in `root` to its parent directory's index.html.
+    :param tiles_over: Build tile pyramids of images bigger than this many megapixels.
+    :param duplicates: Leave out duplicate images (`dupes.DUPLICATES_SKIP`), or list them under the image kept
+                       (`dupes.DUPLICATES_GROUP`).
+    :return: The images whose thumbnails or tile pyramids couldn't be made.
+    """
+    spec = spec._replace(tiles_over=tiles_over)
+    params = thumb_params(spec)
+    galleries = find_galleries(root)
+    builds = []
+    for gallery in galleries:
+        link = linktoparent or gallery.directory != root
+        tmpl_name = SHARDS_TEMPLATE if layout == LAYOUT_SHARDS else TEMPLATE
+        tmpl_digest = template_digest(template_environment([gallery.directory, root]), tmpl_name)
+        inputs = {**params, "layout": layout}
+        if tiles_over is not None:
+            inputs["tiles_over"] = tiles_over
+        if duplicates:
+            inputs["duplicates"] = duplicates
+        signature = gallery_signature(gallery, link, tmpl_digest, inputs)
+        manifest = Manifest(THUMB_DIR, use_hash, params, root=gallery.directory, adopt_params=thumb_params())
+        if manifest.signature == signature and os.path.exists(os.path.join(gallery.directory, page_file(1))):
+            continue
+        entries = gallery.images
+        copies: Dict[str, List[str]] = {}
+        if duplicates:
+            names, copies = drop_duplicates([entry.name for entry in entries], gallery.directory, jobs)
+            kept = set(names)
+            entries = [entry for entry in entries if entry.name in kept]
+        data = [
+            get_image_info(entry.name, THUMB_WIDTH, THUMB_HEIGHT, gallery.directory, entry.stat(), spec)
+            for entry in entries
+        ]
+        if duplicates == dupes.DUPLICATES_GROUP:
+            group_duplicates(data, copies)
+        prune_thumbnails(manifest, [img["name"] for img in data], spec)
+        builds.append((gallery, link, signature, manifest, data))
+    print(f"{len(galleries) - len(builds)} of {len(galleries)} directories unchanged")
+
+    manifests = {gallery.directory: manifest for gallery, _link, _signature, manifest, _data in builds}
+    images = [img for *_rest, data in builds for img in data]
+    failed = make_thumbnails(images, engine, exif_thumbs, jobs, workers, manifests, spec) if images else []
+    if tiles_over is not None and images:
+        failed += make_tiles(images, tiles_over * 1e6, jobs, workers, use_hash)
+
+    failed_set = set(failed)
+    for gallery, link, signature, manifest, data in builds:
+        template_dirs = [gallery.directory, root]
+        if layout == LAYOUT_SHARDS:
+            create_shards(data, link, manifest, gallery.directory, gallery.children, template_dirs, jobs)
+        else:
+            create_html(data, link, manifest, gallery.directory, gallery.children, template_dirs, sprites, jobs)
+        complete = not any(source_path(img) in failed_set for img in data)
+        manifest.set_signature(signature if complete else None)
+        manifest.save()
+    report_thumbnails([gallery.directory for gallery in galleries])
+    return failed
+
+
+def serve_gallery(
+    data: List[dict],
+    manifest: Manifest,
+    engine: str = utils.ENGINE_IMAGEMAGICK,
+    exif_thumbs: bool = False,
+    jobs: int = os.cpu_count() or 1,
+    spec: ThumbSpec = DEFAULT_SPEC,
+    port: int = 8000,
+    cache_bytes: int = server.DEFAULT_CACHE_BYTES,
+) -> None:
+    """
+    Serve the gallery in the current directory, whose pages have been written, until interrupted. Each image's
+    thumbnails are made, `jobs` at a time, when one of them is first asked for, and deleted again, least recently
+    viewed first, to keep them under `cache_bytes`.
+    """
+    images = {img["name"]: img for img in data}
+    thumbnails = server.LazyThumbnails(
+        {name: thumb_names(name, spec) for name in images},
+        make=lambda name: make_thumbnail_job(images[name], engine, exif_thumbs, spec),
+        is_current=lambda name: has_thumbnail(images[name], manifest, spec),
+        made=lambda name: manifest.record(name, images[name]["tname"]),
+        cache=server.DiskCache(cache_bytes),
+        jobs=jobs,
     )
+    httpd = server.make_server(".", port, thumbnails)
+    print(f"Serving http://127.0.0.1:{httpd.server_address[1]}/ (Ctrl-C to stop)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        thumbnails.close()
+        manifest.save()
+
+
+def duplicate_free_info(
+    files: List[str], duplicates: Optional[str], spec: ThumbSpec = DEFAULT_SPEC, jobs: int = os.cpu_count() or 1
+) -> List[dict]:
+    """
+    The info of the images in the current directory, leaving out duplicates if `duplicates` is set.
+    """
+    copies: Dict[str, List[str]] = {}
+    if duplicates:
+        files, copies = drop_duplicates(files, jobs=jobs)
+    data = [get_image_info(f, THUMB_WIDTH, THUMB_HEIGHT, "", None, spec) for f in files]
+    if duplicates == dupes.DUPLICATES_GROUP:
+        group_duplicates(data, copies)
+    return data
 
-    if not files:
-        print("No JPG files found.")
+
+def main() -> None:
+    start_time = time.time()
+    args = parse_args()
+    linktoparent = bool(args.linktoparent)
+    spec = ThumbSpec(args.sizes, args.thumb_format, args.quality, args.tiles_over)
+
+    if args.recursive:
+        failed = build_tree(
+            args.recursive,
+            linktoparent,
+            args.engine,
+            args.exif_thumbs,
+            args.jobs,
+            args.workers,
+            args.hash,
+            spec,
+            args.sprites,
+            args.layout,
+            args.tiles_over,
+            args.duplicates,
+        )
+    elif args.stream:
+        names = [entry.name for entry in os.scandir(".") if entry.is_file() and is_image(entry.name)]
+        if not names:
+            print("No JPG files found.")
+            return
+        if args.duplicates:
+            names, _copies = drop_duplicates(names, jobs=args.jobs)
+        manifest = Manifest(THUMB_DIR, args.hash, thumb_params(spec), adopt_params=thumb_params())
+        prune_thumbnails(manifest, names, spec)
+        failed = stream_gallery(
+            names,
+            linktoparent,
+            manifest,
+            args.engine,
+            args.exif_thumbs,
+            args.jobs,
+            args.workers,
+            spec,
+            args.sprites,
+        )
+        manifest.save()
+        report_thumbnails(["."])
+    elif args.serve:
+        files = sorted([f for f in os.listdir(".") if is_image(f)], key=lambda x: x.lower())
+        if not files:
+            print("No JPG files found.")
+            return
+        data = duplicate_free_info(files, args.duplicates, spec, args.jobs)
+        manifest = Manifest(THUMB_DIR, args.hash, thumb_params(spec), adopt_params=thumb_params())
+        prune_thumbnails(manifest, [img["name"] for img in data], spec)
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        if args.layout == LAYOUT_SHARDS:
+            create_shards(data, linktoparent, manifest, jobs=args.jobs)
+        else:
+            create_html(data, linktoparent, manifest, jobs=args.jobs)
+        manifest.save()
+        cache_bytes = args.cache_size * 1024 * 1024
+        serve_gallery(data, manifest, args.engine, args.exif_thumbs, args.jobs, spec, args.port, cache_bytes)
         return
+    else:
+        files = sorted([f for f in os.listdir(".") if is_image(f)], key=lambda x: x.lower())
+
+        if not files:
+            print("No JPG files found.")
+            return
 
-    data = [get_image_info(f, THUMB_WIDTH, THUMB_HEIGHT) for f in files]
+        data = duplicate_free_info(files, args.duplicates, spec, args.jobs)
 
-    make_thumbnails(data)
-    create_html(data, linktoparent)
+        manifest = Manifest(THUMB_DIR, args.hash, thumb_params(spec), adopt_params=thumb_params())
+        prune_thumbnails(manifest, [img["name"] for img in data], spec)
+        failed = make_thumbnails(data, args.engine, args.exif_thumbs, args.jobs, args.workers, {"": manifest}, spec)
+        if args.tiles_over is not None:
+            failed += make_tiles(data, args.tiles_over * 1e6, args.jobs, args.workers, args.hash)
+        if args.layout == LAYOUT_SHARDS:
+            create_shards(data, linktoparent, manifest, jobs=args.jobs)
+        else:
+            create_html(data, linktoparent, manifest, sprites=args.sprites, jobs=args.jobs)
+        manifest.save()
+        report_thumbnails(["."])
 
     elapsed = time.time() - start_time
     print(f"Completed in {elapsed:.2f}s")
+    if failed:
+        print(f"{len(failed)} thumbnails failed: " + " ".join(sorted(failed)), file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
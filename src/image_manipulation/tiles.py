@@ -0,0 +1,112 @@
+"""
+Deep Zoom (DZI) tile pyramids, so very large images can be looked at in a browser without downloading them whole.
+
+The pyramid of `photo.jpg` is `photo.dzi`, which gives the image's size, and `photo_files/`, with a directory per
+level of 256-pixel JPEG tiles, `photo_files/LEVEL/COLUMN_ROW.jpg`. The top level is the image at full size, and each
+level below it is half the size of the one above, down to a single pixel. `viewer.html`, a small pan-and-zoom viewer,
+shows a pyramid given in its URL fragment: `viewer.html#photo.dzi`.
+
+Pillow can't decode a JPEG a strip at a time, so the image is decoded once, at full size; each level is then made by
+halving the one before, which is released as soon as its tiles are written. At most about 1.25 times the decoded image
+is held at once.
+"""
+
+import math
+import os
+import shutil
+import threading
+from importlib.resources import files
+from typing import Iterator
+
+from PIL import Image, ImageOps
+
+TILE_SIZE = 256
+TILE_OVERLAP = 0
+TILE_FORMAT = "jpg"
+TILE_QUALITY = 85
+# What the tiles are made with, for the manifest: tiles made otherwise are out of date.
+PARAMS = {"tile_size": TILE_SIZE, "overlap": TILE_OVERLAP, "format": TILE_FORMAT, "quality": TILE_QUALITY}
+VIEWER = "viewer.html"
+DZI_NS = "http://schemas.microsoft.com/deepzoom/2008"
+
+_open_lock = threading.Lock()
+
+
+def open_large(path: str) -> Image.Image:
+    """
+    Open an image without Pillow's decompression bomb check, which stops at about 179 megapixels. These are the user's
+    own panoramas and scans, which are expected to be that big.
+    """
+    with _open_lock:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            return Image.open(path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+
+def max_level(width: int, height: int) -> int:
+    """The number of the top, full-size level of the pyramid: level 0 is one pixel."""
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def dzi_xml(width: int, height: int) -> str:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="{DZI_NS}" TileSize="{TILE_SIZE}" Overlap="{TILE_OVERLAP}" Format="{TILE_FORMAT}">'
+        f'<Size Width="{width}" Height="{height}"/></Image>\n'
+    )
+
+
+def files_dir(dzi_path: str) -> str:
+    """The directory with the tiles of the pyramid described by `dzi_path`."""
+    return os.path.splitext(dzi_path)[0] + "_files"
+
+
+def tile_boxes(width: int, height: int) -> Iterator[tuple[int, int, tuple[int, int, int, int]]]:
+    """Column, row and crop box of each tile of a level of the given size."""
+    for row in range(math.ceil(height / TILE_SIZE)):
+        for col in range(math.ceil(width / TILE_SIZE)):
+            left, top = col * TILE_SIZE, row * TILE_SIZE
+            yield col, row, (left, top, min(left + TILE_SIZE, width), min(top + TILE_SIZE, height))
+
+
+def build_pyramid(img_path: str, dzi_path: str) -> None:
+    """
+    Make the tile pyramid of an image, turned upright according to its EXIF orientation. The tiles are written to a
+    temporary directory that replaces the old ones when done, and the .dzi file last, so a pyramid is never seen half
+    made.
+    """
+    tiles_dir = files_dir(dzi_path)
+    tmp_dir = tiles_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    with open_large(img_path) as img:
+        ImageOps.exif_transpose(img, in_place=True)
+        level_img = img if img.mode == "RGB" else img.convert("RGB")
+        width, height = level_img.size
+        for level in range(max_level(width, height), -1, -1):
+            level_dir = os.path.join(tmp_dir, str(level))
+            os.makedirs(level_dir)
+            for col, row, box in tile_boxes(*level_img.size):
+                level_img.crop(box).save(os.path.join(level_dir, f"{col}_{row}.{TILE_FORMAT}"), quality=TILE_QUALITY)
+            if level:
+                previous, level_img = level_img, level_img.reduce(2)
+                previous.close()
+        level_img.close()
+    shutil.rmtree(tiles_dir, ignore_errors=True)
+    os.replace(tmp_dir, tiles_dir)
+    with open(dzi_path, "w", encoding="utf-8") as f:
+        f.write(dzi_xml(width, height))
+
+
+def remove_pyramid(dzi_path: str) -> None:
+    """Delete a pyramid's tiles, and its .dzi file if it's still there."""
+    shutil.rmtree(files_dir(dzi_path), ignore_errors=True)
+    if os.path.exists(dzi_path):
+        os.remove(dzi_path)
+
+
+def viewer_html() -> str:
+    """The viewer page that comes with the package."""
+    return files("image_manipulation").joinpath(VIEWER).read_text(encoding="utf-8")
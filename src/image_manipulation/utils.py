@@ -1,18 +1,40 @@
 import subprocess
-from typing import Optional, Dict, Tuple
+from typing import Any, Optional, Dict, Tuple
 
+from PIL import Image, JpegImagePlugin
 
-def image_dimensions(file: str | None = None, stdin: Optional[bytes] = None) -> tuple[int, int]:
+from image_manipulation import catalog, probe
+
+# Ways the tools can manipulate images: by running ImageMagick's CLI, or in-process with Pillow.
+ENGINE_IMAGEMAGICK = "imagemagick"
+ENGINE_PILLOW = "pillow"
+ENGINES = (ENGINE_IMAGEMAGICK, ENGINE_PILLOW)
+
+
+def image_header(file: str) -> Optional[probe.Header]:
+    """Same as `probe.read_header`, but kept in the catalog (if it's turned on), so it's only read once per change."""
+    header = catalog.cached(file, probe.Header._fields, lambda: probe.read_header(file))
+    return probe.Header(*header) if header else None
+
+
+def image_dimensions(file: str | None = None, stdin: Optional[bytes] = None, oriented: bool = False) -> tuple[int, int]:
     """
     Return horizontal or vertical size of given image file, or of the binary blob.
     Binary blob is a bytes object as used by `subprocess`.
-    :param dim: 'h' or 'w' for height or width.
+    JPEG, PNG, GIF and WebP files are measured from their headers, and the result kept in the catalog (if it's turned
+    on); anything else goes through `identify`.
     :param file: File name, or '-' in order to use the binary blob in `stdin`.
     :param stdin: Optional text blob whose size is wanted.
+    :param oriented: Swap width and height if the EXIF orientation says the image is on its side. Only the header
+        parser knows about orientation, and `identify` reports the stored size, so leave this off to match it.
     :return: The required dimension size in pixels.
     """
     if not file:
         file = "-"
+    if file != "-" and stdin is None:
+        header = image_header(file)
+        if header:
+            return header.dimensions(oriented)
     result = subprocess.run(["identify", "-format", "%w %h", file], input=stdin, capture_output=True, check=True)
 
     if result.returncode != 0:
@@ -27,3 +49,16 @@ def image_dimensions(file: str | None = None, stdin: Optional[bytes] = None) ->
         raise ValueError(f"Non-integer output from `identify`: {parts!r}") from e
 
     return width, height
+
+
+def save_options(img: Image.Image) -> Dict[str, Any]:
+    """
+    Options for saving a modified copy of `img` without losing its metadata, and for JPEGs, at the original quality.
+    """
+    options: Dict[str, Any] = {key: img.info[key] for key in ("exif", "icc_profile", "dpi") if key in img.info}
+    if isinstance(img, JpegImagePlugin.JpegImageFile):
+        options["qtables"] = img.quantization
+        sampling = JpegImagePlugin.get_sampling(img)
+        if sampling != -1:
+            options["subsampling"] = sampling
+    return options
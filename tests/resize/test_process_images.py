@@ -0,0 +1,79 @@
+import logging
+import sys
+from pathlib import Path
+from typing import List
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from image_manipulation import resize
+
+
+def _fake_process_image(path: str, *_: object) -> None:
+    logging.info(f"start {path}")
+    if path.startswith("bad"):
+        raise RuntimeError("broken")
+    logging.info(f"end {path}")
+
+
+def test_process_images_keeps_going_and_orders_logs(caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.INFO)
+    with mock.patch("image_manipulation.resize.process_image", side_effect=_fake_process_image):
+        failed = resize.process_images(["a.jpg", "bad.jpg", "c.jpg"], 0, False, "4x6")
+
+    assert failed == ["bad.jpg"]
+    messages: List[str] = [r.getMessage() for r in caplog.records]
+    assert messages == [
+        "start a.jpg",
+        "end a.jpg",
+        "start bad.jpg",
+        "Failed: bad.jpg: broken",
+        "start c.jpg",
+        "end c.jpg",
+    ]
+
+
+def test_process_images_in_worker_processes(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.INFO)
+    paths = []
+    for i in range(4):
+        Image.new("RGB", (800, 600 + i)).save(tmp_path / f"img{i}.png")
+        paths.append(str(tmp_path / f"img{i}.png"))
+    paths.append(str(tmp_path / "missing.png"))
+
+    failed = resize.process_images(paths, 0, False, "4x6", engine="pillow", jobs=2)
+
+    assert failed == [paths[-1]]
+    for i, padded in enumerate(paths[:-1]):
+        with Image.open(padded) as img:
+            assert img.size == resize.fix_ratio(800, 600 + i, "4x6")
+    processing = [r.getMessage() for r in caplog.records if r.getMessage().startswith("*** Processing")]
+    assert processing == [f"*** Processing: {path} ***" for path in paths]
+
+
+def test_main_exits_non_zero_on_failure() -> None:
+    with (
+        mock.patch.object(sys, "argv", ["ima-resize", "-j", "1", "a.jpg", "b.jpg"]),
+        mock.patch("image_manipulation.resize.process_images", return_value=["b.jpg"]) as mock_process,
+    ):
+        with pytest.raises(SystemExit) as exc:
+            resize.main()
+
+    assert exc.value.code == 1
+    mock_process.assert_called_once_with(["a.jpg", "b.jpg"], 0, False, "4x6", "imagemagick", 1)
+
+
+def test_main_skips_duplicates(caplog: pytest.LogCaptureFixture) -> None:
+    with (
+        mock.patch.object(sys, "argv", ["ima-resize", "--duplicates", "skip", "a.jpg", "b.jpg", "c.jpg"]),
+        mock.patch(
+            "image_manipulation.dupes.split_duplicates", return_value=(["a.jpg", "c.jpg"], {"c.jpg": ["b.jpg"]})
+        ),
+        mock.patch("image_manipulation.resize.process_images", return_value=[]) as mock_process,
+        caplog.at_level(logging.INFO),
+    ):
+        resize.main()
+
+    assert mock_process.call_args.args[0] == ["a.jpg", "c.jpg"]
+    assert "Skipping b.jpg: duplicate of c.jpg" in caplog.messages
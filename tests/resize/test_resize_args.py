@@ -13,6 +13,7 @@ def test_parse_args_default() -> None:
     assert not args.dry_run
     assert not args.quiet
     assert args.ratio == "4x6"
+    assert args.engine == "imagemagick"
     assert args.images == ["x"]  # No image file arguments
 
 
@@ -48,6 +49,13 @@ def test_parse_args_with_ratio() -> None:
     assert args.images == ["image1.jpg"]
 
 
+def test_parse_args_with_engine() -> None:
+    with patch.object(sys, "argv", ["your_script_name.py", "-e", "pillow", "image1.jpg"]):
+        args = parse_args()
+
+    assert args.engine == "pillow"
+
+
 def test_parse_args_multiple_images() -> None:
     with patch.object(sys, "argv", ["your_script_name.py", "image1.jpg", "image2.png"]):
         args = parse_args()
@@ -0,0 +1,76 @@
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from image_manipulation.resize import fix_ratio, process_image
+
+
+@pytest.mark.parametrize("w,h,border", [(800, 600, 0), (600, 1200, 0), (301, 400, 0), (640, 480, 20)])
+def test_process_image_pillow_geometry(tmp_path: Path, w: int, h: int, border: int) -> None:
+    path = tmp_path / "image.png"
+    Image.new("RGB", (w, h), "red").save(path)
+
+    process_image(str(path), border, False, "4x6", engine="pillow")
+
+    new_w, new_h = fix_ratio(w + border, h + border, "4x6")
+    with Image.open(path) as img:
+        assert img.size == (new_w, new_h)
+        assert img.format == "PNG"
+        left, top = (new_w - w) // 2, (new_h - h) // 2
+        assert img.getpixel((left, top)) == (255, 0, 0)
+        assert img.getpixel((left + w - 1, top + h - 1)) == (255, 0, 0)
+        assert img.getpixel((0, 0)) == (0xDD, 0xDD, 0xDD)
+        assert img.getpixel((new_w - 1, new_h - 1)) == (0xDD, 0xDD, 0xDD)
+
+
+def test_process_image_pillow_keeps_exif(tmp_path: Path) -> None:
+    path = tmp_path / "image.jpg"
+    exif = Image.Exif()
+    exif[0x010F] = "Camera"
+    Image.new("RGB", (800, 600), "blue").save(path, exif=exif)
+
+    process_image(str(path), 0, False, "4x6", engine="pillow")
+
+    with Image.open(path) as img:
+        assert img.size == (900, 600)
+        assert img.getexif()[0x010F] == "Camera"
+
+
+def test_process_image_pillow_no_resize_or_dry_run(tmp_path: Path) -> None:
+    path = tmp_path / "image.png"
+    Image.new("RGB", (800, 600)).save(path)
+    before = path.read_bytes()
+
+    with mock.patch("image_manipulation.utils.image_dimensions") as mock_image_dimensions:
+        process_image(str(path), 0, True, "4x6", engine="pillow")
+        mock_image_dimensions.assert_not_called()
+
+    assert path.read_bytes() == before
+
+
+def test_process_image_pillow_cmyk_background(tmp_path: Path) -> None:
+    path = tmp_path / "image.jpg"
+    Image.new("CMYK", (800, 600), (0, 255, 255, 0)).save(path)
+
+    process_image(str(path), 0, False, "4x6", engine="pillow")
+
+    with Image.open(path) as img:
+        assert img.mode == "CMYK"
+        r, g, b = img.convert("RGB").getpixel((0, 0))  # type: ignore[misc]
+        assert max(abs(r - 0xDD), abs(g - 0xDD), abs(b - 0xDD)) <= 3  # light grey, not black
+
+
+@pytest.mark.parametrize("mode,colour,background", [("LA", (50, 128), (0xDD, 255)), ("I;16", 1000, 0xDDDD)])
+def test_process_image_pillow_keeps_alpha_and_depth(tmp_path: Path, mode: str, colour: Any, background: Any) -> None:
+    path = tmp_path / "image.png"
+    Image.new(mode, (800, 600), colour).save(path)
+
+    process_image(str(path), 0, False, "4x6", engine="pillow")
+
+    with Image.open(path) as img:
+        assert img.mode == mode
+        assert img.getpixel((0, 0)) == background
+        assert img.getpixel((450, 300)) == colour
@@ -1,11 +1,26 @@
 import argparse
-from typing import Optional, Tuple
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
 from unittest.mock import call, MagicMock
 
 import pytest
 from pytest_mock import MockerFixture
 
-from image_manipulation.annotate import ImageAnnotate
+from PIL import Image, IptcImagePlugin
+
+from image_manipulation.label import Label, LabelCache, pixel_size, render_label
+from image_manipulation.annotate import (
+    ImageAnnotate,
+    default_border,
+    default_orientation,
+    default_size,
+    main,
+    read_manifest,
+    row_args,
+    run_batch,
+)
 
 
 @pytest.fixture
@@ -18,10 +33,16 @@ def annotate() -> ImageAnnotate:
         output_file="my_output",
         orientation="t-r-v",
         verbose=True,
+        engine="imagemagick",
     )
     return ImageAnnotate(args)
 
 
+@pytest.fixture(autouse=True)
+def fresh_label_cache(mocker: MockerFixture) -> LabelCache:
+    return mocker.patch("image_manipulation.label._label_cache", LabelCache())
+
+
 @pytest.fixture
 def mock_subprocess(mocker: MockerFixture) -> MagicMock:
     return mocker.patch("subprocess.run")
@@ -97,3 +118,251 @@ def test_composite_cmd(
         "my_input", "my_output",
         # fmt: on
     ]
+
+
+@pytest.mark.parametrize(
+    "orientation,expected_box",
+    [
+        ("t-l-h", (40, 40, 40 + 60, 40 + 50)),
+        ("b-r-h", (300 - 40 - 60, 200 - 40 - 50, 300 - 40, 200 - 40)),
+        ("m-m-v", ((300 - 50) // 2, (200 - 60) // 2, (300 - 50) // 2 + 50, (200 - 60) // 2 + 60)),
+    ],
+)
+def test_composite_pillow(
+    annotate: ImageAnnotate,
+    mocker: MockerFixture,
+    mock_subprocess: MagicMock,
+    tmp_path: Path,
+    orientation: str,
+    expected_box: Tuple[int, int, int, int],
+) -> None:
+    label = Image.new("RGBA", (60, 50) if orientation.endswith("h") else (50, 60), (0, 0, 0, 0x99))
+    render = mocker.patch("image_manipulation.annotate.render_label", return_value=label)
+    annotate.input_file = str(tmp_path / "in.png")
+    annotate.output_file = str(tmp_path / "out.png")
+    annotate.engine = "pillow"
+    annotate.set_orientation(orientation)
+    Image.new("RGB", (300, 200), "white").save(annotate.input_file)
+
+    annotate.run()
+
+    render.assert_called_once_with("hello there", 50, rotate=orientation.endswith("v"))
+    with Image.open(annotate.output_file) as out:
+        assert out.size == (300, 200)
+        left, top, right, bottom = expected_box
+        assert out.getpixel((left, top)) == out.getpixel((right - 1, bottom - 1)) == (102, 102, 102)
+        assert out.getpixel((left - 1, top)) == out.getpixel((right, bottom - 1)) == (255, 255, 255)
+    # At most the exiv2 step for non-JPEG metadata is left to run outside Python.
+    assert all(c.args[0][0] == "exiv2" for c in mock_subprocess.call_args_list)
+
+
+@pytest.mark.parametrize("output,mode", [("out.jpg", "RGB"), ("out.png", "RGBA")])
+def test_composite_pillow_alpha_input(
+    annotate: ImageAnnotate, mocker: MockerFixture, mock_subprocess: MagicMock, tmp_path: Path, output: str, mode: str
+) -> None:
+    mocker.patch("image_manipulation.annotate.render_label", return_value=Image.new("RGBA", (60, 50), (0, 0, 0, 0x99)))
+    annotate.input_file = str(tmp_path / "in.png")
+    annotate.output_file = str(tmp_path / output)
+    annotate.engine = "pillow"
+    Image.new("RGBA", (300, 200), (255, 0, 0, 0)).save(annotate.input_file)
+
+    annotate.run()
+
+    with Image.open(annotate.output_file) as out:
+        assert out.mode == mode
+        if mode == "RGB":
+            assert out.getpixel((299, 199)) == (255, 255, 255)  # transparent areas flattened onto white
+        else:
+            assert out.getchannel("A").getpixel((299, 199)) == 0
+
+
+@pytest.mark.parametrize(
+    "input_name,input_mode,output,mode,icc",
+    [
+        ("in.jpg", "L", "out.jpg", "L", True),
+        ("in.jpg", "CMYK", "out.jpg", "CMYK", True),
+        ("in.jpg", "CMYK", "out.png", "RGB", False),
+        ("in.png", "P", "out.png", "RGBA", True),
+    ],
+)
+def test_composite_pillow_keeps_mode(
+    annotate: ImageAnnotate,
+    mocker: MockerFixture,
+    mock_subprocess: MagicMock,
+    tmp_path: Path,
+    input_name: str,
+    input_mode: str,
+    output: str,
+    mode: str,
+    icc: bool,
+) -> None:
+    mocker.patch("image_manipulation.annotate.render_label", return_value=Image.new("RGBA", (60, 50), (0, 0, 0, 0x99)))
+    annotate.input_file = str(tmp_path / input_name)
+    annotate.output_file = str(tmp_path / output)
+    annotate.engine = "pillow"
+    original = Image.new(input_mode, (300, 200))
+    options: Dict[str, Any] = {"icc_profile": b"profile"}
+    if input_mode == "P":
+        options["transparency"] = 0  # the whole image
+    original.save(annotate.input_file, **options)
+
+    annotate.run()
+
+    with Image.open(annotate.output_file) as out:
+        assert out.mode == mode
+        assert ("icc_profile" in out.info) == icc
+        if mode == "RGBA":
+            assert out.getchannel("A").getpixel((299, 199)) == 0
+
+
+def test_render_label_sizes() -> None:
+    horizontal = render_label("hello there", 24)
+    vertical = render_label("hello there", 24, rotate=True)
+    assert horizontal.mode == "RGBA"
+    assert horizontal.width > horizontal.height > pixel_size(24) // 2
+    assert vertical.size == (horizontal.height, horizontal.width)
+    assert horizontal.getpixel((0, 0)) == (0, 0, 0, 0x99)
+    assert (255, 255, 255, 255) in {colour for _count, colour in horizontal.getcolors(1 << 16) or []}
+
+
+@pytest.mark.parametrize(
+    "name,content",
+    [
+        (
+            "manifest.jsonl",
+            '{"input": "a.jpg", "output": "A.jpg", "text": "one"}\n\n'
+            '{"input": "b.jpg", "output": "B.jpg", "text": "two", "size": 12, "border": 5, "orientation": "b-r-v"}\n',
+        ),
+        (
+            "manifest.csv",
+            "input,output,text,size,border,orientation\na.jpg,A.jpg,one,,,\nb.jpg,B.jpg,two,12,5,b-r-v\n",
+        ),
+    ],
+)
+def test_read_manifest(tmp_path: Path, name: str, content: str) -> None:
+    manifest = tmp_path / name
+    manifest.write_text(content)
+    rows = read_manifest(str(manifest))
+
+    first, second = (row_args(row) for row in rows)
+    assert (first.input_file, first.output_file, first.text) == ("a.jpg", "A.jpg", "one")
+    assert (first.text_size, first.border, first.orientation) == (default_size, default_border, default_orientation)
+    assert (second.text_size, second.border, second.orientation) == (12, 5, "b-r-v")
+
+
+def test_row_args_keeps_zero_border(tmp_path: Path) -> None:
+    manifest = tmp_path / "manifest.jsonl"
+    manifest.write_text('{"input": "a.jpg", "output": "A.jpg", "text": "one", "border": 0}\n')
+    (row,) = read_manifest(str(manifest))
+    assert row_args(row).border == 0
+
+
+def test_run_batch_reports_each_row(mocker: MockerFixture) -> None:
+    run = mocker.patch("image_manipulation.annotate.ImageAnnotate.run", side_effect=[None, RuntimeError("bad image")])
+    rows = [
+        {"input": "a.jpg", "output": "A.jpg", "text": "one"},
+        {"input": "b.jpg", "output": "B.jpg", "text": "two"},
+        {"input": "c.jpg", "text": "three"},
+    ]
+
+    assert list(run_batch(rows)) == [
+        {"input": "a.jpg", "output": "A.jpg", "ok": True},
+        {"input": "b.jpg", "output": "B.jpg", "ok": False, "error": "bad image"},
+        {"input": "c.jpg", "output": None, "ok": False, "error": "missing output"},
+    ]
+    assert run.call_count == 2
+
+
+def test_main_batch(tmp_path: Path, mocker: MockerFixture, capsys: pytest.CaptureFixture[str]) -> None:
+    manifest = tmp_path / "manifest.jsonl"
+    manifest.write_text('{"input": "a.jpg", "output": "A.jpg", "text": "one"}\n')
+    mocker.patch("image_manipulation.annotate.ImageAnnotate.run")
+    mocker.patch.object(sys, "argv", ["ima-annotate", "--batch", str(manifest), "-j", "1"])
+
+    main()
+
+    assert json.loads(capsys.readouterr().out) == {"row": 1, "input": "a.jpg", "output": "A.jpg", "ok": True}
+
+
+def test_main_requires_text_without_batch(mocker: MockerFixture) -> None:
+    mocker.patch.object(sys, "argv", ["ima-annotate", "-i", "a.jpg"])
+    with pytest.raises(SystemExit):
+        main()
+
+
+def test_run_pillow_jpeg_writes_metadata_in_one_go(
+    annotate: ImageAnnotate, tmp_path: Path, mock_subprocess: MagicMock
+) -> None:
+    annotate.input_file = str(tmp_path / "in.jpg")
+    annotate.output_file = str(tmp_path / "out.jpg")
+    annotate.engine = "pillow"
+    Image.new("RGB", (300, 200), "white").save(annotate.input_file)
+
+    annotate.run()
+
+    mock_subprocess.assert_not_called()
+    with Image.open(annotate.output_file) as out:
+        assert out.getexif().get_ifd(0x8769)[0x9286] == b"ASCII\x00\x00\x00hello there"
+        assert b"hello there" in out.info["xmp"]
+        assert (IptcImagePlugin.getiptcinfo(out) or {})[(2, 120)] == b"hello there"
+
+
+def test_run_imagemagick_writes_metadata_without_exiv2(
+    annotate: ImageAnnotate,
+    tmp_path: Path,
+    mocker: MockerFixture,
+    mock_subprocess: MagicMock,
+    mock_image_dimension: MagicMock,
+) -> None:
+    mock_image_dimension.return_value = (50, 60)
+    annotate.output_file = str(tmp_path / "out.jpg")
+    mocker.patch.object(annotate, "labelimg", return_value=b"label")
+    mocker.patch.object(annotate, "composite_cmd", return_value=["composite"])
+    mock_subprocess.side_effect = lambda *_a, **_kw: Image.new("RGB", (30, 20)).save(annotate.output_file)
+
+    annotate.run()
+
+    assert mock_subprocess.call_count == 1
+    with Image.open(annotate.output_file) as out:
+        assert b"hello there" in out.info["xmp"]
+
+
+def test_label_is_rendered_and_measured_once_per_caption(
+    annotate: ImageAnnotate, mocker: MockerFixture, mock_image_dimension: MagicMock
+) -> None:
+    labelimg = mocker.patch.object(annotate, "labelimg", return_value=b"miff")
+    mock_image_dimension.return_value = (50, 60)
+
+    assert annotate.label() == Label(b"miff", 50, 60)
+    assert annotate.label() == Label(b"miff", 50, 60)
+    annotate.set_orientation("t-l-h")
+    annotate.label()
+
+    assert labelimg.call_count == 2
+    assert mock_image_dimension.call_count == 2
+    # The label's size is known, so placing it only needs the input image measured.
+    mock_image_dimension.reset_mock()
+    mock_image_dimension.return_value = (300, 200)
+    annotate.set_orientation("b-r-v")
+    assert annotate.composite_cmd(Label(b"miff", 50, 60))[4] == "+210+100"
+    mock_image_dimension.assert_called_with("my_input", None)
+
+
+def test_label_cache_evicts_least_recently_used() -> None:
+    cache = LabelCache(max_bytes=10)
+    cache.get("a", lambda: Label(b"aaaa", 2, 2))
+    cache.get("b", lambda: Label(b"bbbb", 2, 2))
+    cache.get("a", lambda: Label(b"new!", 2, 2))
+    cache.get("c", lambda: Label(b"cccc", 2, 2))
+
+    assert list(cache.labels) == ["a", "c"]
+    assert cache.size == 8
+    assert cache.get("b", lambda: Label(b"BBBB", 2, 2)).blob == b"BBBB"
+
+
+def test_label_cache_on_disk(tmp_path: Path) -> None:
+    LabelCache(directory=str(tmp_path)).get(("pillow", "hi"), lambda: Label(b"\x01\x02\x03\x04", 1, 1))
+    render = MagicMock()
+
+    assert LabelCache(directory=str(tmp_path)).get(("pillow", "hi"), render) == Label(b"\x01\x02\x03\x04", 1, 1)
+    render.assert_not_called()
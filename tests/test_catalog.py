@@ -0,0 +1,80 @@
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+from PIL import Image
+
+from image_manipulation import catalog, mkpics, utils
+
+
+@pytest.fixture
+def images(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> catalog.Catalog:
+    monkeypatch.setenv(catalog.CATALOG_ENV, str(tmp_path / "catalog.sqlite3"))
+    images = catalog.default_catalog()
+    assert images is not None
+    return images
+
+
+def test_catalog_round_trip_and_invalidation(tmp_path: Path, images: catalog.Catalog) -> None:
+    photo = tmp_path / "photo.jpg"
+    photo.write_bytes(b"one")
+    assert images.get(str(photo)) is None
+
+    images.update(str(photo), width=10, height=20)
+    images.update(str(photo), taken="2020:01:02 03:04:05")
+    assert images.get(str(photo)) == {
+        "width": 10,
+        "height": 20,
+        "orientation": None,
+        "taken": "2020:01:02 03:04:05",
+        "dhash": None,
+    }
+
+    photo.write_bytes(b"changed")
+    assert images.get(str(photo)) is None
+    images.update(str(photo), orientation=6)
+    row = images.get(str(photo))
+    assert row is not None and row["orientation"] == 6 and row["width"] is None
+
+
+def test_catalog_ignores_missing_files_and_rejects_unknown_columns(tmp_path: Path, images: catalog.Catalog) -> None:
+    images.update(str(tmp_path / "missing.jpg"), width=1)
+    assert images.get(str(tmp_path / "missing.jpg")) is None
+    with pytest.raises(ValueError, match="Unknown catalog columns: colour"):
+        images.update(str(tmp_path), colour="red")
+
+
+def test_default_catalog_off(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delenv(catalog.CATALOG_ENV, raising=False)
+    compute = MagicMock(return_value=(1, 2))
+    assert catalog.default_catalog() is None
+    assert catalog.cached("x.jpg", ("width", "height"), compute) == (1, 2)
+    assert catalog.cached("x.jpg", ("width", "height"), compute) == (1, 2)
+    assert compute.call_count == 2
+
+
+def test_cached_computes_once(tmp_path: Path, images: catalog.Catalog) -> None:
+    photo = tmp_path / "photo.jpg"
+    photo.write_bytes(b"data")
+    compute = MagicMock(return_value=("",))
+    assert catalog.cached(str(photo), ("taken",), compute) == ("",)
+    assert catalog.cached(str(photo), ("taken",), compute) == ("",)
+    compute.assert_called_once()
+
+
+def test_tools_fill_catalog(tmp_path: Path, images: catalog.Catalog) -> None:
+    photo = tmp_path / "photo.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    exif[0x0132] = "2021:05:06 07:08:09"
+    Image.new("RGB", (64, 48)).save(photo, exif=exif)
+
+    assert utils.image_dimensions(str(photo)) == (64, 48)
+    assert mkpics.exif_datetime(str(photo)) == "2021:05:06 07:08:09"
+    assert images.get(str(photo)) == {
+        "width": 64,
+        "height": 48,
+        "orientation": 6,
+        "taken": "2021:05:06 07:08:09",
+        "dhash": None,
+    }
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageOps
+
+from image_manipulation import catalog, dupes
+
+
+def _picture(path: Path, size: tuple[int, int] = (640, 480), quality: int = 95) -> str:
+    Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 100).convert("RGB").save(path, quality=quality)
+    return str(path)
+
+
+def _other_picture(path: Path) -> str:
+    gradient = Image.linear_gradient("L").resize((640, 480))
+    ImageOps.mirror(gradient).convert("RGB").save(path, quality=95)
+    return str(path)
+
+
+def test_dhash_survives_resaving(tmp_path: Path) -> None:
+    original = dupes.dhash(_picture(tmp_path / "a.jpg"))
+    small = dupes.dhash(_picture(tmp_path / "b.jpg", (320, 240), quality=40))
+    other = dupes.dhash(_other_picture(tmp_path / "c.jpg"))
+
+    assert (original ^ small).bit_count() <= dupes.MAX_DISTANCE
+    assert (original ^ other).bit_count() > dupes.MAX_DISTANCE
+
+
+def test_near_pairs_without_numpy(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(dupes, "np", None)
+    hashes = [0b0000, 0b1111_0000_0000, 0b0001, 0b1111_0011_0000]
+    assert list(dupes.near_pairs(hashes, 2)) == [(0, 2), (1, 3)]
+    assert list(dupes.near_pairs([])) == []
+
+
+def test_near_pairs_with_numpy() -> None:
+    pytest.importorskip("numpy")
+    hashes = [0, 2**64 - 1, 1, 2**64 - 2]
+    assert list(dupes.near_pairs(hashes, 2)) == [(0, 2), (1, 3)]
+
+
+def test_split_duplicates_keeps_biggest(tmp_path: Path) -> None:
+    small = _picture(tmp_path / "a_small.jpg", (320, 240), quality=40)
+    other = _other_picture(tmp_path / "b.jpg")
+    big = _picture(tmp_path / "c_big.jpg")
+    broken = tmp_path / "d.jpg"
+    broken.write_bytes(b"not an image")
+
+    kept, copies = dupes.split_duplicates([small, other, big, str(broken)], jobs=2)
+
+    assert kept == [other, big, str(broken)]
+    assert copies == {big: [small]}
+
+
+def test_decompression_bomb_skipped(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    photo = _picture(tmp_path / "a.jpg")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    assert dupes.image_hash(photo) is None
+
+
+def test_hash_cached_in_catalog(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv(catalog.CATALOG_ENV, str(tmp_path / "catalog.sqlite3"))
+    photo = _picture(tmp_path / "a.jpg")
+    value = dupes.image_hash(photo)
+
+    monkeypatch.setattr(dupes, "dhash", lambda path: pytest.fail("hashed again"))
+    assert dupes.image_hash(photo) == value
+    images = catalog.default_catalog()
+    assert images is not None
+    assert images.get(photo) == {**dict.fromkeys(catalog.COLUMNS), "dhash": f"{value:016x}"}
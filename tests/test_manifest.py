@@ -0,0 +1,99 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from image_manipulation.manifest import MANIFEST_FILE, Manifest
+
+
+@pytest.fixture
+def gallery(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("th")
+    Path("a.jpg").write_bytes(b"picture")
+    Path("th/a.th.jpg").write_bytes(b"thumbnail")
+    return tmp_path
+
+
+def _bump_mtime(path: str, seconds: int = 10) -> None:
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + seconds * 10**9))
+
+
+def test_record_and_reload(gallery: Path) -> None:
+    manifest = Manifest("th", params={"width": 160})
+    manifest.record("a.jpg", "th/a.th.jpg")
+    manifest.save()
+
+    data = json.loads((gallery / "th" / MANIFEST_FILE).read_text())
+    assert data["images"]["a.jpg"]["size"] == 7
+    assert data["images"]["a.jpg"]["params"] == {"width": 160}
+    assert Manifest("th", params={"width": 160}).is_current("a.jpg", "th/a.th.jpg")
+    assert not Manifest("th", params={"width": 200}).is_current("a.jpg", "th/a.th.jpg")
+
+
+def test_changed_source(gallery: Path) -> None:
+    manifest = Manifest("th")
+    manifest.record("a.jpg", "th/a.th.jpg")
+    assert manifest.is_current("a.jpg", "th/a.th.jpg")
+
+    Path("a.jpg").write_bytes(b"edited!")  # same size
+    _bump_mtime("a.jpg")
+    assert not manifest.is_current("a.jpg", "th/a.th.jpg")
+
+
+def test_hash_ignores_touch(gallery: Path) -> None:
+    manifest = Manifest("th", use_hash=True)
+    manifest.record("a.jpg", "th/a.th.jpg")
+
+    _bump_mtime("a.jpg")
+    assert manifest.is_current("a.jpg", "th/a.th.jpg")
+
+    st = os.stat("a.jpg")
+    Path("a.jpg").write_bytes(b"PICTURE")
+    os.utime("a.jpg", ns=(st.st_atime_ns, st.st_mtime_ns))  # content changed, size and mtime kept
+    assert not manifest.is_current("a.jpg", "th/a.th.jpg")
+    assert Manifest("th").images == {}  # nothing saved yet
+
+
+def test_adopts_thumbnails_made_before_the_manifest(gallery: Path) -> None:
+    manifest = Manifest("th", params={"width": 160}, adopt_params={"width": 160})
+    _bump_mtime("th/a.th.jpg")
+    assert not Manifest("th").is_current("a.jpg", "th/a.th.jpg")
+    assert not Manifest("th", params={"width": 160, "format": "jpeg"}, adopt_params={"width": 160}).is_current(
+        "a.jpg", "th/a.th.jpg"
+    )
+    assert manifest.is_current("a.jpg", "th/a.th.jpg")
+    assert "a.jpg" in manifest.images
+
+    _bump_mtime("a.jpg", 20)
+    assert not Manifest("th", params={"width": 160}, adopt_params={"width": 160}).is_current("a.jpg", "th/a.th.jpg")
+    assert not manifest.is_current("missing.jpg", "th/missing.th.jpg")
+
+
+def test_prune(gallery: Path) -> None:
+    Path("th/gone.th.jpg").write_bytes(b"old")
+    Path("th/notes.txt").write_text("keep me")
+    manifest = Manifest("th")
+    manifest.record("a.jpg", "th/a.th.jpg")
+    manifest.images["gone.jpg"] = {"thumbnail": "th/gone.th.jpg"}
+
+    assert manifest.prune({"a.jpg": ["th/a.th.jpg"]}) == ["th/gone.th.jpg"]
+    assert set(manifest.images) == {"a.jpg"}
+    assert sorted(os.listdir("th")) == ["a.th.jpg", "notes.txt"]
+
+
+def test_corrupt_manifest_is_ignored(gallery: Path) -> None:
+    (gallery / "th" / MANIFEST_FILE).write_text("{not json")
+    assert Manifest("th").images == {}
+
+
+def test_loaded_entries_share_params(gallery: Path) -> None:
+    manifest = Manifest("th", params={"width": 160})
+    manifest.record("a.jpg", "th/a.th.jpg")
+    manifest.save()
+
+    loaded = Manifest("th", params={"width": 160})
+    assert loaded.images["a.jpg"]["params"] is loaded.params
+    assert Manifest("th", params={"width": 200}).images["a.jpg"]["params"] == {"width": 160}
@@ -0,0 +1,93 @@
+import io
+import struct
+
+import piexif
+import pytest
+from PIL import Image, IptcImagePlugin
+
+from image_manipulation import metadata
+
+
+def _jpeg(**options: object) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 8), "red").save(buffer, format="JPEG", **options)
+    return buffer.getvalue()
+
+
+def test_with_caption_sets_all_three_and_keeps_image_data() -> None:
+    exif = piexif.dump({"0th": {piexif.ImageIFD.Make: b"Camera"}, "Exif": {}})
+    original = _jpeg(exif=exif)
+
+    captioned = metadata.with_caption(original, "At the lake")
+
+    assert captioned.endswith(metadata.split_segments(original)[1])
+    with Image.open(io.BytesIO(captioned)) as img:
+        img.load()
+        exif_dict = piexif.load(img.info["exif"])
+        assert exif_dict["0th"][piexif.ImageIFD.Make] == b"Camera"
+        assert piexif.helper.UserComment.load(exif_dict["Exif"][piexif.ExifIFD.UserComment]) == "At the lake"
+        assert b'<rdf:li xml:lang="x-default">At the lake</rdf:li>' in img.info["xmp"]
+        assert (IptcImagePlugin.getiptcinfo(img) or {})[(2, 120)] == b"At the lake"
+
+
+def test_with_caption_replaces_previous_caption_and_keeps_other_metadata() -> None:
+    iptc = b"\x1c\x02\x19\x00\x04lake" + b"\x1c\x02\x78\x00\x05First"
+    resources = b"8BIM\x04\x04\x00\x00" + struct.pack(">I", len(iptc)) + iptc + b"\x00"
+    resources += b"8BIM\x04\x25\x00\x00\x00\x00\x00\x02ok"
+    xmp = (
+        b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        b'<rdf:Description xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:my="urn:my">'
+        b"<dc:title>Trip</dc:title><my:tag>x</my:tag><dc:description>First</dc:description>"
+        b"</rdf:Description></rdf:RDF></x:xmpmeta>"
+    )
+    segments, scan = metadata.split_segments(_jpeg())
+    segments += [
+        (metadata.APP1, metadata.XMP_HEADER + xmp),
+        (metadata.APP13, metadata.PHOTOSHOP_HEADER + resources),
+    ]
+
+    captioned = metadata.with_caption(metadata.join_segments(segments, scan), "Second")
+
+    new_segments, _ = metadata.split_segments(captioned)
+    app1 = [payload for marker, payload in new_segments if marker == metadata.APP1]
+    app13 = [payload for marker, payload in new_segments if marker == metadata.APP13]
+    assert len(app1) == 2 and len(app13) == 1
+    new_xmp = app1[1]
+    assert b"<dc:title>Trip</dc:title>" in new_xmp and b"<my:tag>x</my:tag>" in new_xmp
+    assert b"Second" in new_xmp and b"First" not in new_xmp
+    assert b"8BIM\x04\x25\x00\x00\x00\x00\x00\x02ok" in app13[0]
+    with Image.open(io.BytesIO(captioned)) as img:
+        iptc_info = IptcImagePlugin.getiptcinfo(img) or {}
+        assert iptc_info[(2, 120)] == b"Second"
+        assert iptc_info[(2, 25)] == b"lake"
+
+
+def test_unwritable_exif_kept_as_it_is(capsys: pytest.CaptureFixture[str]) -> None:
+    # Phones often store SceneType as a number, which piexif loads but won't dump.
+    exif = Image.Exif()
+    exif[piexif.ImageIFD.Orientation] = 6
+    exif.get_ifd(piexif.ImageIFD.ExifTag).update(
+        {piexif.ExifIFD.DateTimeOriginal: "2020:01:02 03:04:05", piexif.ExifIFD.SceneType: 1}
+    )
+    original = _jpeg(exif=exif.tobytes())
+
+    captioned = metadata.with_caption(original, "At the lake")
+
+    exif_dict = piexif.load(captioned)
+    assert exif_dict["0th"][piexif.ImageIFD.Orientation] == 6
+    assert exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] == b"2020:01:02 03:04:05"
+    assert b'<rdf:li xml:lang="x-default">At the lake</rdf:li>' in captioned
+    assert "kept without the comment" in capsys.readouterr().err
+
+
+def test_unicode_caption() -> None:
+    captioned = metadata.with_caption(_jpeg(), "Zürich")
+    with Image.open(io.BytesIO(captioned)) as img:
+        comment = piexif.load(img.info["exif"])["Exif"][piexif.ExifIFD.UserComment]
+        assert piexif.helper.UserComment.load(comment) == "Zürich"
+        assert (IptcImagePlugin.getiptcinfo(img) or {})[(2, 120)] == "Zürich".encode()
+
+
+def test_split_segments_rejects_non_jpeg() -> None:
+    with pytest.raises(ValueError, match="not a JPEG"):
+        metadata.split_segments(b"\x89PNG")
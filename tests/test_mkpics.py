@@ -1,7 +1,10 @@
+import sys
+from pathlib import Path
 from unittest.mock import MagicMock
 
 import piexif
 import pytest
+from PIL import Image
 from pytest_mock import MockerFixture
 
 from image_manipulation import mkpics
@@ -73,3 +76,93 @@ def test_get_new_filename(
     if exif_to_return:
         exif.info = {"exif": piexif.dump(exif_to_return)}
     assert mkpics.new_filename(file, prefix) == expected
+
+
+def test_new_filename_reads_jpeg_exif_without_pillow(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = tmp_path / "xyz.jpg"
+    Image.new("RGB", (8, 8)).save(path, exif=piexif.dump(exif_with_original_date))
+    pil_image = mocker.patch("image_manipulation.mkpics.Image")
+
+    assert mkpics.new_filename(str(path), "k") == ("20200304", "k03041939.jpg")
+    pil_image.open.assert_not_called()
+
+
+def test_new_filename_whatsapp_in_other_directory(mocker: MockerFixture) -> None:
+    read_exif = mocker.patch("image_manipulation.mkpics.probe.read_exif")
+    assert mkpics.new_filename("phone/IMG-20200712-WA01234.jpg", "k") == ("20200712", "k07120123.jpg")
+    read_exif.assert_not_called()
+
+
+def test_main_keeps_file_order(mocker: MockerFixture, capsys: pytest.CaptureFixture[str]) -> None:
+    mocker.patch.object(
+        sys, "argv", ["ima-mkpics", "-p", "k", "-j", "4"] + [f"IMG-2020071{i}-WA0123.jpg" for i in range(8)]
+    )
+    mkpics.main()
+    out = capsys.readouterr().out
+    assert [line.split()[-1] for line in out.splitlines() if line.strip().startswith("-i")] == [
+        f"k071{i}0123.jpg" for i in range(8)
+    ]
+
+
+def test_execute_annotates_in_process_and_writes_sidecars(
+    tmp_path: Path, mocker: MockerFixture, capsys: pytest.CaptureFixture[str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("image_manipulation.mkpics.new_filename", side_effect=lambda f, p: ("20200405", f"{p}{f}"))
+    run = mocker.patch("image_manipulation.annotate.ImageAnnotate.run", side_effect=[None, RuntimeError("bad")])
+
+    failed = mkpics.execute(["a.jpg", "b.jpg"], "k", True, 1, "pillow")
+
+    assert failed == 1
+    assert run.call_count == 2
+    assert Path("ka.jpg.xml").read_text() == annotation_with_xml.split("newname.xml\n")[1].removesuffix("EOT\n")
+    assert not Path("kb.jpg.xml").exists()
+    out, err = capsys.readouterr()
+    assert out == "[1/2] a.jpg -> ka.jpg\n"
+    assert err == "[2/2] b.jpg FAILED: bad\n"
+
+
+def test_execute_passes_caption_to_annotate(mocker: MockerFixture) -> None:
+    mocker.patch("image_manipulation.mkpics.new_filename", return_value=("20200405", "newname"))
+    run_batch = mocker.patch("image_manipulation.annotate.run_batch", return_value=[])
+
+    mkpics.execute(["xyz.jpg"], "k", False, 3, "imagemagick")
+
+    run_batch.assert_called_once_with(
+        [{"input": "xyz.jpg", "output": "newname", "text": " 20200405 - ", "date": "20200405"}], 3, "imagemagick"
+    )
+
+
+def test_main_duplicates(tmp_path: Path, mocker: MockerFixture, capsys: pytest.CaptureFixture[str]) -> None:
+    files = [str(tmp_path / name) for name in ("a.jpg", "b.jpg", "c.jpg")]
+    mocker.patch(
+        "image_manipulation.dupes.split_duplicates", return_value=([files[1]], {files[1]: [files[0], files[2]]})
+    )
+    mocker.patch("image_manipulation.mkpics.new_filename", return_value=("20200405", "newname"))
+    mocker.patch.object(sys, "argv", ["ima-mkpics", "-p", "k", "--duplicates", "group"] + files)
+    mkpics.main()
+
+    out, err = capsys.readouterr()
+    assert out.startswith(f"# {files[1]} duplicates: {files[0]} {files[2]}\n")
+    assert out.count("-i ") == 1
+    assert err == f"Skipping {files[0]}: duplicate of {files[1]}\nSkipping {files[2]}: duplicate of {files[1]}\n"
+
+
+def test_execute_reports_undated_files_and_carries_on(
+    tmp_path: Path, mocker: MockerFixture, capsys: pytest.CaptureFixture[str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (8, 8)).save("nodate.jpg")
+    run_batch = mocker.patch(
+        "image_manipulation.annotate.run_batch",
+        side_effect=lambda rows, *_: ({"input": row["input"], "output": row["output"], "ok": True} for row in rows),
+    )
+
+    failed = mkpics.execute(["nodate.jpg", "IMG-20200712-WA0001.jpg"], "k", True, 1, "pillow")
+
+    assert failed == 1
+    assert [row["input"] for row in run_batch.call_args.args[0]] == ["IMG-20200712-WA0001.jpg"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["k07120001.jpg.xml", "nodate.jpg"]
+    out, err = capsys.readouterr()
+    assert out == "[2/2] IMG-20200712-WA0001.jpg -> k07120001.jpg\n"
+    assert err == "[1/2] nodate.jpg FAILED: no date in the EXIF data\n"
@@ -0,0 +1,136 @@
+import io
+from pathlib import Path
+
+import pytest
+import piexif
+from PIL import Image
+
+from image_manipulation import probe
+
+
+@pytest.mark.parametrize(
+    "fmt,options",
+    [
+        ("JPEG", {}),
+        ("JPEG", {"progressive": True}),
+        ("PNG", {}),
+        ("GIF", {}),
+        ("WEBP", {}),
+        ("WEBP", {"lossless": True}),
+    ],
+)
+def test_read_header_formats(tmp_path: Path, fmt: str, options: dict) -> None:
+    path = tmp_path / f"image.{fmt.lower()}"
+    Image.new("RGB", (321, 123), "green").save(path, format=fmt, **options)
+    assert probe.read_header(str(path)) == probe.Header(321, 123, 1)
+
+
+def test_read_header_webp_extended(tmp_path: Path) -> None:
+    path = tmp_path / "image.webp"
+    Image.new("RGBA", (50, 70), (0, 0, 0, 10)).save(path, exif=b"Exif\x00\x00II*\x00\x08\x00\x00\x00\x00\x00")
+    assert path.read_bytes()[12:16] == b"VP8X"
+    assert probe.read_header(str(path)) == probe.Header(50, 70)
+
+
+@pytest.mark.parametrize("orientation,oriented_size", [(1, (400, 300)), (3, (400, 300)), (6, (300, 400))])
+def test_read_header_jpeg_orientation(tmp_path: Path, orientation: int, oriented_size: tuple[int, int]) -> None:
+    path = tmp_path / "image.jpg"
+    exif = Image.Exif()
+    exif[probe.TAG_ORIENTATION] = orientation
+    Image.new("RGB", (400, 300)).save(path, exif=exif)
+
+    header = probe.read_header(str(path))
+    assert header == probe.Header(400, 300, orientation)
+    assert header.dimensions() == (400, 300)
+    assert header.dimensions(oriented=True) == oriented_size
+
+
+def test_read_header_big_endian_exif() -> None:
+    tiff = b"MM\x00*\x00\x00\x00\x08\x00\x01" + b"\x01\x12\x00\x03\x00\x00\x00\x01\x00\x08\x00\x00" + b"\x00" * 4
+    assert probe.exif_orientation(tiff) == 8
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"BM" + b"\x00" * 40,  # BMP isn't handled
+        b"\xff\xd8\xff\xe0\x00\x10JFIF",  # truncated JPEG
+        b"\xff\xd8\xff\xda\x00\x02",  # scan before any frame header
+        b"RIFF\x00\x00\x00\x00WEBPVP8L",  # truncated WebP
+        b"RIFF\x00\x00\x00\x00WEBPVP8X",
+        b"RIFF\x00\x00\x00\x00WEBPVP8 ",
+    ],
+)
+def test_read_header_unknown(tmp_path: Path, data: bytes) -> None:
+    path = tmp_path / "image"
+    path.write_bytes(data)
+    assert probe.read_header(str(path)) is None
+
+
+def test_read_header_missing_file(tmp_path: Path) -> None:
+    assert probe.read_header(str(tmp_path / "nope.jpg")) is None
+
+
+def test_read_header_from_stream() -> None:
+    buf = io.BytesIO()
+    Image.new("L", (7, 9)).save(buf, format="JPEG")
+    buf.seek(0)
+    assert probe.read_header_from(buf) == probe.Header(7, 9)
+
+
+def _jpeg_with_exif(path: Path, exif_dict: dict) -> None:
+    Image.new("RGB", (8, 8)).save(path, exif=piexif.dump(exif_dict))
+
+
+@pytest.mark.parametrize(
+    "exif_dict,expected",
+    [
+        (
+            {
+                "0th": {piexif.ImageIFD.DateTime: b"2020:03:05 19:39:12"},
+                "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2020:03:04 19:39:12"},
+            },
+            "2020:03:04 19:39:12",
+        ),
+        ({"0th": {piexif.ImageIFD.DateTime: b"2020:03:05 19:39:12"}}, "2020:03:05 19:39:12"),
+        ({"0th": {piexif.ImageIFD.Make: b"Camera"}}, ""),
+    ],
+)
+def test_read_exif_datetime(tmp_path: Path, exif_dict: dict, expected: str) -> None:
+    path = tmp_path / "image.jpg"
+    _jpeg_with_exif(path, exif_dict)
+    tiff = probe.read_exif(str(path))
+    assert tiff is not None
+    assert probe.exif_datetime(tiff) == expected
+
+
+def test_read_exif_without_exif(tmp_path: Path) -> None:
+    Image.new("RGB", (8, 8)).save(tmp_path / "image.jpg")
+    Image.new("RGB", (8, 8)).save(tmp_path / "image.png")
+    assert probe.read_exif(str(tmp_path / "image.jpg")) == b""
+    assert probe.read_exif(str(tmp_path / "image.png")) is None
+    assert probe.read_exif(str(tmp_path / "missing.jpg")) is None
+    assert probe.exif_datetime(b"junk") == ""
+
+
+def test_exif_thumbnail(tmp_path: Path) -> None:
+    preview = io.BytesIO()
+    Image.new("RGB", (160, 120), "red").save(preview, format="JPEG")
+    path = tmp_path / "image.jpg"
+    _jpeg_with_exif(path, {"0th": {piexif.ImageIFD.Make: b"Camera"}, "1st": {}, "thumbnail": preview.getvalue()})
+
+    tiff = probe.read_exif(str(path))
+    assert tiff is not None
+    thumbnail = probe.exif_thumbnail(tiff)
+    assert thumbnail is not None
+    assert probe.read_header_from(io.BytesIO(thumbnail)) == probe.Header(160, 120)
+
+
+def test_exif_thumbnail_missing(tmp_path: Path) -> None:
+    path = tmp_path / "image.jpg"
+    _jpeg_with_exif(path, {"0th": {piexif.ImageIFD.Make: b"Camera"}})
+    tiff = probe.read_exif(str(path))
+    assert tiff is not None
+    assert probe.exif_thumbnail(tiff) is None
+    assert probe.exif_thumbnail(b"junk") is None
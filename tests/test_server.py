@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import pytest
+
+from image_manipulation import server
+
+
+def _write(path: Path, size: int) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path: Path) -> None:
+    cache = server.DiskCache(max_bytes=250)
+    a = [_write(tmp_path / "a.th.jpg", 100), _write(tmp_path / "a.320w.th.jpg", 50)]
+    b = [_write(tmp_path / "b.th.jpg", 100)]
+    assert cache.add("a", a) == []
+    assert cache.add("b", b) == []
+    assert cache.touch("a")
+
+    c = [_write(tmp_path / "c.th.jpg", 100)]
+    assert cache.add("c", c) == b
+    assert not os.path.exists(b[0])
+    assert cache.size == 250
+    assert not cache.touch("b")
+
+    # The newest group stays, however big
+    d = [_write(tmp_path / "d.th.jpg", 1000)]
+    assert sorted(cache.add("d", d)) == sorted(a + c)
+    assert list(cache.entries) == ["d"]
+
+
+def test_disk_cache_load_oldest_first(tmp_path: Path) -> None:
+    old = _write(tmp_path / "old.th.jpg", 100)
+    new = _write(tmp_path / "new.th.jpg", 100)
+    os.utime(old, (1000, 1000))
+    cache = server.DiskCache(max_bytes=150)
+
+    assert cache.load({"new": [new], "old": [old], "missing": [str(tmp_path / "missing.th.jpg")]}) == [old]
+    assert list(cache.entries) == ["new"]
+
+
+class _Thumbnails:
+    """A gallery in the current directory whose thumbnails are made slowly, counting how often."""
+
+    def __init__(self) -> None:
+        self.calls: List[str] = []
+        self.recorded: List[str] = []
+
+    def path(self, name: str) -> str:
+        return os.path.join("th", f"{name}.th.jpg")
+
+    def make(self, name: str) -> Optional[str]:
+        self.calls.append(name)
+        time.sleep(0.1)
+        if name == "bad":
+            return "broken image"
+        _write(Path(self.path(name)), 10)
+        return None
+
+    def lazy(self, names: List[str], max_bytes: int = 1000) -> server.LazyThumbnails:
+        return server.LazyThumbnails(
+            {name: [self.path(name)] for name in names},
+            make=self.make,
+            is_current=lambda name: os.path.exists(self.path(name)),
+            made=self.recorded.append,
+            cache=server.DiskCache(max_bytes),
+            jobs=4,
+        )
+
+
+def test_lazy_thumbnails_made_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    thumbs = _Thumbnails()
+    lazy = thumbs.lazy(["a", "bad"])
+    errors: List[Optional[str]] = []
+    requests = [threading.Thread(target=lambda: errors.append(lazy.ensure("a"))) for _ in range(5)]
+    for request in requests:
+        request.start()
+    for request in requests:
+        request.join()
+
+    assert errors == [None] * 5
+    assert thumbs.calls == ["a"] and thumbs.recorded == ["a"]
+    assert lazy.ensure("a") is None
+    assert thumbs.calls == ["a"]
+    assert lazy.ensure("bad") == "broken image"
+    assert thumbs.recorded == ["a"]
+    lazy.close()
+
+
+@pytest.fixture
+def gallery(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[tuple[str, _Thumbnails]]:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "index.html").write_text("gallery")
+    thumbs = _Thumbnails()
+    lazy = thumbs.lazy(["a", "b", "bad"], max_bytes=15)
+    httpd = server.make_server(str(tmp_path), 0, lazy)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", thumbs
+    httpd.shutdown()
+    httpd.server_close()
+    lazy.close()
+
+
+def test_server_makes_thumbnails_on_request(gallery: tuple[str, _Thumbnails], tmp_path: Path) -> None:
+    url, thumbs = gallery
+    with urllib.request.urlopen(f"{url}/index.html") as response:
+        assert response.read() == b"gallery"
+    assert thumbs.calls == []
+
+    with urllib.request.urlopen(f"{url}/th/a.th.jpg") as response:
+        assert response.read() == b"x" * 10
+    with urllib.request.urlopen(f"{url}/th/b.th.jpg") as response:
+        assert response.read() == b"x" * 10
+    assert thumbs.calls == ["a", "b"]
+    assert not (tmp_path / "th" / "a.th.jpg").exists()  # evicted: only one fits
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f"{url}/th/bad.th.jpg")
+    assert error.value.code == 500
@@ -1,11 +1,21 @@
 from __future__ import annotations
 
+import glob
+import io
+import json
 import os
+import subprocess
+import sys
+import time
+from importlib.resources import files
 from pathlib import Path
+from typing import Any
 from unittest.mock import MagicMock, patch
 
 import pytest
 import jinja2
+import piexif
+from PIL import Image, JpegImagePlugin
 
 import image_manipulation.showth as showth
 
@@ -15,6 +25,7 @@ def _fake_stat(tmp_file: Path, mtime: float = 1700000000.0, size: int = 2048) ->
 
     class _Stat:
         st_mtime = mtime
+        st_mtime_ns = int(mtime * 1e9)
         st_size = size
 
     # Simulate `os.stat()` output partially
@@ -29,7 +40,209 @@ def _fake_stat(tmp_file: Path, mtime: float = 1700000000.0, size: int = 2048) ->
 @patch("subprocess.run")
 def test_make_thumbnail_invokes_convert(mock_run: MagicMock) -> None:
     showth.make_thumbnail("img.jpg", "out.jpg", 160, 120)
-    mock_run.assert_called_once_with(["convert", "img.jpg", "-strip", "-resize", "160x120", "out.jpg"], check=False)
+    mock_run.assert_called_once_with(["convert", "img.jpg", "-strip", "-resize", "160x120", "out.jpg"], check=True)
+
+
+@patch("subprocess.run")
+def test_make_thumbnail_extra_sizes_one_decode(mock_run: MagicMock) -> None:
+    showth.make_thumbnail(
+        "img.jpg", "th/img.th.jpg", 160, 120, [("th/img.320w.th.jpg", 320, 240), ("b.jpg", 1024, 768)]
+    )
+    mock_run.assert_called_once_with(
+        [
+            "convert",
+            "img.jpg",
+            "-strip",
+            "-resize",
+            "1024x768",
+            "-write",
+            "b.jpg",
+            "-resize",
+            "320x240",
+            "-write",
+            "th/img.320w.th.jpg",
+            "-resize",
+            "160x120",
+            "th/img.th.jpg",
+        ],
+        check=True,
+    )
+
+
+def test_make_thumbnail_pillow_extra_sizes(tmp_path: Path) -> None:
+    src = tmp_path / "img.jpg"
+    Image.new("RGB", (4000, 3000), "green").save(src)
+    outputs = {width: tmp_path / f"{width}.jpg" for width in (160, 320, 1024)}
+
+    with patch.object(Image, "open", wraps=Image.open) as image_open:
+        showth.make_thumbnail_pillow(
+            str(src), str(outputs[160]), 160, 120, [(str(outputs[w]), *showth.size_box(w)) for w in (320, 1024)]
+        )
+
+    image_open.assert_called_once()
+    for width, out in outputs.items():
+        with Image.open(out) as thumb:
+            assert thumb.size == showth.size_box(width)
+
+
+def test_sizes_names_and_srcset() -> None:
+    assert showth.parse_sizes("1024, 160,320") == (160, 320, 1024)
+    with pytest.raises(Exception):
+        showth.parse_sizes("big")
+    assert showth.thumb_names("a.jpg", showth.ThumbSpec((160, 320))) == ["th/a.th.jpg", "th/a.320w.th.jpg"]
+    assert showth.srcset("a.jpg") == ""
+    assert (
+        showth.srcset("a.jpg", showth.ThumbSpec((320, 1024)))
+        == "th/a.th.jpg 1x, th/a.320w.th.jpg 2x, th/a.1024w.th.jpg 6.4x"
+    )
+
+
+@patch("image_manipulation.showth.make_thumbnail")
+@patch("image_manipulation.showth.make_thumbnail_exif")
+def test_make_thumbnail_job_sizes(mock_exif: MagicMock, mock_im: MagicMock) -> None:
+    img = {"name": "a.jpg", "dir": "photos", "tname": "th/a.th.jpg"}
+    spec = showth.ThumbSpec((160, 320))
+    assert showth.make_thumbnail_job(img, "imagemagick", True, spec) is None
+    mock_exif.assert_not_called()  # previews are too small for the bigger size anyway
+    mock_im.assert_called_once_with(
+        "photos/a.jpg", "photos/th/a.th.jpg", 160, 120, extra=[("photos/th/a.320w.th.jpg", 320, 240)], spec=spec
+    )
+
+
+@patch("subprocess.run")
+def test_make_thumbnail_format_and_quality(mock_run: MagicMock) -> None:
+    spec = showth.ThumbSpec(format="jpeg", quality=80)
+    showth.make_thumbnail("img.jpg", "out.jpg", 160, 120, spec=spec)
+    mock_run.assert_called_once_with(
+        ["convert", "img.jpg", "-strip", "-quality", "80", "-interlace", "Plane", "-resize", "160x120", "out.jpg"],
+        check=True,
+    )
+
+
+@pytest.mark.parametrize("fmt,expected", [("jpeg", "JPEG"), ("webp", "WEBP")])
+def test_make_thumbnail_pillow_formats(tmp_path: Path, fmt: str, expected: str) -> None:
+    src = tmp_path / "img.jpg"
+    Image.new("RGB", (1600, 1200), "red").save(src)
+    out = tmp_path / f"out{showth.THUMB_EXTENSIONS[fmt]}"
+
+    showth.make_thumbnail_pillow(str(src), str(out), 160, 120, spec=showth.ThumbSpec(format=fmt, quality=70))
+
+    with Image.open(out) as thumb:
+        assert thumb.format == expected
+        assert thumb.size == (160, 120)
+        if fmt == "jpeg":
+            assert thumb.info.get("progressive")
+
+
+def test_thumb_spec_names_and_params() -> None:
+    spec = showth.ThumbSpec((320,), "webp", 75)
+    assert showth.thumb_names("a.jpg", spec) == ["th/a.th.webp", "th/a.320w.th.webp"]
+    assert showth.get_image_info("a.jpg", 160, 120, st=_fake_stat(Path("a.jpg")), spec=spec)["tname"] == "th/a.th.webp"
+    assert showth.thumb_params(spec) == {"width": 160, "height": 120, "sizes": [320], "format": "webp", "quality": 75}
+    assert showth.thumb_params() == {"width": 160, "height": 120}
+
+
+@pytest.mark.parametrize("orientation,expected_size", [(1, (160, 120)), (6, (90, 120)), (8, (90, 120))])
+def test_make_thumbnail_pillow(
+    tmp_path: Path, orientation: int, expected_size: tuple[int, int], capsys: pytest.CaptureFixture[str]
+) -> None:
+    src = tmp_path / "img.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    photo = Image.new("RGB", (1600, 1200), "white")
+    photo.paste((255, 0, 0), (0, 0, 800, 1200))  # left half red
+    photo.save(src, exif=exif)
+    out = tmp_path / "out.jpg"
+
+    draft_method = JpegImagePlugin.JpegImageFile.draft
+    with patch.object(JpegImagePlugin.JpegImageFile, "draft", autospec=True, side_effect=draft_method) as draft:
+        showth.make_thumbnail_pillow(str(src), str(out), 160, 120)
+
+    assert draft.call_args.args[2] == ((120, 160) if orientation == 6 or orientation == 8 else (160, 120))
+    with Image.open(out) as thumb:
+        assert thumb.format == "JPEG"
+        assert thumb.size == expected_size
+        assert "exif" not in thumb.info
+        # Rotated upright: for orientation 6 the red half ends up on top, for 8 at the bottom.
+        red_at = {1: (10, 60), 6: (45, 10), 8: (45, 110)}[orientation]
+        r, g, b = thumb.convert("RGB").getpixel(red_at)  # type: ignore[misc]
+        assert r > 200 and g < 60 and b < 60
+    assert capsys.readouterr().out == f"{src} -> {out}\n"
+
+
+def _photo_with_preview(
+    path: Path, size: tuple[int, int], preview_size: tuple[int, int], orientation: int = 1
+) -> bytes:
+    preview = Image.new("RGB", preview_size, "white")
+    preview.paste((255, 0, 0), (0, 0, preview_size[0] // 2, preview_size[1]))  # left half red
+    buf = io.BytesIO()
+    preview.save(buf, format="JPEG")
+    exif = piexif.dump({"0th": {piexif.ImageIFD.Orientation: orientation}, "1st": {}, "thumbnail": buf.getvalue()})
+    Image.new("RGB", size, "blue").save(path, exif=exif)
+    return piexif.load(exif)["thumbnail"]
+
+
+# A 16:9 photo with a 4:3 (letterboxed) preview, and a preview that's too small
+@pytest.mark.parametrize("size,preview_size", [((1600, 900), (160, 120)), ((1600, 1200), (100, 75))])
+def test_make_thumbnail_exif_rejects(tmp_path: Path, size: tuple[int, int], preview_size: tuple[int, int]) -> None:
+    src = tmp_path / "img.jpg"
+    _photo_with_preview(src, size, preview_size)
+    out = tmp_path / "out.jpg"
+    assert not showth.make_thumbnail_exif(str(src), str(out), 160, 120)
+    assert not out.exists()
+
+
+def test_make_thumbnail_exif_copies_preview(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    src = tmp_path / "img.jpg"
+    preview = _photo_with_preview(src, (1600, 1200), (160, 120))
+    out = tmp_path / "out.jpg"
+    with patch.object(Image, "open", side_effect=AssertionError("decoded")):
+        assert showth.make_thumbnail_exif(str(src), str(out), 160, 120)
+    assert out.read_bytes() == preview
+    assert capsys.readouterr().out == f"{src} -> {out} (EXIF thumbnail)\n"
+
+
+@pytest.mark.parametrize(
+    "orientation,preview_size,expected_size", [(6, (160, 120), (90, 120)), (1, (320, 240), (160, 120))]
+)
+def test_make_thumbnail_exif_resizes_preview(
+    tmp_path: Path, orientation: int, preview_size: tuple[int, int], expected_size: tuple[int, int]
+) -> None:
+    src = tmp_path / "img.jpg"
+    _photo_with_preview(src, (1600, 1200), preview_size, orientation)
+    out = tmp_path / "out.jpg"
+    assert showth.make_thumbnail_exif(str(src), str(out), 160, 120)
+    with Image.open(out) as thumb:
+        assert thumb.size == expected_size
+        red_at = (45, 10) if orientation == 6 else (10, 60)
+        r, g, b = thumb.convert("RGB").getpixel(red_at)  # type: ignore[misc]
+        assert r > 200 and g < 60 and b < 60
+
+
+@patch("image_manipulation.showth.make_thumbnail")
+@patch("image_manipulation.showth.make_thumbnail_exif")
+def test_make_thumbnail_any_exif_fallback(mock_exif: MagicMock, mock_im: MagicMock) -> None:
+    mock_exif.return_value = True
+    showth.make_thumbnail_any("a.jpg", "th/a.th.jpg", 160, 120, exif_thumbs=True)
+    mock_im.assert_not_called()
+
+    mock_exif.return_value = False
+    showth.make_thumbnail_any("a.jpg", "th/a.th.jpg", 160, 120, exif_thumbs=True)
+    mock_im.assert_called_once_with("a.jpg", "th/a.th.jpg", 160, 120)
+
+    showth.make_thumbnail_any("a.jpg", "th/a.th.jpg", 160, 120)
+    assert mock_exif.call_count == 2
+
+
+@patch("image_manipulation.showth.make_thumbnail_pillow")
+@patch("image_manipulation.showth.make_thumbnail")
+def test_make_thumbnails_engine(
+    mock_im: MagicMock, mock_pillow: MagicMock, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    showth.make_thumbnails([{"name": "a.jpg", "tname": "th/a.th.jpg"}], engine="pillow")
+    mock_pillow.assert_called_once_with("a.jpg", "th/a.th.jpg", showth.THUMB_WIDTH, showth.THUMB_HEIGHT)
+    mock_im.assert_not_called()
 
 
 # ---------------------------------------------------------------------------
@@ -113,6 +326,138 @@ def test_create_html_paginates_and_renders(
     assert mock_render.call_count == 3
 
 
+def _gallery_data(count: int) -> list[dict]:
+    return [
+        {"name": f"img{i:02}.jpg", "tname": f"th/img{i:02}.th.jpg", "ddate": 1700000000.0, "size": "1kB"}
+        for i in range(count)
+    ]
+
+
+def test_create_html_incremental(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "tmpl.html").write_text("{% for img in data %}{{ img.name }} {% endfor %}")
+    os.makedirs("th")
+    manifest = showth.Manifest("th")
+
+    showth.create_html(_gallery_data(30), linktoparent=False, manifest=manifest)
+    assert sorted(os.listdir(".")) == ["index.html", "index2.html", "index3.html", "th", "tmpl.html"]
+    assert set(manifest.pages) == {"index.html", "index2.html", "index3.html"}
+    mtimes = {f: os.stat(f).st_mtime_ns for f in manifest.pages}
+    capsys.readouterr()
+
+    # Nothing changed: nothing is rendered or written
+    with patch.object(jinja2.Template, "render", side_effect=AssertionError("rendered")):
+        showth.create_html(_gallery_data(30), linktoparent=False, manifest=manifest)
+    assert {f: os.stat(f).st_mtime_ns for f in manifest.pages} == mtimes
+
+    # One more image lands on the first page (names sort backwards); the gallery shrinks to two pages.
+    data = _gallery_data(20) + [{"name": "img99.jpg", "tname": "th/img99.th.jpg", "ddate": 1.0, "size": "1kB"}]
+    showth.create_html(data, linktoparent=False, manifest=manifest)
+    out = capsys.readouterr().out
+    assert "Wrote index.html" in out and "Wrote index2.html" in out
+    assert "Removed index3.html" in out
+    assert not os.path.exists("index3.html")
+    assert set(manifest.pages) == {"index.html", "index2.html"}
+
+
+def test_create_html_template_change(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    tmpl = tmp_path / "tmpl.html"
+    tmpl.write_text("v1 {{ thispage }}")
+    os.makedirs("th")
+    manifest = showth.Manifest("th")
+    showth.create_html(_gallery_data(3), linktoparent=False, manifest=manifest)
+
+    tmpl.write_text("v2 {{ thispage }}")
+    showth.create_html(_gallery_data(3), linktoparent=False, manifest=manifest)
+    assert (tmp_path / "index.html").read_text() == "v2 1"
+
+
+def test_create_html_packaged_template_and_bytecode_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    showth.create_html(_gallery_data(3), linktoparent=False)  # no tmpl.html here
+    assert "img02.jpg" in (tmp_path / "index.html").read_text()
+    assert [name for name in os.listdir("th") if name.startswith("__jinja2_")]
+
+    # The compiled template is reused, until the template changes
+    with patch.object(jinja2.Environment, "compile", autospec=True, side_effect=jinja2.Environment.compile) as compile:
+        showth.load_template(["."], "th")
+        compile.assert_not_called()
+        (tmp_path / "tmpl.html").write_text("local {{ thispage }}")
+        _tmpl, digest = showth.load_template(["."], "th")
+        compile.assert_called_once()
+    assert digest != showth.load_template(["missing"], "th")[1]
+
+
+def test_create_html_parallel(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "tmpl.html").write_text("{{ thispage }}: {% for img in data %}{{ img.name }} {% endfor %}")
+    manifest = showth.Manifest("th")
+
+    showth.create_html(_gallery_data(40), linktoparent=False, manifest=manifest, jobs=4)
+
+    assert set(manifest.pages) == {"index.html", "index2.html", "index3.html", "index4.html"}
+    assert (tmp_path / "index4.html").read_text() == "4: img03.jpg img02.jpg img01.jpg img00.jpg "
+
+
+def _shard_data(count: int) -> list[dict]:
+    return [
+        {
+            "name": f"img{i:02}.jpg",
+            "tname": f"th/img{i:02}.th.jpg",
+            "date": "Nov 14 2023",
+            "ddate": 1700000000.0,
+            "bytes": 2048,
+            "width": 160,
+            "height": 120,
+        }
+        for i in range(count)
+    ]
+
+
+def test_create_shards(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(showth, "IMAGES_PER_SHARD", 10)
+    os.makedirs("th")
+    Image.new("RGB", (160, 90)).save("th/img00.th.jpg")
+    (tmp_path / "index2.html").write_text("old page")
+    manifest = showth.Manifest("th")
+    manifest.record_page("index2.html", "digest")
+
+    showth.create_shards(_shard_data(25), linktoparent=False, manifest=manifest, jobs=2)
+
+    shards = [json.loads(Path(f"th/shard{i}.json").read_text()) for i in (1, 2, 3)]
+    assert [len(shard) for shard in shards] == [10, 10, 5]
+    assert shards[0][0] == ["img00.jpg", "th/img00.th.jpg", "Nov 14 2023", 2048, 160, 90, "", ""]
+    assert shards[2][-1][0] == "img24.jpg"
+    html = (tmp_path / "index.html").read_text()
+    assert '"src": "th/shard3.json"' in html and "25 images" in html
+    assert not os.path.exists("index2.html")
+    assert manifest.pages == {}
+
+    # Images added at the end only rewrite the last shard, and the page
+    capsys.readouterr()
+    showth.create_shards(_shard_data(28), linktoparent=False, manifest=manifest)
+    assert capsys.readouterr().out.split() == ["Wrote", "th/shard3.json", "Wrote", "index.html"]
+
+    # Back to pages: the shards go
+    showth.create_html(_shard_data(28), linktoparent=False, manifest=manifest)
+    assert not glob.glob("th/shard*.json")
+    assert os.path.exists("index3.html")
+
+
+def test_render_page_keeps_identical_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    tmpl = jinja2.Template("page {{ thispage }}")
+    (tmp_path / "index.html").write_text("page 1")
+    os.utime("index.html", ns=(0, 0))
+
+    showth.render_page([], i=1, total=1, tmpl=tmpl)
+    assert os.stat("index.html").st_mtime_ns == 0
+
+
 # ---------------------------------------------------------------------------
 # make_thumbnails
 # ---------------------------------------------------------------------------
@@ -131,6 +476,44 @@ def test_make_thumbnails_parallel(mock_make: MagicMock, mock_exists: MagicMock,
     mock_make.assert_any_call("b.jpg", "th/b.th.jpg", showth.THUMB_WIDTH, showth.THUMB_HEIGHT)
 
 
+@patch("os.makedirs")
+@patch("os.path.exists", return_value=False)
+@patch("image_manipulation.showth.make_thumbnail")
+def test_make_thumbnails_largest_first_and_failures(
+    mock_make: MagicMock, mock_exists: MagicMock, mock_makedirs: MagicMock, capsys: pytest.CaptureFixture[str]
+) -> None:
+    def convert(img_path: str, *_: object) -> None:
+        if img_path == "bad.jpg":
+            raise subprocess.CalledProcessError(1, ["convert", img_path])
+
+    mock_make.side_effect = convert
+    imgs = [
+        {"name": "small.jpg", "tname": "th/small.th.jpg", "bytes": 10},
+        {"name": "bad.jpg", "tname": "th/bad.th.jpg", "bytes": 500},
+        {"name": "huge.jpg", "tname": "th/huge.th.jpg", "bytes": 9000},
+    ]
+    failed = showth.make_thumbnails(imgs, jobs=1)
+
+    assert failed == ["bad.jpg"]
+    assert [c.args[0] for c in mock_make.call_args_list] == ["huge.jpg", "bad.jpg", "small.jpg"]
+    assert (
+        "FAILED: bad.jpg: Command '['convert', 'bad.jpg']' returned non-zero exit status 1." in capsys.readouterr().err
+    )
+
+
+def test_make_thumbnails_process_workers(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (320, 240), "red").save("a.jpg")
+    (tmp_path / "b.jpg").write_bytes(b"not a jpeg")
+    imgs = [{"name": "a.jpg", "tname": "th/a.th.jpg"}, {"name": "b.jpg", "tname": "th/b.th.jpg"}]
+
+    failed = showth.make_thumbnails(imgs, engine="pillow", jobs=2, workers=showth.WORKERS_PROCESS)
+
+    assert failed == ["b.jpg"]
+    with Image.open(tmp_path / "th" / "a.th.jpg") as thumb:
+        assert thumb.size == (160, 120)
+
+
 # ---------------------------------------------------------------------------
 # main()
 # ---------------------------------------------------------------------------
@@ -150,16 +533,45 @@ def test_main_happy_path(
 ) -> None:
     mock_listdir.return_value = ["a.jpg", "b.JPG", "c.th.jpg"]
     mock_get.side_effect = lambda f, *_: {"name": f, "tname": f"th/{f}.th.jpg"}
+    mock_thumbs.return_value = []
     monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["ima-showth"])
 
     showth.main()
     mock_thumbs.assert_called_once()
     mock_html.assert_called_once()
 
 
+@patch("image_manipulation.showth.create_html")
+@patch("image_manipulation.showth.make_thumbnails", return_value=["b.jpg"])
+@patch("image_manipulation.showth.get_image_info")
+@patch("os.listdir", return_value=["a.jpg", "b.jpg"])
+def test_main_reports_failures(
+    mock_listdir: MagicMock,
+    mock_get: MagicMock,
+    mock_thumbs: MagicMock,
+    mock_html: MagicMock,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    mock_get.side_effect = lambda f, *_: {"name": f, "tname": f"th/{f}.th.jpg"}
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-j", "3", "--workers", "process"])
+
+    with pytest.raises(SystemExit) as exc:
+        showth.main()
+
+    assert exc.value.code == 1
+    assert mock_thumbs.call_args.args[3:5] == (3, "process")
+    mock_html.assert_called_once()
+    assert "1 thumbnails failed: b.jpg" in capsys.readouterr().err
+
+
 @patch("builtins.print")
 @patch("os.listdir", return_value=[])
-def test_main_no_images(mock_listdir: MagicMock, mock_print: MagicMock) -> None:
+def test_main_no_images(mock_listdir: MagicMock, mock_print: MagicMock, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(sys, "argv", ["ima-showth"])
     showth.main()
     mock_print.assert_any_call("No JPG files found.")
 
@@ -222,3 +634,457 @@ def test_full_render_integration(tmp_path: Path) -> None:
     # Each image reference should appear at least once -- and they're sorted backwards, alphabetically
     assert "th/img9.th.jpg" in first_html
     assert "th/img10.th.jpg" in second_html
+
+
+def test_main_remakes_only_changed_thumbnails(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "tmpl.html").write_text("{% for img in data %}{{ img.tname }} {% endfor %}")
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        Image.new("RGB", (320, 240), "red").save(name)
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "-j", "1"])
+    made: list[str] = []
+    make_pillow = showth.make_thumbnail_pillow
+
+    def make_thumbnail_pillow(img_path: str, out_path: str, width: int, height: int) -> None:
+        made.append(img_path)
+        make_pillow(img_path, out_path, width, height)
+
+    monkeypatch.setattr(showth, "make_thumbnail_pillow", make_thumbnail_pillow)
+
+    showth.main()
+    assert sorted(made) == ["a.jpg", "b.jpg", "c.jpg"]
+    assert (tmp_path / "th" / "manifest.json").exists()
+
+    made.clear()
+    showth.main()
+    assert made == []
+
+    Image.new("RGB", (320, 240), "blue").save("b.jpg")
+    os.utime("b.jpg", ns=(os.stat("b.jpg").st_atime_ns, os.stat("a.jpg").st_mtime_ns + 10**9))
+    os.remove("c.jpg")
+    capsys.readouterr()
+    showth.main()
+    assert made == ["b.jpg"]
+    assert not (tmp_path / "th" / "c.th.jpg").exists()
+    assert "Removed th/c.th.jpg" in capsys.readouterr().out
+
+
+# ---------------------------------------------------------------------------
+# --recursive
+# ---------------------------------------------------------------------------
+
+
+def _photo_tree(root: Path) -> None:
+    for directory in ("2019/spring", "2019/summer", "2020", "empty/nothing", ".hidden"):
+        (root / directory).mkdir(parents=True)
+    for name in (
+        "top.jpg",
+        "2019/spring/a.jpg",
+        "2019/spring/b.JPG",
+        "2019/summer/c.jpg",
+        "2020/d.jpg",
+        ".hidden/e.jpg",
+    ):
+        Image.new("RGB", (320, 240), "red").save(root / name)
+    (root / "2019" / "notes.txt").write_text("not a photo")
+    (root / "tmpl.html").write_text(
+        "{% for c in children %}[{{ c.href }}]{% endfor %}{% for img in data %}{{ img.name }} {% endfor %}"
+        "{% if linktoparent %}UP{% endif %}"
+    )
+
+
+def test_find_galleries(tmp_path: Path) -> None:
+    _photo_tree(tmp_path)
+    root = str(tmp_path)
+    galleries = {os.path.relpath(g.directory, root): g for g in showth.find_galleries(root)}
+
+    assert list(galleries) == ["2019/spring", "2019/summer", "2019", "2020", "."]
+    assert [entry.name for entry in galleries["2019/spring"].images] == ["a.jpg", "b.JPG"]
+    assert galleries["2019"].images == []
+    assert galleries["2019"].children == ["spring", "summer"]
+    assert galleries["."].children == ["2019", "2020"]
+
+
+def test_build_tree(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]) -> None:
+    _photo_tree(tmp_path)
+    root = str(tmp_path)
+    made: list[str] = []
+    make_pillow = showth.make_thumbnail_pillow
+
+    def make_thumbnail_pillow(img_path: str, out_path: str, width: int, height: int) -> None:
+        made.append(os.path.relpath(img_path, root))
+        make_pillow(img_path, out_path, width, height)
+
+    monkeypatch.setattr(showth, "make_thumbnail_pillow", make_thumbnail_pillow)
+
+    assert showth.build_tree(root, engine="pillow", jobs=1) == []
+    assert sorted(made) == ["2019/spring/a.jpg", "2019/spring/b.JPG", "2019/summer/c.jpg", "2020/d.jpg", "top.jpg"]
+    assert (tmp_path / "index.html").read_text() == "[2019/index.html][2020/index.html]top.jpg "
+    assert (tmp_path / "2019" / "index.html").read_text() == "[spring/index.html][summer/index.html]UP"
+    assert (tmp_path / "2019" / "spring" / "index.html").read_text() == "b.JPG a.jpg UP"
+    assert (tmp_path / "2019" / "spring" / "th" / "a.th.jpg").exists()
+    assert not (tmp_path / ".hidden" / "index.html").exists()
+    assert not (tmp_path / "empty" / "index.html").exists()
+
+    # Nothing changed: every directory is skipped
+    made.clear()
+    capsys.readouterr()
+    showth.build_tree(root, engine="pillow", jobs=1)
+    assert made == []
+    assert "5 of 5 directories unchanged" in capsys.readouterr().out
+
+    # A new photo: only its directory is rebuilt
+    Image.new("RGB", (320, 240), "blue").save(tmp_path / "2020" / "f.jpg")
+    with patch.object(showth, "create_html", wraps=showth.create_html) as create_html:
+        showth.build_tree(root, engine="pillow", jobs=1)
+    assert made == ["2020/f.jpg"]
+    assert [c.args[3] for c in create_html.call_args_list] == [os.path.join(root, "2020")]
+    assert (tmp_path / "2020" / "index.html").read_text() == "f.jpg d.jpg UP"
+
+
+def test_build_tree_retries_failed_directories(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "tmpl.html").write_text("{{ data|length }}")
+    (tmp_path / "bad.jpg").write_bytes(b"not a jpeg")
+    root = str(tmp_path)
+
+    assert showth.build_tree(root, engine="pillow", jobs=1) == [os.path.join(root, "bad.jpg")]
+    assert showth.build_tree(root, engine="pillow", jobs=1) == [os.path.join(root, "bad.jpg")]
+
+
+@patch("image_manipulation.showth.build_tree", return_value=[])
+def test_main_recursive(mock_build: MagicMock, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "--recursive", "photos", "-j", "2", "1"])
+    showth.main()
+    mock_build.assert_called_once_with(
+        "photos", True, "imagemagick", False, 2, "thread", False, showth.ThumbSpec(), False, "pages", None, None
+    )
+
+
+# ---------------------------------------------------------------------------
+# --stream
+# ---------------------------------------------------------------------------
+
+
+def test_image_record(tmp_path: Path) -> None:
+    (tmp_path / "photo.jpg").write_bytes(b"x" * 2048)
+    record = showth.ImageRecord.from_file("photo.jpg", str(tmp_path))
+    info = showth.get_image_info("photo.jpg", showth.THUMB_WIDTH, showth.THUMB_HEIGHT, str(tmp_path))
+
+    assert record.as_dict() == info
+    assert record["tname"] == record.tname == "th/photo.th.jpg"
+    assert record.get("bytes") == 2048
+    assert record.get("nope", 1) == 1
+    with pytest.raises(KeyError):
+        record["nope"]
+    with pytest.raises(AttributeError):
+        record.extra = 1  # type: ignore[attr-defined]
+    assert jinja2.Template("{{ img.name }} {{ img.size }}").render(img=record) == "photo.jpg 2.00kB"
+
+
+def test_stream_gallery_writes_pages_as_thumbnails_finish(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "tmpl.html").write_text("{% for img in data %}{{ img.name }} {% endfor %}")
+    names = [f"img{i:02}.jpg" for i in range(40)]
+    for name in names:
+        Path(name).write_bytes(b"jpeg")
+    events: list[str] = []
+
+    def make_thumbnail(img_path: str, out_path: str, *_: object) -> None:
+        events.append(img_path)
+        Path(out_path).write_bytes(b"th")
+
+    monkeypatch.setattr(showth, "make_thumbnail", make_thumbnail)
+    render_page = showth.render_page
+
+    def render(page_data: list, i: int, *args: Any, **kwargs: Any) -> None:
+        events.append(f"page {i}")
+        render_page(page_data, i, *args, **kwargs)
+
+    monkeypatch.setattr(showth, "render_page", render)
+    manifest = showth.Manifest("th")
+
+    assert showth.stream_gallery(list(names), False, manifest, jobs=1) == []
+
+    pages = [e for e in events if e.startswith("page")]
+    assert pages == ["page 1", "page 2", "page 3", "page 4"]
+    # With one worker, two pages are in flight: page 1 is written before the thumbnails of page 4 are started.
+    assert events.index("page 1") < events.index("img03.jpg")
+    assert (tmp_path / "index.html").read_text().startswith("img39.jpg img38.jpg")
+    assert (tmp_path / "index4.html").read_text() == "img03.jpg img02.jpg img01.jpg img00.jpg "
+    assert len(manifest.images) == 40
+
+
+@patch("image_manipulation.showth.stream_gallery", return_value=[])
+def test_main_stream(mock_stream: MagicMock, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Path("b.jpg").write_bytes(b"jpeg")
+    Path("a.th.jpg").write_bytes(b"jpeg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "--stream"])
+    showth.main()
+    assert mock_stream.call_args.args[0] == ["b.jpg"]
+
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "--stream", "--recursive", "."])
+    with pytest.raises(SystemExit):
+        showth.main()
+
+
+def _thumb_files() -> list[str]:
+    """What's in th/, apart from the compiled template."""
+    return sorted(name for name in os.listdir("th") if not name.startswith("__jinja2_"))
+
+
+def test_main_sizes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "tmpl.html").write_text(
+        '{% for img in data %}<img src="{{ img.tname }}" srcset="{{ img.srcset }}">{% endfor %}'
+    )
+    Image.new("RGB", (1600, 1200), "red").save("a.jpg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--sizes", "160,320"])
+
+    showth.main()
+
+    assert _thumb_files() == ["a.320w.th.jpg", "a.th.jpg", "manifest.json"]
+    assert 'srcset="th/a.th.jpg 1x, th/a.320w.th.jpg 2x"' in (tmp_path / "index.html").read_text()
+
+    # Back to one size: the bigger thumbnails are deleted
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow"])
+    showth.main()
+    assert _thumb_files() == ["a.th.jpg", "manifest.json"]
+
+
+def test_main_sizes_checks_every_size(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (1600, 1200), "red").save("a.jpg")
+    os.makedirs("th")
+    Image.new("RGB", (160, 120), "red").save("th/a.th.jpg")  # from before there was a manifest
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--sizes", "160,320"])
+
+    showth.main()
+    assert _thumb_files() == ["a.320w.th.jpg", "a.th.jpg", "manifest.json"]
+
+    # A deleted size is made again
+    os.remove("th/a.320w.th.jpg")
+    showth.main()
+    assert _thumb_files() == ["a.320w.th.jpg", "a.th.jpg", "manifest.json"]
+
+
+# ---------------------------------------------------------------------------
+# --sprites
+# ---------------------------------------------------------------------------
+
+
+def test_create_html_sprites(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    tmpl = Path(str(files("image_manipulation").joinpath("tmpl.html"))).read_text()
+    (tmp_path / "tmpl.html").write_text(tmpl)
+    os.makedirs("th")
+    colours = ["red", "green", "blue"]
+    data = []
+    for i, colour in enumerate(colours):
+        Image.new("RGB", (160, 120) if i != 1 else (90, 120), colour).save(f"th/img{i}.th.jpg")
+        data.append({"name": f"img{i}.jpg", "tname": f"th/img{i}.th.jpg", "ddate": 1.0, "width": 160, "height": 120})
+    data.append({"name": "broken.jpg", "tname": "th/broken.th.jpg", "ddate": 1.0, "width": 160, "height": 120})
+
+    showth.create_html(data, linktoparent=False, manifest=showth.Manifest("th"), sprites=True)
+
+    with Image.open("th/sprite1.jpg") as sprite:
+        assert sprite.size == (160 + 90 + 160, 120)
+        # Sorted by name, descending: img2 (blue), img1 (green), img0 (red)
+        assert [sprite.getpixel((x, 60)) for x in (80, 205, 330)] == [  # type: ignore[misc]
+            pytest.approx((0, 0, 254), abs=3),
+            pytest.approx((0, 128, 1), abs=3),
+            pytest.approx((254, 0, 0), abs=3),
+        ]
+    html = (tmp_path / "index.html").read_text()
+    assert html.count("url(th/sprite1.jpg)") == 3
+    assert "url(th/sprite1.jpg) -160px 0;" in html and "width: 90px" in html
+    assert '<img src="th/broken.th.jpg"' in html
+    assert '<img src="th/img0.th.jpg"' not in html
+
+    # Sprites turned off: the pages go back to separate images and the sprite goes
+    showth.create_html(data, linktoparent=False, manifest=showth.Manifest("th"))
+    assert not os.path.exists("th/sprite1.jpg")
+    assert '<img src="th/img0.th.jpg"' in (tmp_path / "index.html").read_text()
+
+
+def test_main_sprites_follow_remade_thumbnails(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.effect_mandelbrot((1600, 1200), (-2.0, -1.2, 1.0, 1.2), 100).convert("RGB").save("a.jpg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--sprites", "--quality", "95"])
+    showth.main()
+    old = os.stat("th/sprite1.jpg").st_mtime_ns - 10**9
+    os.utime("th/sprite1.jpg", ns=(old, old))
+
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--sprites", "--quality", "5"])
+    showth.main()
+    assert os.stat("th/sprite1.jpg").st_mtime_ns != old
+
+
+def test_main_thumb_format(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "tmpl.html").write_text('{% for img in data %}<img src="{{ img.tname }}">{% endfor %}')
+    Image.new("RGB", (1600, 1200), "red").save("a.jpg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow"])
+    showth.main()
+    assert _thumb_files() == ["a.th.jpg", "manifest.json"]
+
+    # Switching format remakes the thumbnail, links the new one and deletes the old one
+    capsys.readouterr()
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--thumb-format", "webp", "--quality", "60"])
+    showth.main()
+
+    assert _thumb_files() == ["a.th.webp", "manifest.json"]
+    assert '<img src="th/a.th.webp">' in (tmp_path / "index.html").read_text()
+    size = os.path.getsize("th/a.th.webp")
+    assert f"Thumbnails: 1 files, {size / 1024:.1f}kB" in capsys.readouterr().out
+
+    # A different quality makes the thumbnail out of date too
+    mtime_ns = os.stat("th/a.th.webp").st_mtime_ns
+    os.utime("th/a.th.webp", ns=(mtime_ns - 10**9, mtime_ns - 10**9))
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--thumb-format", "webp", "--quality", "90"])
+    showth.main()
+    assert os.stat("th/a.th.webp").st_mtime_ns != mtime_ns - 10**9
+
+
+def test_main_shards_layout(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (1600, 1200), "red").save("a.jpg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--layout", "shards"])
+    showth.main()
+    assert json.loads(Path("th/shard1.json").read_text())[0][:2] == ["a.jpg", "th/a.th.jpg"]
+    assert "th/shard1.json" in (tmp_path / "index.html").read_text()
+
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "--layout", "shards", "--stream"])
+    with pytest.raises(SystemExit):
+        showth.main()
+
+
+def test_main_serve(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (1600, 1200), "red").save("a.jpg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--serve", "--port", "0", "--cache-size", "5"])
+
+    with patch.object(showth.server.ThreadingHTTPServer, "serve_forever", side_effect=KeyboardInterrupt) as serve:
+        showth.main()
+
+    serve.assert_called_once()
+    assert "th/a.th.jpg" in (tmp_path / "index.html").read_text()
+    assert not os.path.exists("th/a.th.jpg")  # made when first asked for
+
+
+def test_make_tiles_incremental(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (600, 400), "blue").save("pano.jpg")
+    Image.new("RGB", (60, 40), "blue").save("small.jpg")
+    data = [showth.get_image_info(f, 160, 120) for f in ("pano.jpg", "small.jpg")]
+
+    assert showth.make_tiles(data, 100_000) == []
+    assert data[0]["tiles"] == "th/viewer.html#tiles/pano.dzi"
+    assert "tiles" not in data[1]
+    assert os.path.exists("th/tiles/pano.dzi") and os.path.exists("th/tiles/pano_files/10/0_0.jpg")
+    assert "Deep Zoom" in (tmp_path / "th" / "viewer.html").read_text()
+
+    # Unchanged: nothing is built
+    data = [showth.get_image_info(f, 160, 120) for f in ("pano.jpg", "small.jpg")]
+    with patch.object(showth.tiles, "build_pyramid", side_effect=AssertionError("built")):
+        assert showth.make_tiles(data, 100_000) == []
+    assert data[0]["tiles"]
+
+    # Changed: built again
+    Image.new("RGB", (700, 400), "blue").save("pano.jpg")
+    with patch.object(showth.tiles, "build_pyramid", wraps=showth.tiles.build_pyramid) as build:
+        assert showth.make_tiles(data, 100_000) == []
+    build.assert_called_once_with("pano.jpg", "th/tiles/pano.dzi")
+
+    # No longer big enough: deleted
+    data = [showth.get_image_info(f, 160, 120) for f in ("pano.jpg", "small.jpg")]
+    assert showth.make_tiles(data, 1_000_000) == []
+    assert "tiles" not in data[0]
+    assert not os.path.exists("th/tiles/pano.dzi") and not os.path.exists("th/tiles/pano_files")
+
+
+def test_main_tiles(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (1200, 900), "red").save("a.jpg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--tiles-over", "1"])
+    showth.main()
+    assert 'href="th/viewer.html#tiles/a.dzi"' in (tmp_path / "index.html").read_text()
+
+
+def test_main_tiles_thumbnail_past_bomb_limit(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (1200, 900), "red").save("pano.jpg")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 200_000)
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--tiles-over", "1"])
+    showth.main()  # no SystemExit: the thumbnail was made
+    assert _thumb_files() == ["manifest.json", "pano.th.jpg", "tiles", "viewer.html"]
+
+
+def test_make_tiles_few_at_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    running: list[int] = [0, 0]  # now, most
+
+    def build_pyramid(img_path: str, dzi_path: str) -> None:
+        running[0] += 1
+        running[1] = max(running)
+        time.sleep(0.05)
+        running[0] -= 1
+        Path(dzi_path).write_text("dzi")
+
+    monkeypatch.setattr(showth.tiles, "build_pyramid", build_pyramid)
+    data = []
+    for i in range(6):
+        Image.new("RGB", (1200, 900), "red").save(f"img{i}.jpg")
+        data.append(showth.get_image_info(f"img{i}.jpg", showth.THUMB_WIDTH, showth.THUMB_HEIGHT))
+
+    assert showth.make_tiles(data, 1e6, jobs=8) == []
+    assert running[1] <= showth.TILES_JOBS
+
+
+def test_headers_kept_in_catalog(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("IMA_CATALOG", str(tmp_path / "catalog.sqlite3"))
+    monkeypatch.setattr(showth.tiles, "build_pyramid", lambda img_path, dzi_path: Path(dzi_path).write_text("dzi"))
+    Image.new("RGB", (600, 400), "blue").save("pano.jpg")
+    os.makedirs(showth.THUMB_DIR)
+    data = [showth.get_image_info("pano.jpg", 160, 120)]
+    showth.make_thumbnail_pillow("pano.jpg", showth.thumb_path(data[0]), 160, 120)
+
+    def run() -> tuple[Any, ...]:
+        return showth.make_tiles(data, 100_000), showth.sprite_layout(data, 0), showth.shard_entry(data[0])
+
+    first = run()
+    with patch.object(showth.probe, "read_header", side_effect=AssertionError("read again")):
+        assert run() == first
+    assert first[1]["cells"] == [{"x": 0, "width": 160, "height": 107}]
+
+
+# ---------------------------------------------------------------------------
+# --duplicates
+# ---------------------------------------------------------------------------
+
+
+def _mandelbrot(path: str, size: tuple[int, int]) -> None:
+    Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 100).convert("RGB").save(path, quality=95)
+
+
+@pytest.mark.parametrize("mode", ["skip", "group"])
+def test_main_duplicates(
+    mode: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    _mandelbrot("a.jpg", (320, 240))
+    _mandelbrot("b.jpg", (640, 480))
+    Image.linear_gradient("L").convert("RGB").save("c.jpg")
+    monkeypatch.setattr(sys, "argv", ["ima-showth", "-e", "pillow", "--duplicates", mode])
+    showth.main()
+
+    assert "Skipping a.jpg: duplicate of b.jpg" in capsys.readouterr().out
+    assert _thumb_files() == ["b.th.jpg", "c.th.jpg", "manifest.json"]
+    page = (tmp_path / "index.html").read_text()
+    assert 'href="a.jpg"' not in page
+    assert ("Also: a.jpg" in page) == (mode == "group")
@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+
+from PIL import Image
+
+from image_manipulation import tiles
+
+
+def test_max_level() -> None:
+    assert tiles.max_level(1, 1) == 0
+    assert tiles.max_level(600, 300) == 10
+    assert tiles.max_level(256, 256) == 8
+
+
+def test_build_pyramid(tmp_path: Path) -> None:
+    src = tmp_path / "pano.jpg"
+    Image.new("RGB", (600, 300), "blue").save(src)
+    dzi = tmp_path / "pano.dzi"
+
+    tiles.build_pyramid(str(src), str(dzi))
+
+    assert 'TileSize="256" Overlap="0" Format="jpg"' in dzi.read_text()
+    assert '<Size Width="600" Height="300"/>' in dzi.read_text()
+    files = tmp_path / "pano_files"
+    assert sorted(os.listdir(files / "10")) == ["0_0.jpg", "0_1.jpg", "1_0.jpg", "1_1.jpg", "2_0.jpg", "2_1.jpg"]
+    assert sorted(os.listdir(files / "9")) == ["0_0.jpg", "1_0.jpg"]
+    with Image.open(files / "10" / "2_1.jpg") as tile:
+        assert tile.size == (88, 44)
+    with Image.open(files / "9" / "1_0.jpg") as tile:
+        assert tile.size == (44, 150)
+    with Image.open(files / "0" / "0_0.jpg") as tile:
+        assert tile.size == (1, 1)
+    assert sorted(int(level) for level in os.listdir(files)) == list(range(11))
+
+    # Built again smaller: the old levels go
+    Image.new("RGB", (200, 100), "blue").save(src)
+    tiles.build_pyramid(str(src), str(dzi))
+    assert sorted(int(level) for level in os.listdir(files)) == list(range(9))
+    assert not os.path.exists(str(files) + ".tmp")
+
+    tiles.remove_pyramid(str(dzi))
+    assert not dzi.exists() and not files.exists()
+
+
+def test_build_pyramid_upright(tmp_path: Path) -> None:
+    src = tmp_path / "scan.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new("RGB", (400, 300), "white").save(src, exif=exif)
+    dzi = tmp_path / "scan.dzi"
+
+    tiles.build_pyramid(str(src), str(dzi))
+
+    assert '<Size Width="300" Height="400"/>' in dzi.read_text()
@@ -1,6 +1,8 @@
+from pathlib import Path
 from unittest.mock import patch, Mock
 
 import pytest
+from PIL import Image
 
 from image_manipulation.utils import image_dimensions
 
@@ -35,3 +37,25 @@ def test_image_dimensions_error() -> None:
     with patch("subprocess.run", return_value=mock_result):
         with pytest.raises(RuntimeError, match="Error reading image dimensions"):
             list(image_dimensions("bad.jpg"))
+
+
+def test_image_dimensions_from_header(tmp_path: Path) -> None:
+    path = tmp_path / "image.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new("RGB", (640, 480)).save(path, exif=exif)
+
+    with patch("subprocess.run") as mock_run:
+        assert image_dimensions(str(path)) == (640, 480)
+        assert image_dimensions(str(path), oriented=True) == (480, 640)
+        mock_run.assert_not_called()
+
+
+def test_image_dimensions_unknown_format_uses_identify(tmp_path: Path) -> None:
+    path = tmp_path / "image.bmp"
+    Image.new("RGB", (64, 48)).save(path)
+    mock_result = Mock(returncode=0, stdout="64 48")
+
+    with patch("subprocess.run", return_value=mock_result) as mock_run:
+        assert image_dimensions(str(path)) == (64, 48)
+        mock_run.assert_called_once()